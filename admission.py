@@ -0,0 +1,122 @@
+from asyncio import CancelledError, Future, TimeoutError, get_running_loop, shield, wait_for
+from collections import deque
+from contextlib import asynccontextmanager
+from math import ceil
+from typing import AsyncIterator, Deque, Tuple
+
+from kh_common.exceptions.http_error import ServiceUnavailable
+
+
+class AdmissionRejected(ServiceUnavailable) :
+	# an HttpError, so that HttpErrorHandler passes it through rather than turning it into a 500
+
+	def __init__(self: 'AdmissionRejected', message: str, retry_after: int) -> None :
+		ServiceUnavailable.__init__(self, message, retry_after=retry_after)
+		self.retry_after: int = retry_after
+
+
+class WeightedAdmission :
+	"""
+	a weighted semaphore with a bounded, first in first out wait queue.
+	work is admitted while the sum of admitted weights fits within capacity. weights larger than
+	capacity are clamped to it, so oversized work still runs, just on its own.
+	"""
+
+	def __init__(self: 'WeightedAdmission', capacity: int, max_waiters: int, deadline: float) -> None :
+		self.capacity: int = capacity
+		self.max_waiters: int = max_waiters
+		self.deadline: float = deadline
+		self._in_use: int = 0
+		self._waiters: Deque[Tuple[int, Future]] = deque()
+
+
+	@property
+	def in_use(self: 'WeightedAdmission') -> int :
+		return self._in_use
+
+
+	@property
+	def waiting(self: 'WeightedAdmission') -> int :
+		return len(self._waiters)
+
+
+	@property
+	def retry_after(self: 'WeightedAdmission') -> int :
+		return max(ceil(self.deadline), 1)
+
+
+	def _fits(self: 'WeightedAdmission', weight: int) -> bool :
+		return self._in_use + weight <= self.capacity
+
+
+	def _wake(self: 'WeightedAdmission') -> None :
+		while self._waiters and self._fits(self._waiters[0][0]) :
+			weight, future = self._waiters.popleft()
+
+			if future.done() :
+				continue
+
+			self._in_use += weight
+			future.set_result(None)
+
+
+	async def acquire(self: 'WeightedAdmission', weight: int) -> int :
+		"""
+		waits until the given weight can be admitted and returns the weight that was charged,
+		which must be passed back to release. raises AdmissionRejected when the wait queue is full
+		or when the weight could not be admitted before the deadline.
+		"""
+		weight = max(1, min(weight, self.capacity))
+
+		if not self._waiters and self._fits(weight) :
+			self._in_use += weight
+			return weight
+
+		if len(self._waiters) >= self.max_waiters :
+			raise AdmissionRejected('server is at capacity and the wait queue is full, try again later.', self.retry_after)
+
+		future: Future = get_running_loop().create_future()
+		entry: Tuple[int, Future] = (weight, future)
+		self._waiters.append(entry)
+
+		try :
+			await wait_for(shield(future), self.deadline)
+
+		except TimeoutError :
+			# the weight may have been granted between the timeout firing and this handler running
+			if not future.done() :
+				self._waiters.remove(entry)
+				future.cancel()
+				# smaller waiters queued behind this one may fit now
+				self._wake()
+				raise AdmissionRejected('server is at capacity, try again later.', self.retry_after)
+
+		except CancelledError :
+			if future.done() :
+				self.release(weight)
+
+			else :
+				self._waiters.remove(entry)
+				future.cancel()
+				# smaller waiters queued behind this one may fit now
+				self._wake()
+
+			raise
+
+		return weight
+
+
+	def release(self: 'WeightedAdmission', weight: int) -> None :
+		self._in_use -= weight
+		self._wake()
+
+
+	@asynccontextmanager
+	async def admit(self: 'WeightedAdmission', weight: int) -> AsyncIterator[None] :
+		weight = await self.acquire(weight)
+
+		try :
+			yield
+
+		finally :
+			self.release(weight)
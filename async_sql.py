@@ -0,0 +1,190 @@
+from asyncio import Lock
+from re import Match, compile
+from time import perf_counter
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import asyncpg
+from kh_common.config.credentials import db
+from metrics import Counter, Gauge, Histogram, TimeBuckets, registry
+
+
+PoolConnections: Gauge = registry.register(Gauge('uploader_sql_pool_connections', 'connections held by the async postgres pool.', ('state',)))
+PoolAcquireSeconds: Histogram = registry.register(Histogram('uploader_sql_pool_acquire_seconds', 'time spent waiting for a pooled postgres connection.', TimeBuckets))
+QuerySeconds: Histogram = registry.register(Histogram('uploader_sql_query_seconds', 'postgres round trip time per statement type.', TimeBuckets, ('statement',)))
+PreparedStatements: Counter = registry.register(Counter('uploader_sql_prepared_statements_total', 'distinct statements translated for, and prepared by, the async pool.'))
+
+_placeholder = compile(r'%s')
+
+
+def _translate(sql: str) -> str :
+	# psycopg2 style %s placeholders to asyncpg's positional $n placeholders
+	index: int = 0
+
+	def replace(match: Match) -> str :
+		nonlocal index
+		index += 1
+		return f'${index}'
+
+	return _placeholder.sub(replace, sql)
+
+
+class AsyncTransaction :
+	"""
+	mirrors kh_common's Transaction: queries run inside a single transaction on one pooled connection,
+	commit() must be called explicitly, and leaving the outermost context without committing rolls back.
+	entering an already open transaction again is a no-op, so it can be passed down into helpers.
+	"""
+
+	def __init__(self: 'AsyncTransaction', interface: 'AsyncSqlInterface') -> None :
+		self._interface: AsyncSqlInterface = interface
+		self._connection: Optional[asyncpg.Connection] = None
+		self._transaction = None
+		self._depth: int = 0
+		self._committed: bool = False
+
+
+	async def __aenter__(self: 'AsyncTransaction') -> 'AsyncTransaction' :
+		if not self._depth :
+			self._connection = await self._interface._acquire()
+			self._transaction = self._connection.transaction()
+			await self._transaction.start()
+
+		self._depth += 1
+		return self
+
+
+	async def __aexit__(self: 'AsyncTransaction', exc_type, exc, tb) -> None :
+		self._depth -= 1
+
+		if self._depth :
+			return
+
+		try :
+			if not self._committed :
+				await self._transaction.rollback()
+
+		finally :
+			await self._interface._release(self._connection)
+			self._connection = None
+
+
+	async def query(self: 'AsyncTransaction', sql: str, params: Tuple = (), fetch_one: bool = False, fetch_all: bool = False) -> Any :
+		return await self._interface._execute(self._connection, sql, params, fetch_one, fetch_all)
+
+
+	async def commit(self: 'AsyncTransaction') -> None :
+		await self._transaction.commit()
+		self._committed = True
+
+
+class AsyncSqlInterface :
+	"""
+	a native async counterpart to SqlInterface, backed by a bounded asyncpg pool.
+	queries keep SqlInterface's %s placeholders, but params are converted by their own map, since asyncpg
+	encodes bytes itself and rejects the psycopg2 wrappers SqlInterface converts them to. every statement is prepared by asyncpg
+	and cached per connection, so the fixed queries are only planned once per pooled connection.
+	"""
+
+	def __init__(self: 'AsyncSqlInterface', min_connections: int = 1, max_connections: int = 10, statement_cache_size: int = 256, conversions: Dict[type, Callable] = { }) -> None :
+		self._pool: Optional[asyncpg.Pool] = None
+		self._pool_lock: Lock = Lock()
+		self._pool_min: int = min_connections
+		self._pool_max: int = max_connections
+		self._statement_cache_size: int = statement_cache_size
+		self._translated: Dict[str, str] = { }
+		self._async_conversions: Dict[type, Callable] = {
+			tuple: list,
+			**conversions,
+		}
+
+
+	async def _get_pool(self: 'AsyncSqlInterface') -> asyncpg.Pool :
+		if self._pool :
+			return self._pool
+
+		async with self._pool_lock :
+			if not self._pool :
+				self._pool = await asyncpg.create_pool(
+					host=db.get('host'),
+					port=db.get('port'),
+					user=db.get('user'),
+					password=db.get('password'),
+					database=db.get('dbname') or db.get('database'),
+					min_size=self._pool_min,
+					max_size=self._pool_max,
+					statement_cache_size=self._statement_cache_size,
+				)
+
+		return self._pool
+
+
+	def _update_pool_metrics(self: 'AsyncSqlInterface') -> None :
+		idle: int = self._pool.get_idle_size()
+		PoolConnections.set(idle, 'idle')
+		PoolConnections.set(self._pool.get_size() - idle, 'in_use')
+		PoolConnections.set(self._pool_max, 'max')
+
+
+	async def _acquire(self: 'AsyncSqlInterface') -> asyncpg.Connection :
+		pool: asyncpg.Pool = await self._get_pool()
+		start: float = perf_counter()
+		connection: asyncpg.Connection = await pool.acquire()
+		PoolAcquireSeconds.observe(perf_counter() - start)
+		self._update_pool_metrics()
+		return connection
+
+
+	async def _release(self: 'AsyncSqlInterface', connection: asyncpg.Connection) -> None :
+		await self._pool.release(connection)
+		self._update_pool_metrics()
+
+
+	async def _execute(self: 'AsyncSqlInterface', connection: asyncpg.Connection, sql: str, params: Tuple, fetch_one: bool, fetch_all: bool) -> Any :
+		translated: Optional[str] = self._translated.get(sql)
+
+		if translated is None :
+			translated = self._translated[sql] = _translate(sql)
+			PreparedStatements.inc()
+
+		args: Tuple = tuple(map(self._convert_async_item, params or ()))
+		start: float = perf_counter()
+
+		try :
+			if fetch_one :
+				return await connection.fetchrow(translated, *args)
+
+			if fetch_all :
+				return await connection.fetch(translated, *args)
+
+			return await connection.execute(translated, *args)
+
+		finally :
+			QuerySeconds.observe(perf_counter() - start, sql.split(None, 1)[0].upper())
+
+
+	def async_transaction(self: 'AsyncSqlInterface') -> AsyncTransaction :
+		return AsyncTransaction(self)
+
+
+	async def async_query(self: 'AsyncSqlInterface', sql: str, params: Tuple = (), fetch_one: bool = False, fetch_all: bool = False) -> Any :
+		connection: asyncpg.Connection = await self._acquire()
+
+		try :
+			return await self._execute(connection, sql, params, fetch_one, fetch_all)
+
+		finally :
+			await self._release(connection)
+
+
+	def _convert_async_item(self: 'AsyncSqlInterface', item: Any) -> Any :
+		for cls in type(item).__mro__ :
+			if cls in self._async_conversions :
+				return self._async_conversions[cls](item)
+
+		return item
+
+
+	async def close_pool(self: 'AsyncSqlInterface') -> None :
+		if self._pool :
+			await self._pool.close()
+			self._pool = None
@@ -0,0 +1,386 @@
+"""
+regenerates thumbnails, animated previews and thumbhashes for existing posts, using the same
+ImageProcessor that uploadImage uses. run it after changing thumbnail_sizes, output_quality,
+filter_function or adding a derivative, so that the existing catalog matches new uploads.
+
+	python3 -m backfill --checkpoint backfill.json                  # start, or resume, a backfill
+	python3 -m backfill --checkpoint backfill.json --processes 16 --b2-rps 50
+	python3 -m backfill --checkpoint backfill.json --restart        # ignore the checkpoint and start over
+
+post ids are streamed from kheina.public.posts in post_id order, skipping posts whose derivatives_version
+shows they were already rendered with the current settings, and, with the versioned layout, that have a media
+version. each original is downloaded from the cdn and rendered in a process pool. the post's row is then locked,
+as long as it still holds the same image, so an upload to the post waits for the backfill to finish with it
+instead of having its legacy keys overwritten with the old image's derivatives. the derivatives are written
+over the legacy keys and, when the versioned layout is enabled, the original and its derivatives are also
+uploaded under a new media version. then the post's media_version, derivatives_version, thumbhash and
+thumbnail_sizes are updated, and the previous version is deleted right away, since the backfill doesn't outlive
+it. the current legacy keys are never deleted. every b2 and cdn request shares a single rate limit.
+
+progress is checkpointed as the highest post_id below which every post is finished, so an interrupted
+backfill resumes where it left off and redoes at most the posts that were in flight. posts that fail are
+appended to the checkpoint's .failed file, one json object per line, and are not retried automatically.
+"""
+from argparse import ArgumentParser, Namespace
+from asyncio import Lock, Queue, gather, get_running_loop, run, sleep
+from collections import deque
+from functools import partial
+from json import dump, dumps, load
+from os import cpu_count, path, replace
+from time import monotonic
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+from urllib.parse import quote
+
+from aiohttp import ClientSession, ClientTimeout
+from async_sql import AsyncSqlInterface
+from batch_cache import BatchCache
+from cleanup import B2Cleanup
+from imaging import Derivatives, ImageProcessor, pool_render_derivatives
+from kh_common.backblaze import B2Interface
+from kh_common.caching.key_value_store import KeyValueStore
+from versioning import VersionedMedia, media_prefix, media_version, settings_version
+
+from fuzzly.models.post import PostId
+
+
+class RateLimit :
+	"""
+	a token bucket shared by every request the backfill makes. rate is in requests per second, 0 is unlimited.
+	"""
+
+	def __init__(self: 'RateLimit', rate: float, burst: Optional[int] = None) -> None :
+		self.rate: float = rate
+		self.burst: float = burst or max(rate, 1)
+		self._tokens: float = self.burst
+		self._updated: float = monotonic()
+		self._lock: Lock = Lock()
+
+
+	async def acquire(self: 'RateLimit') -> None :
+		if not self.rate :
+			return
+
+		async with self._lock :
+			now: float = monotonic()
+			self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+			self._updated = now
+
+			if self._tokens >= 1 :
+				self._tokens -= 1
+				return
+
+			# waiters queue on the lock, so each one sleeps for exactly the next token
+			await sleep((1 - self._tokens) / self.rate)
+			self._tokens = 0
+			self._updated = monotonic()
+
+
+class Checkpoint :
+	"""
+	tracks the posts in flight, in the order they were started, and persists the highest post_id below
+	which every post is finished. the settings that shape derivatives are stored alongside it, so a
+	backfill isn't resumed with different ones by accident.
+	"""
+
+	def __init__(self: 'Checkpoint', file: str, settings: Dict[str, Any], restart: bool = False) -> None :
+		self.file: str = file
+		self.failed_file: str = file + '.failed'
+		self.settings: Dict[str, Any] = settings
+		self.after: int = 0
+		self.done: int = 0
+		self.failed: int = 0
+		self._pending: Deque[int] = deque()
+		self._finished: Set[int] = set()
+
+		if restart or not path.exists(file) :
+			return
+
+		with open(file) as f :
+			saved: Dict[str, Any] = load(f)
+
+		if saved['settings'] != settings :
+			raise ValueError(f'{file} was written with different settings, pass --restart to start over. saved: {saved["settings"]}, current: {settings}')
+
+		self.after = saved['after']
+		self.done = saved['done']
+		self.failed = saved['failed']
+
+
+	def start(self: 'Checkpoint', post_id: int) -> None :
+		self._pending.append(post_id)
+
+
+	def finish(self: 'Checkpoint', post_id: int, error: Optional[str] = None) -> None :
+		self._finished.add(post_id)
+
+		if error is None :
+			self.done += 1
+
+		else :
+			self.failed += 1
+
+			with open(self.failed_file, 'a') as f :
+				f.write(dumps({ 'post_id': PostId(post_id), 'error': error }) + '\n')
+
+		while self._pending and self._pending[0] in self._finished :
+			self.after = self._pending.popleft()
+			self._finished.remove(self.after)
+
+
+	def save(self: 'Checkpoint') -> None :
+		# written to a temporary file first, so an interruption never leaves a truncated checkpoint behind
+		with open(self.file + '.tmp', 'w') as f :
+			dump({ 'after': self.after, 'done': self.done, 'failed': self.failed, 'settings': self.settings }, f)
+
+		replace(self.file + '.tmp', self.file)
+
+
+class Backfill(AsyncSqlInterface, B2Interface, B2Cleanup, VersionedMedia) :
+
+	def __init__(self: 'Backfill', args: Namespace) -> None :
+		concurrency: int = args.concurrency or args.processes * 2
+		# every post in flight holds a connection while its keys are written, plus one for the stream of post ids
+		AsyncSqlInterface.__init__(self, max_connections=concurrency + 1)
+		B2Interface.__init__(self, max_retries=5)
+		B2Cleanup.__init__(self, concurrency=4)
+		VersionedMedia.__init__(self, gc_delay=0)
+		self.processor: ImageProcessor = ImageProcessor()
+		self.processor.image_workers = args.processes
+		self.source: str = args.source.rstrip('/')
+		self.page_size: int = args.page_size
+		self.concurrency: int = concurrency
+		self.report_interval: float = args.report_interval
+		self.limit: RateLimit = RateLimit(args.b2_rps)
+		self.checkpoint: Checkpoint = Checkpoint(
+			args.checkpoint,
+			self.processor.derivative_settings(),
+			args.restart,
+		)
+		self.settings: str = settings_version(self.checkpoint.settings)
+		self.posts: BatchCache = BatchCache(KeyValueStore('kheina', 'posts'))
+		self.bytes_in: int = 0
+		self.bytes_out: int = 0
+
+
+	async def _b2_post(self: 'Backfill', endpoint: str, body: Dict[str, Any]) -> Dict[str, Any] :
+		# cleanup's list and delete calls count against the same limit as uploads
+		await self.limit.acquire()
+		return await B2Cleanup._b2_post(self, endpoint, body)
+
+
+	async def _stream_posts(self: 'Backfill', queue: Queue) -> None :
+		after: int = self.checkpoint.after
+
+		while True :
+			page: List[Tuple[int, str, Optional[str]]] = await self.async_query("""
+				SELECT posts.post_id, posts.filename, posts.media_version
+				FROM kheina.public.posts
+				WHERE posts.post_id > %s
+					AND posts.filename IS NOT NULL
+					AND (
+						posts.derivatives_version IS DISTINCT FROM %s
+						OR (%s AND posts.media_version IS NULL)
+					)
+				ORDER BY posts.post_id
+				LIMIT %s;
+				""",
+				(after, self.settings, self.versioned_media, self.page_size),
+				fetch_all=True,
+			)
+
+			for post_id, filename, version in page :
+				self.checkpoint.start(post_id)
+				await queue.put((post_id, filename, version))
+
+			if len(page) < self.page_size :
+				break
+
+			after = page[-1][0]
+
+		for _ in range(self.concurrency) :
+			await queue.put(None)
+
+
+	async def _download(self: 'Backfill', session: ClientSession, post_id: int, filename: str, version: Optional[str]) -> bytes :
+		await self.limit.acquire()
+
+		async with session.get(f'{self.source}/{media_prefix(post_id, version)}{quote(filename)}', raise_for_status=True) as response :
+			data: bytes = await response.read()
+
+		self.bytes_in += len(data)
+		return data
+
+
+	async def _upload(self: 'Backfill', data: bytes, url: str, content_type: str, immutable: bool = True) -> None :
+		await self.limit.acquire()
+
+		if immutable :
+			await get_running_loop().run_in_executor(None, self.b2_upload_immutable, data, url, content_type)
+
+		else :
+			await get_running_loop().run_in_executor(None, partial(self.b2_upload, data, url, content_type=content_type))
+
+		self.bytes_out += len(data)
+
+
+	async def _upload_media(self: 'Backfill', data: bytes, post_id: int, version: Optional[str], key: str, content_type: str) -> None :
+		# readers still build unversioned urls, so the legacy key is always rewritten
+		await self._upload(data, media_prefix(post_id, None) + key, content_type, immutable=False)
+
+		if version :
+			await self._upload(data, media_prefix(post_id, version) + key, content_type)
+
+
+	async def _backfill_post(self: 'Backfill', session: ClientSession, post_id: int, filename: str, old_version: Optional[str]) -> None :
+		content_type: str = self.mime_types.get(filename[filename.rfind('.') + 1:].lower(), '')
+
+		if not content_type.startswith('image/') :
+			# videos have no derivatives yet
+			return
+
+		data: bytes = await self._download(session, post_id, filename, old_version)
+		version: Optional[str] = media_version(data, self.checkpoint.settings, filename) if self.versioned_media else None
+
+		if version and version == old_version :
+			# already rendered with these settings, by a run from before derivatives_version was recorded
+			await self.async_query("""
+				UPDATE kheina.public.posts
+					SET derivatives_version = %s
+				WHERE posts.post_id = %s
+					AND posts.media_version = %s;
+				""",
+				(self.settings, post_id, version),
+			)
+			return
+
+		derivatives: Derivatives = await get_running_loop().run_in_executor(self.processor.image_pool, pool_render_derivatives, data)
+
+		async with self.async_transaction() as transaction :
+			# an upload to the post updates this row before writing its keys, so while it's locked here, the
+			# upload waits for the keys below to be written and then overwrites them with its own
+			locked: Optional[Tuple[int]] = await transaction.query("""
+				SELECT posts.post_id
+				FROM kheina.public.posts
+				WHERE posts.post_id = %s
+					AND posts.filename = %s
+					AND posts.media_version IS NOT DISTINCT FROM %s
+				FOR UPDATE;
+				""",
+				(post_id, filename, old_version),
+				fetch_one=True,
+			)
+
+			if not locked :
+				# a new image was uploaded to the post while this one was being rendered, and it brought its own media
+				return
+
+			if version :
+				# versioned keys are immutable, so the original moves to the new version along with its derivatives
+				await self._upload(data, media_prefix(post_id, version) + filename, content_type)
+
+			del data
+
+			for thumbnail in derivatives.thumbnails :
+				await self._upload_media(thumbnail.data, post_id, version, f'thumbnails/{thumbnail.name}', self._get_mime_from_filename(thumbnail.name))
+
+			if derivatives.animated_preview :
+				await self._upload_media(derivatives.animated_preview, post_id, version, 'thumbnails/animated.webp', self.mime_types['webp'])
+
+			await transaction.query("""
+				UPDATE kheina.public.posts
+					SET thumbhash = %s,
+						thumbnail_sizes = %s,
+						media_version = %s,
+						derivatives_version = %s
+				WHERE posts.post_id = %s;
+				""",
+				(derivatives.thumbhash, derivatives.sizes, version, self.settings, post_id),
+			)
+			await transaction.commit()
+
+		await self.posts.remove(PostId(post_id))
+		await self.collect_post_media(PostId(post_id))
+
+
+	async def _worker(self: 'Backfill', session: ClientSession, queue: Queue) -> None :
+		while True :
+			item: Optional[Tuple[int, str, Optional[str]]] = await queue.get()
+
+			if item is None :
+				return
+
+			post_id, filename, version = item
+			error: Optional[str] = None
+
+			try :
+				await self._backfill_post(session, post_id, filename, version)
+
+			except Exception as e :
+				error = f'{type(e).__name__}: {e}'
+
+			self.checkpoint.finish(post_id, error)
+
+
+	async def _report(self: 'Backfill') -> None :
+		start: float = monotonic()
+		last: Tuple[float, int, int, int] = (start, self.checkpoint.done, self.bytes_in, self.bytes_out)
+
+		while True :
+			await sleep(self.report_interval)
+			self.checkpoint.save()
+
+			now: float = monotonic()
+			elapsed: float = now - last[0]
+			print(
+				f'{self.checkpoint.done:>10} done {self.checkpoint.failed:>6} failed'
+				f'  {(self.checkpoint.done - last[1]) / elapsed:8.1f} posts/s'
+				f'  {(self.bytes_in - last[2]) / elapsed / 2**20:7.1f} MiB/s in'
+				f'  {(self.bytes_out - last[3]) / elapsed / 2**20:7.1f} MiB/s out'
+				f'  after {PostId(self.checkpoint.after) if self.checkpoint.after else "-"}',
+				flush=True,
+			)
+			last = (now, self.checkpoint.done, self.bytes_in, self.bytes_out)
+
+
+	async def run(self: 'Backfill') -> None :
+		queue: Queue = Queue(self.concurrency * 2)
+		reporter = get_running_loop().create_task(self._report())
+		start: float = monotonic()
+
+		try :
+			async with ClientSession(timeout=ClientTimeout(total=self.b2_timeout)) as session :
+				await gather(
+					self._stream_posts(queue),
+					*(self._worker(session, queue) for _ in range(self.concurrency)),
+				)
+
+			# deletes that failed are retried with backoff, so give them the chance to finish before exiting
+			if self._cleanup_task :
+				await self._cleanup_task
+
+		finally :
+			reporter.cancel()
+			self.checkpoint.save()
+			self.processor.close_image_pool()
+			await self.close_pool()
+
+		elapsed: float = monotonic() - start
+		print(f'finished: {self.checkpoint.done} done, {self.checkpoint.failed} failed in {elapsed:.0f}s ({self.checkpoint.done / elapsed:.1f} posts/s)')
+
+
+def parse_args() -> Namespace :
+	parser: ArgumentParser = ArgumentParser(description='regenerates derivatives for existing posts.')
+	parser.add_argument('--checkpoint', default='backfill.json', help='progress file, resumed from if it exists.')
+	parser.add_argument('--restart', action='store_true', help='ignore an existing checkpoint and start from the first post.')
+	parser.add_argument('--processes', type=int, default=cpu_count() or 1, help='image processing workers.')
+	parser.add_argument('--concurrency', type=int, default=0, help='posts in flight, defaults to twice the processes.')
+	parser.add_argument('--b2-rps', type=float, default=25, help='cdn and b2 requests per second across all posts, 0 for unlimited.')
+	parser.add_argument('--page-size', type=int, default=1000, help='post ids read from postgres per query.')
+	parser.add_argument('--source', default='https://cdn.fuzz.ly', help='where originals are downloaded from.')
+	parser.add_argument('--report-interval', type=float, default=10, help='seconds between progress reports and checkpoints.')
+	return parser.parse_args()
+
+
+if __name__ == '__main__' :
+	args: Namespace = parse_args()
+	run(Backfill(args).run())
@@ -0,0 +1,200 @@
+from asyncio import get_running_loop
+from functools import partial
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import aerospike
+from aerospike_helpers.batch.records import BatchRecords, Write
+from aerospike_helpers.operations import operations
+from kh_common.caching.key_value_store import KeyValueStore
+from metrics import Counter, registry
+
+
+BatchCalls: Counter = registry.register(Counter('uploader_kvs_batch_calls_total', 'aerospike calls made by the batch cache, per operation.', ('operation',)))
+BatchKeys: Counter = registry.register(Counter('uploader_kvs_batch_keys_total', 'keys covered by batch cache calls, per operation.', ('operation',)))
+
+# aerospike.exception.RecordNotFound's code, as reported per record by batch calls
+KeyNotFound: int = 2
+
+
+class BatchCache :
+	"""
+	multi-key and read-modify-write access to a KeyValueStore's set, each in a single aerospike call.
+	values live in the store's 'data' bin, so the store's own get/put keep working on the same records.
+	counters are only ever incremented if they already exist, so that a missing counter can be populated
+	from the database rather than silently starting from zero.
+	"""
+
+	def __init__(self: 'BatchCache', store: KeyValueStore, max_retries: int = 3) -> None :
+		self._store: KeyValueStore = store
+		self._read_policy: Dict[str, Any] = { 'max_retries': max_retries }
+		self._update_policy: Dict[str, Any] = { 'max_retries': max_retries, 'exists': aerospike.POLICY_EXISTS_UPDATE }
+		self._create_policy: Dict[str, Any] = { 'max_retries': max_retries, 'exists': aerospike.POLICY_EXISTS_CREATE }
+
+
+	def _key(self: 'BatchCache', key: str) -> Tuple[str, str, str] :
+		return (self._store._namespace, self._store._set, key)
+
+
+	async def _run(self: 'BatchCache', operation: str, keys: int, func: Callable, *args: Any, **kwargs: Any) -> Any :
+		BatchCalls.inc(1, operation)
+		BatchKeys.inc(keys, operation)
+		return await get_running_loop().run_in_executor(None, partial(func, *args, **kwargs))
+
+
+	async def exists_many(self: 'BatchCache', keys: Iterable[str]) -> Dict[str, bool] :
+		keys = list(keys)
+
+		if not keys :
+			return { }
+
+		records: List[Tuple] = await self._run('exists_many', len(keys), KeyValueStore._client.exists_many, list(map(self._key, keys)), self._read_policy)
+		# records come back in the order of the keys, with empty metadata when a record doesn't exist
+		return { key: meta is not None for key, (_, meta) in zip(keys, records) }
+
+
+	async def get_many(self: 'BatchCache', keys: Iterable[str]) -> Dict[str, Optional[Any]] :
+		return (await get_many_across([(self, keys)]))[0]
+
+
+	async def remove(self: 'BatchCache', key: str) -> bool :
+		"""
+		removes the record without checking for it first, returns whether it existed.
+		"""
+		self._store._cache.pop(key, None)
+
+		try :
+			await self._run('remove', 1, KeyValueStore._client.remove, self._key(key), policy=self._read_policy)
+			return True
+
+		except aerospike.exception.RecordNotFound :
+			return False
+
+
+	async def remove_many(self: 'BatchCache', keys: Iterable[str]) -> None :
+		keys = list(keys)
+
+		if not keys :
+			return
+
+		for key in keys :
+			self._store._cache.pop(key, None)
+
+		# missing records are reported per record rather than raised, which is exactly what invalidation wants
+		await self._run('remove_many', len(keys), KeyValueStore._client.batch_remove, list(map(self._key, keys)))
+
+
+	async def put_many(self: 'BatchCache', values: Dict[str, Any]) -> None :
+		"""
+		writes every value in a single call, with the namespace's default ttl, like KeyValueStore.put.
+		"""
+		if not values :
+			return
+
+		for key in values :
+			self._store._cache.pop(key, None)
+
+		batch: BatchRecords = await self._run(
+			'put_many',
+			len(values),
+			KeyValueStore._client.batch_write,
+			BatchRecords([Write(self._key(key), [operations.write('data', value)]) for key, value in values.items()]),
+		)
+
+		for key, record in zip(values, batch.batch_records) :
+			if record.result :
+				raise aerospike.exception.AerospikeError(record.result, f'failed to write {key}.')
+
+
+	async def create(self: 'BatchCache', key: str, value: Any, ttl: int = -1) -> bool :
+		"""
+		writes value only if the record doesn't exist yet, returns whether it was written. by default, the record never expires.
+		"""
+		try :
+			await self._run('create', 1, KeyValueStore._client.put, self._key(key), { 'data': value }, meta={ 'ttl': ttl }, policy=self._create_policy)
+			return True
+
+		except aerospike.exception.RecordExistsError :
+			return False
+
+
+	async def increment(self: 'BatchCache', key: str, value: int) -> Optional[int] :
+		"""
+		increments and reads back an existing counter in one call. returns None if the counter doesn't exist.
+		"""
+		try :
+			_, _, bins = await self._run(
+				'increment',
+				1,
+				KeyValueStore._client.operate,
+				self._key(key),
+				[operations.increment('data', value), operations.read('data')],
+				meta={ 'ttl': -1 },
+				policy=self._update_policy,
+			)
+			return bins['data']
+
+		except aerospike.exception.RecordNotFound :
+			return None
+
+
+	async def increment_many(self: 'BatchCache', deltas: Dict[str, int]) -> Dict[str, Optional[int]] :
+		"""
+		increments existing counters, one batch call per distinct delta, and returns their new values.
+		counters that don't exist are left alone and returned as None.
+		"""
+		by_value: Dict[int, List[str]] = { }
+
+		for key, value in deltas.items() :
+			by_value.setdefault(value, []).append(key)
+
+		results: Dict[str, Optional[int]] = { }
+
+		for value, keys in by_value.items() :
+			batch = await self._run(
+				'increment_many',
+				len(keys),
+				KeyValueStore._client.batch_operate,
+				list(map(self._key, keys)),
+				# batch writes have no meta argument, so the never expire ttl is set by a touch instead
+				[operations.increment('data', value), operations.touch(-1), operations.read('data')],
+				policy_batch_write={ 'exists': aerospike.POLICY_EXISTS_UPDATE },
+			)
+
+			for key, record in zip(keys, batch.batch_records) :
+				if record.result == KeyNotFound :
+					results[key] = None
+
+				elif record.result :
+					raise aerospike.exception.AerospikeError(record.result, f'failed to increment {key}.')
+
+				else :
+					results[key] = record.record[2]['data']
+
+		return results
+
+
+async def get_many_across(lookups: Iterable[Tuple[BatchCache, Iterable[str]]]) -> List[Dict[str, Optional[Any]]] :
+	"""
+	reads keys from any number of caches' sets in a single aerospike call. returns the values read from each
+	cache, in the order of lookups, with None for missing records.
+	"""
+	lookups = [(cache, list(keys)) for cache, keys in lookups]
+	keys: List[Tuple[str, str, str]] = [cache._key(key) for cache, cache_keys in lookups for key in cache_keys]
+
+	if not keys :
+		return [{ } for _ in lookups]
+
+	cache: BatchCache = lookups[0][0]
+	records: List[Tuple] = await cache._run('get_many', len(keys), KeyValueStore._client.get_many, keys, cache._read_policy)
+	results: List[Dict[str, Optional[Any]]] = []
+	offset: int = 0
+
+	# records come back in the order of the keys
+	for _, cache_keys in lookups :
+		results.append({
+			key: bins['data'] if meta is not None else None
+			for key, (_, meta, bins) in zip(cache_keys, records[offset:offset + len(cache_keys)])
+		})
+		offset += len(cache_keys)
+
+	return results
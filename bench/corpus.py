@@ -0,0 +1,84 @@
+"""
+a fixed, generated image corpus. every image is derived from a seeded noise tile and a gradient,
+so the same spec always produces the same pixels without shipping binary fixtures.
+"""
+from hashlib import sha1
+from random import Random
+from typing import Dict, List, NamedTuple
+
+from wand.image import Image
+
+
+class ImageSpec(NamedTuple) :
+	name: str
+	width: int
+	height: int
+	format: str
+	frames: int = 1
+
+
+Corpus: List[ImageSpec] = [
+	ImageSpec('small_png', 300, 200, 'png'),
+	ImageSpec('photo_jpeg', 2000, 1500, 'jpeg'),
+	ImageSpec('large_jpeg', 4000, 3000, 'jpeg'),
+	ImageSpec('wide_webp', 3000, 1000, 'webp'),
+	ImageSpec('tall_png', 1000, 3000, 'png'),
+	ImageSpec('small_gif', 320, 240, 'gif', 10),
+	ImageSpec('large_gif', 800, 600, 'gif', 60),
+]
+
+Extensions: Dict[str, str] = {
+	'jpeg': 'jpg',
+	'png': 'png',
+	'webp': 'webp',
+	'gif': 'gif',
+}
+
+_tile_size: int = 128
+
+
+def _noise_tile(seed: int) -> Image :
+	random: Random = Random(seed)
+	pixels: bytes = bytes(random.getrandbits(8) for _ in range(_tile_size * _tile_size * 3))
+	return Image(blob=pixels, format='rgb', width=_tile_size, height=_tile_size, depth=8)
+
+
+def _frame(spec: ImageSpec, index: int) -> Image :
+	image: Image = Image(width=spec.width, height=spec.height, pseudo=f'gradient:#{(index * 40) % 256:02x}5080-#e0a040')
+
+	seed: int = int.from_bytes(sha1(f'{spec.name}:{index}'.encode()).digest()[:4], 'big')
+
+	with _noise_tile(seed) as tile, image.texture(tile) as noise :
+		image.composite(noise, operator='overlay')
+
+	return image
+
+
+def generate(spec: ImageSpec) -> bytes :
+	if spec.frames == 1 :
+		with _frame(spec, 0) as image :
+			image.format = spec.format
+			return image.make_blob()
+
+	with Image() as animation :
+		for i in range(spec.frames) :
+			with _frame(spec, i) as frame :
+				animation.sequence.append(frame)
+
+		for frame in animation.sequence :
+			frame.delay = 4
+
+		animation.format = spec.format
+		return animation.make_blob()
+
+
+def filename(spec: ImageSpec) -> str :
+	return f'{spec.name}.{Extensions[spec.format]}'
+
+
+def load() -> Dict[ImageSpec, bytes] :
+	return { spec: generate(spec) for spec in Corpus }
+
+
+def fingerprint(corpus: Dict[ImageSpec, bytes]) -> Dict[str, str] :
+	return { spec.name: sha1(data).hexdigest() for spec, data in corpus.items() }
@@ -0,0 +1,646 @@
+"""
+local stand-ins for the services the uploader talks to, so its pipelines can be run and measured
+on a single machine. install() must be called before uploader is imported, since importing it
+creates the module level KeyValueStores.
+"""
+import re
+from datetime import datetime, timezone
+from enum import Enum
+from logging import getLogger
+from os import makedirs, path, remove, walk
+from threading import Lock
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional, Pattern, Tuple
+
+
+class RecordNotFound(Exception) :
+	pass
+
+
+class FakeAerospike :
+	"""
+	a dict backed subset of the aerospike client api used through KeyValueStore.
+	"""
+
+	def __init__(self: 'FakeAerospike') -> None :
+		self._data: Dict[Tuple[str, str, Any], Dict[str, Any]] = { }
+		self._lock: Lock = Lock()
+		self._not_found: type = RecordNotFound
+
+		try :
+			import aerospike
+			self._not_found = aerospike.exception.RecordNotFound
+
+		except ImportError :
+			pass
+
+
+	def _key(self: 'FakeAerospike', key: Tuple) -> Tuple[str, str, Any] :
+		return tuple(key[:3])
+
+
+	def connect(self: 'FakeAerospike', *args, **kwargs) -> 'FakeAerospike' :
+		return self
+
+
+	def close(self: 'FakeAerospike') -> None :
+		pass
+
+
+	def get(self: 'FakeAerospike', key: Tuple, policy: dict = None) -> Tuple[Tuple, dict, Dict[str, Any]] :
+		with self._lock :
+			k = self._key(key)
+
+			if k not in self._data :
+				raise self._not_found(2, 'AEROSPIKE_ERR_RECORD_NOT_FOUND')
+
+			return k, { 'ttl': -1, 'gen': 1 }, dict(self._data[k])
+
+
+	def put(self: 'FakeAerospike', key: Tuple, bins: Dict[str, Any], meta: dict = None, policy: dict = None) -> None :
+		with self._lock :
+			k = self._key(key)
+
+			if k in self._data and (policy or { }).get('exists') == self._policy('POLICY_EXISTS_CREATE') :
+				import aerospike
+				raise aerospike.exception.RecordExistsError(5, 'AEROSPIKE_ERR_RECORD_EXISTS')
+
+			self._data.setdefault(k, { }).update(bins)
+
+
+	def exists(self: 'FakeAerospike', key: Tuple, policy: dict = None) -> Tuple[Tuple, Optional[dict]] :
+		with self._lock :
+			k = self._key(key)
+			return k, ({ 'ttl': -1, 'gen': 1 } if k in self._data else None)
+
+
+	def remove(self: 'FakeAerospike', key: Tuple, meta: dict = None, policy: dict = None) -> None :
+		with self._lock :
+			k = self._key(key)
+
+			if k not in self._data :
+				raise self._not_found(2, 'AEROSPIKE_ERR_RECORD_NOT_FOUND')
+
+			del self._data[k]
+
+
+	def increment(self: 'FakeAerospike', key: Tuple, bin: str, value: int, meta: dict = None, policy: dict = None) -> None :
+		with self._lock :
+			bins = self._data.setdefault(self._key(key), { })
+			bins[bin] = bins.get(bin, 0) + value
+
+
+	def get_many(self: 'FakeAerospike', keys: List[Tuple], policy: dict = None) -> List[Tuple[Tuple, Optional[dict], Optional[Dict[str, Any]]]] :
+		with self._lock :
+			results = []
+
+			for key in keys :
+				k = self._key(key)
+				if k in self._data :
+					results.append((k, { 'ttl': -1, 'gen': 1 }, dict(self._data[k])))
+
+				else :
+					results.append((k, None, None))
+
+			return results
+
+
+	def exists_many(self: 'FakeAerospike', keys: List[Tuple], policy: dict = None) -> List[Tuple[Tuple, Optional[dict]]] :
+		return [self.exists(key) for key in keys]
+
+
+	def _policy(self: 'FakeAerospike', name: str) -> Optional[int] :
+		try :
+			import aerospike
+			return getattr(aerospike, name)
+
+		except ImportError :
+			return None
+
+
+	def _operate(self: 'FakeAerospike', key: Tuple, ops: List[Dict[str, Any]], policy: Optional[dict]) -> Tuple[Tuple, dict, Dict[str, Any]] :
+		# only the write, increment, touch and read operations BatchCache uses are supported
+		import aerospike
+		k = self._key(key)
+
+		if k not in self._data and (policy or { }).get('exists') == aerospike.POLICY_EXISTS_UPDATE :
+			raise self._not_found(2, 'AEROSPIKE_ERR_RECORD_NOT_FOUND')
+
+		bins = self._data.setdefault(k, { })
+		read: Dict[str, Any] = { }
+
+		for op in ops :
+			if op['op'] == aerospike.OPERATOR_WRITE :
+				bins[op['bin']] = op['val']
+
+			elif op['op'] == aerospike.OPERATOR_INCR :
+				bins[op['bin']] = bins.get(op['bin'], 0) + op['val']
+
+			elif op['op'] == aerospike.OPERATOR_READ :
+				read[op['bin']] = bins.get(op['bin'])
+
+		return k, { 'ttl': -1, 'gen': 1 }, read
+
+
+	def operate(self: 'FakeAerospike', key: Tuple, ops: List[Dict[str, Any]], meta: dict = None, policy: dict = None) -> Tuple[Tuple, dict, Dict[str, Any]] :
+		with self._lock :
+			return self._operate(key, ops, policy)
+
+
+	def batch_operate(self: 'FakeAerospike', keys: List[Tuple], ops: List[Dict[str, Any]], policy_batch: dict = None, policy_batch_write: dict = None) -> SimpleNamespace :
+		records: List[SimpleNamespace] = []
+
+		with self._lock :
+			for key in keys :
+				try :
+					records.append(SimpleNamespace(key=key, result=0, record=self._operate(key, ops, policy_batch_write)))
+
+				except self._not_found :
+					records.append(SimpleNamespace(key=key, result=2, record=None))
+
+		return SimpleNamespace(result=0, batch_records=records)
+
+
+	def batch_write(self: 'FakeAerospike', batch_records: Any, policy_batch: dict = None) -> Any :
+		with self._lock :
+			for record in batch_records.batch_records :
+				record.record = self._operate(record.key, record.ops, record.policy)
+				record.result = 0
+
+		return batch_records
+
+
+	def batch_remove(self: 'FakeAerospike', keys: List[Tuple], policy_batch: dict = None, policy_batch_remove: dict = None) -> None :
+		with self._lock :
+			for key in keys :
+				self._data.pop(self._key(key), None)
+
+
+def install() -> FakeAerospike :
+	"""
+	points KeyValueStore at an in memory client, so no aerospike cluster is contacted.
+	"""
+	from kh_common.caching.key_value_store import KeyValueStore
+
+	if not isinstance(KeyValueStore._client, FakeAerospike) :
+		KeyValueStore._client = FakeAerospike()
+
+	return KeyValueStore._client
+
+
+class FakeB2 :
+	"""
+	writes uploads to a local directory instead of backblaze.
+	"""
+
+	def __init__(self: 'FakeB2', root: str) -> None :
+		self.root: str = root
+		self.uploaded: int = 0
+
+
+	def _path(self: 'FakeB2', filename: str) -> str :
+		return path.join(self.root, filename.lstrip('/'))
+
+
+	def b2_upload(self: 'FakeB2', file_data: bytes, filename: str, content_type: str = None, sha1: str = None) -> Dict[str, Any] :
+		file_path: str = self._path(filename)
+		makedirs(path.dirname(file_path), exist_ok=True)
+
+		with open(file_path, 'wb') as file :
+			file.write(file_data)
+
+		self.uploaded += len(file_data)
+		return { 'fileName': filename, 'contentLength': len(file_data), 'contentType': content_type }
+
+
+	def b2_upload_immutable(self: 'FakeB2', file_data: bytes, filename: str, content_type: str) -> Dict[str, Any] :
+		return self.b2_upload(file_data, filename, content_type)
+
+
+	def b2_delete_file(self: 'FakeB2', filename: str) -> bool :
+		try :
+			remove(self._path(filename))
+			return True
+
+		except FileNotFoundError :
+			return False
+
+
+	async def b2_delete_file_async(self: 'FakeB2', filename: str) -> bool :
+		return self.b2_delete_file(filename)
+
+
+	async def b2_list_versions(self: 'FakeB2', prefix: str) -> List[Dict[str, str]] :
+		# local files only ever have one version, so the name doubles as the file id
+		files: List[Dict[str, str]] = []
+
+		for directory, _, names in walk(self.root) :
+			for name in names :
+				filename: str = path.relpath(path.join(directory, name), self.root)
+
+				if filename.startswith(prefix) :
+					files.append({ 'fileName': filename, 'fileId': filename })
+
+		return sorted(files, key=lambda file : file['fileName'])
+
+
+	async def _b2_delete_version(self: 'FakeB2', file: Dict[str, str]) -> None :
+		remove(self._path(file['fileName']))
+
+
+class FakeDatabase :
+	"""
+	an in memory posts and users table that answers the fixed queries the uploader issues.
+	queries are matched by regex, unknown queries raise so that missing fakes are obvious.
+	"""
+
+	def __init__(self: 'FakeDatabase') -> None :
+		self.posts: Dict[int, Dict[str, Any]] = { }
+		self.users: Dict[int, Dict[str, Any]] = { }
+		self._lock: Lock = Lock()
+		self._routes: List[Tuple[Pattern, Callable[[str, tuple], Any]]] = []
+
+		# order matters, the first matching route answers the query
+		self.route(r'SELECT count\(1\) FROM kheina\.public\.posts WHERE post_id = ', self._post_exists)
+		self.route(r'INSERT INTO kheina\.public\.posts\s+\(post_id, uploader, privacy_id\)', self._create_unpublished)
+		self.route(r'SELECT post_id FROM kheina\.public\.posts\s+WHERE uploader = ', self._select_unpublished)
+		self.route(r'INSERT INTO kheina\.public\.posts\s+\(privacy_id, ', self._create_draft)
+		self.route(r'SELECT posts\.filename from kheina\.public\.posts', self._select_filename)
+		self.route(r'SELECT posts\.filename, posts\.media_version\s+FROM kheina\.public\.posts', self._select_media)
+		self.route(r'SELECT posts\.filename, posts\.media_version, posts\.thumbnail_sizes\s+FROM kheina\.public\.posts', self._select_collected_media)
+		self.route(r'UPDATE kheina\.public\.posts\s+SET updated_on = NOW\(\),\s+media_type_id', self._update_media)
+		self.route(r'UPDATE kheina\.public\.posts\s+SET updated_on = NOW\(\)\s+,', self._update_metadata)
+		self.route(r'SELECT privacy\.type\s+FROM kheina\.public\.posts', self._select_privacy)
+		self.route(r'INSERT INTO kheina\.public\.post_(votes|scores)', lambda sql, params : None)
+		self.route(r'UPDATE kheina\.public\.posts\s+SET created_on = NOW\(\)', self._publish)
+		self.route(r'UPDATE kheina\.public\.posts\s+SET updated_on = NOW\(\),\s+privacy_id', self._update_privacy)
+		self.route(r'SELECT tag_post\.post_id, tags\.tag', self._select_tags)
+		self.route(r'SELECT COUNT\(1\)\s+FROM kheina\.public\.tags', lambda sql, params : (0,))
+		self.route(r'SELECT COUNT\(1\)\s+FROM kheina\.public\.posts', self._count_public)
+		self.route(r'UPDATE kheina\.public\.users\s+SET icon = ', lambda sql, params : self._update_user('icon', params))
+		self.route(r'UPDATE kheina\.public\.users\s+SET banner = ', lambda sql, params : self._update_user('banner', params))
+		self.route(r'SELECT users\.(icon|banner), ', self._select_user_media)
+
+
+	def add_post(self: 'FakeDatabase', post_id: int, uploader: int, privacy: str = 'unpublished', **fields: Any) -> None :
+		now: datetime = datetime.now(timezone.utc)
+		self.posts[post_id] = {
+			'post_id': post_id,
+			'uploader': uploader,
+			'privacy': privacy,
+			'filename': None,
+			'title': None,
+			'description': None,
+			'rating': 'explicit',
+			'parent': None,
+			'created_on': now,
+			'updated_on': now,
+			**fields,
+		}
+
+
+	def route(self: 'FakeDatabase', pattern: str, handler: Callable[[str, tuple], Any]) -> None :
+		self._routes.append((re.compile(pattern, re.I | re.S), handler))
+
+
+	def query(self: 'FakeDatabase', sql: str, params: tuple = (), commit: bool = False, fetch_one: bool = False, fetch_all: bool = False) -> Any :
+		params = tuple(p.name if isinstance(p, Enum) else p for p in (params or ()))
+
+		with self._lock :
+			for pattern, handler in self._routes :
+				if pattern.search(sql) :
+					result = handler(sql, params)
+
+					if fetch_one :
+						return result[0] if isinstance(result, list) and result else (result or None)
+
+					if fetch_all :
+						return result if isinstance(result, list) else ([result] if result else [])
+
+					return None
+
+		raise NotImplementedError(f'FakeDatabase has no route for query: {" ".join(sql.split())[:200]}')
+
+
+	def _owned(self: 'FakeDatabase', post_id: int, uploader: int) -> Optional[Dict[str, Any]] :
+		post = self.posts.get(post_id)
+
+		if not post or post['uploader'] != uploader :
+			return None
+
+		return post
+
+
+	def _post_exists(self: 'FakeDatabase', sql: str, params: tuple) -> tuple :
+		return (int(params[0] in self.posts),)
+
+
+	def _select_unpublished(self: 'FakeDatabase', sql: str, params: tuple) -> Optional[tuple] :
+		for post in self.posts.values() :
+			if post['uploader'] == params[0] and post['privacy'] == 'unpublished' :
+				return (post['post_id'],)
+
+		return None
+
+
+	def _create_unpublished(self: 'FakeDatabase', sql: str, params: tuple) -> None :
+		post_id, uploader = params
+
+		if not self._select_unpublished(sql, (uploader,)) :
+			self.add_post(post_id, uploader)
+
+
+	def _create_draft(self: 'FakeDatabase', sql: str, params: tuple) -> tuple :
+		columns: List[str] = [c.strip() for c in re.search(r'\(privacy_id, ([^)]*)\)', sql).group(1).split(',')]
+		fields: Dict[str, Any] = dict(zip(columns, params))
+		post_id: int = fields.pop('post_id')
+		uploader: int = fields.pop('uploader')
+		self.add_post(post_id, uploader, 'draft', **fields)
+		post = self.posts[post_id]
+		return (post['created_on'], post['updated_on'])
+
+
+	def _select_filename(self: 'FakeDatabase', sql: str, params: tuple) -> Optional[tuple] :
+		post = self._owned(*params)
+		return (post['filename'],) if post else None
+
+
+	def _select_media(self: 'FakeDatabase', sql: str, params: tuple) -> Optional[tuple] :
+		post = self.posts.get(params[0])
+		return (post['filename'], post.get('media_version')) if post else None
+
+
+	def _select_collected_media(self: 'FakeDatabase', sql: str, params: tuple) -> Optional[tuple] :
+		post = self.posts.get(params[0])
+		return (post['filename'], post.get('media_version'), post.get('thumbnail_sizes')) if post else None
+
+
+	def _update_media(self: 'FakeDatabase', sql: str, params: tuple) -> Optional[tuple] :
+		content_type, filename, width, height, thumbhash, thumbnail_sizes, media_version, derivatives_version, post_id, uploader = params[:10]
+		post = self._owned(post_id, uploader)
+
+		if not post :
+			return None
+
+		post.update(
+			media_type=content_type,
+			filename=filename,
+			width=width,
+			height=height,
+			thumbhash=thumbhash,
+			thumbnail_sizes=thumbnail_sizes,
+			media_version=media_version,
+			derivatives_version=derivatives_version,
+			updated_on=datetime.now(timezone.utc),
+		)
+		return (post['updated_on'],)
+
+
+	def _update_metadata(self: 'FakeDatabase', sql: str, params: tuple) -> Optional[tuple] :
+		columns: List[str] = re.findall(r'(\w+) = (?:rating_to_id\()?%s', sql.split('WHERE')[0])
+		post = self._owned(params[-1], params[-2])
+
+		if not post :
+			return None
+
+		post.update(zip(columns, params), updated_on=datetime.now(timezone.utc))
+		return (post['created_on'], post['updated_on'])
+
+
+	def _select_privacy(self: 'FakeDatabase', sql: str, params: tuple) -> Optional[tuple] :
+		uploader, post_id = params
+		post = self._owned(post_id, uploader)
+		return (post['privacy'],) if post else None
+
+
+	def _publish(self: 'FakeDatabase', sql: str, params: tuple) -> None :
+		privacy, uploader, post_id = params
+		post = self._owned(post_id, uploader)
+
+		if post :
+			now: datetime = datetime.now(timezone.utc)
+			post.update(privacy=privacy, created_on=now, updated_on=now)
+
+
+	def _update_privacy(self: 'FakeDatabase', sql: str, params: tuple) -> None :
+		privacy, uploader, post_id = params
+		post = self._owned(post_id, uploader)
+
+		if post :
+			post.update(privacy=privacy, updated_on=datetime.now(timezone.utc))
+
+
+	def _select_tags(self: 'FakeDatabase', sql: str, params: tuple) -> List[tuple] :
+		return [(post_id, tag) for post_id in params[0] for tag in ('load_test', f'tag_{post_id % 50}')]
+
+
+	def _count_public(self: 'FakeDatabase', sql: str, params: tuple) -> tuple :
+		return (sum(post['privacy'] == 'public' for post in self.posts.values()),)
+
+
+	def _update_user(self: 'FakeDatabase', column: str, params: tuple) -> None :
+		post_id, version, user_id = params
+		self.users.setdefault(user_id, { }).update({ column: post_id, f'{column}_version': version })
+
+
+	def _select_user_media(self: 'FakeDatabase', sql: str, params: tuple) -> Optional[tuple] :
+		column: str = re.search(r'SELECT users\.(\w+),', sql).group(1)
+		user: Optional[Dict[str, Any]] = self.users.get(params[0])
+		return (user[column], user[f'{column}_version']) if user and column in user else None
+
+
+class FakeTransaction :
+
+	def __init__(self: 'FakeTransaction', database: FakeDatabase) -> None :
+		self._database: FakeDatabase = database
+
+
+	def __enter__(self: 'FakeTransaction') -> 'FakeTransaction' :
+		return self
+
+
+	def __exit__(self: 'FakeTransaction', exc_type, exc, tb) -> None :
+		pass
+
+
+	def commit(self: 'FakeTransaction') -> None :
+		pass
+
+
+	def query(self: 'FakeTransaction', sql: str, params: tuple = (), commit: bool = False, fetch_one: bool = False, fetch_all: bool = False) -> Any :
+		return self._database.query(sql, params, fetch_one=fetch_one, fetch_all=fetch_all)
+
+
+	async def query_async(self: 'FakeTransaction', sql: str, params: tuple = (), commit: bool = False, fetch_one: bool = False, fetch_all: bool = False) -> Any :
+		return self._database.query(sql, params, fetch_one=fetch_one, fetch_all=fetch_all)
+
+
+class FakeAsyncTransaction(FakeTransaction) :
+
+	def __init__(self: 'FakeAsyncTransaction', database: FakeDatabase, convert: Callable[[tuple], tuple]) -> None :
+		FakeTransaction.__init__(self, database)
+		self._convert: Callable[[tuple], tuple] = convert
+
+
+	async def __aenter__(self: 'FakeAsyncTransaction') -> 'FakeAsyncTransaction' :
+		return self
+
+
+	async def __aexit__(self: 'FakeAsyncTransaction', exc_type, exc, tb) -> None :
+		pass
+
+
+	async def query(self: 'FakeAsyncTransaction', sql: str, params: tuple = (), fetch_one: bool = False, fetch_all: bool = False) -> Any :
+		return self._database.query(sql, self._convert(params), fetch_one=fetch_one, fetch_all=fetch_all)
+
+
+	async def commit(self: 'FakeAsyncTransaction') -> None :
+		pass
+
+
+MimeTypes: Dict[str, str] = {
+	'jpeg': 'image/jpeg',
+	'jpg': 'image/jpeg',
+	'png': 'image/png',
+	'webp': 'image/webp',
+	'gif': 'image/gif',
+}
+
+
+def fake_uploader(root: str, database: Optional[FakeDatabase] = None) :
+	"""
+	builds an Uploader without running the SqlInterface or B2Interface constructors, which would
+	connect to postgres and authorize with backblaze, and wires its storage calls to the fakes above.
+	"""
+	install()
+	from cleanup import B2Cleanup
+	from emoji import Emojis
+	from hot_refresh import HotRefresh
+	from imaging import ImageProcessor
+	from scratch import ScratchSpace
+	from async_sql import AsyncSqlInterface
+	from psycopg2 import Binary
+	from uploader import SqlConversions, Uploader
+	from versioning import VersionedMedia
+
+	database = database or FakeDatabase()
+	b2: FakeB2 = FakeB2(root)
+
+	uploader: Uploader = Uploader.__new__(Uploader)
+	ImageProcessor.__init__(uploader)
+	B2Cleanup.__init__(uploader)
+	# replaced media is collected right away, rather than leaving collections sleeping past the end of a run
+	VersionedMedia.__init__(uploader, gc_delay=0)
+	HotRefresh.__init__(uploader)
+	Emojis.__init__(uploader)
+	uploader.scratch = ScratchSpace(path.join(root, 'scratch'))
+	uploader.logger = getLogger('bench')
+	uploader.mime_types = dict(MimeTypes)
+	# SqlInterface's own map, so anything that sends its conversions through the async pool fails here too
+	uploader._conversions = { tuple: list, bytes: Binary, **SqlConversions }
+	AsyncSqlInterface.__init__(uploader, conversions=SqlConversions)
+	uploader.database = database
+	uploader.b2 = b2
+
+	uploader.transaction = lambda : FakeTransaction(database)
+	uploader.query = database.query
+
+	async def query_async(sql: str, params: tuple = (), commit: bool = False, fetch_one: bool = False, fetch_all: bool = False) -> Any :
+		return database.query(sql, params, fetch_one=fetch_one, fetch_all=fetch_all)
+
+	uploader.query_async = query_async
+	def async_params(params: tuple) -> tuple :
+		# converted like AsyncSqlInterface._execute does, and rejected where asyncpg would reject them
+		params = tuple(map(uploader._convert_async_item, params or ()))
+
+		for param in params :
+			if isinstance(param, Binary) :
+				raise TypeError('asyncpg cannot encode psycopg2.Binary, pass bytes instead.')
+
+		return params
+
+	uploader.async_transaction = lambda : FakeAsyncTransaction(database, async_params)
+
+	async def async_query(sql: str, params: tuple = (), fetch_one: bool = False, fetch_all: bool = False) -> Any :
+		return database.query(sql, async_params(params), fetch_one=fetch_one, fetch_all=fetch_all)
+
+	async def close_pool() -> None :
+		pass
+
+	uploader.async_query = async_query
+	uploader.close_pool = close_pool
+	uploader.b2_upload = b2.b2_upload
+	uploader.b2_upload_immutable = b2.b2_upload_immutable
+	uploader.b2_delete_file = b2.b2_delete_file
+	uploader.b2_delete_file_async = b2.b2_delete_file_async
+	uploader.b2_list_versions = b2.b2_list_versions
+	uploader._b2_delete_version = b2._b2_delete_version
+	uploader._get_mime_from_filename = lambda filename : MimeTypes.get(filename[filename.rfind('.') + 1:])
+	uploader.close = lambda : None
+
+	return uploader
+
+
+class FakeInternalClient :
+	"""
+	answers the fuzzly InternalClient calls the uploader makes from the fake database.
+	"""
+
+	def __init__(self: 'FakeInternalClient', database: FakeDatabase) -> None :
+		self._database: FakeDatabase = database
+
+
+	async def user(self: 'FakeInternalClient', user_id: int) :
+		from fuzzly.models.internal import InternalUser
+
+		user: Dict[str, Any] = self._database.users.get(user_id, { })
+		return InternalUser.construct(
+			user_id=user_id,
+			name=f'user {user_id}',
+			handle=f'user{user_id}',
+			icon=user.get('icon'),
+			banner=user.get('banner'),
+		)
+
+
+	async def post(self: 'FakeInternalClient', post_id) :
+		from fuzzly.models.internal import InternalPost
+		from fuzzly.models.post import PostId
+
+		post: Dict[str, Any] = self._database.posts[PostId(post_id).int()]
+		return InternalPost.construct(
+			post_id=post['post_id'],
+			user_id=post['uploader'],
+			filename=post['filename'],
+		)
+
+
+class FakeResponse :
+
+	def __init__(self: 'FakeResponse', data: bytes) -> None :
+		self._data: bytes = data
+
+
+	async def __aenter__(self: 'FakeResponse') -> 'FakeResponse' :
+		return self
+
+
+	async def __aexit__(self: 'FakeResponse', exc_type, exc, tb) -> None :
+		pass
+
+
+	async def read(self: 'FakeResponse') -> bytes :
+		return self._data
+
+
+def fake_cdn(b2: FakeB2) -> Callable[..., FakeResponse] :
+	"""
+	a stand-in for aiohttp.request that serves cdn urls from the files written to the given FakeB2.
+	"""
+	from urllib.parse import unquote, urlparse
+
+	def request(method: str, url: str, **kwargs: Any) -> FakeResponse :
+		with open(b2._path(unquote(urlparse(url).path)), 'rb') as file :
+			return FakeResponse(file.read())
+
+	return request
@@ -0,0 +1,360 @@
+"""
+replays a mix of uploader traffic against server.app, booted in process under uvicorn with every
+external service replaced by the fakes in bench.fakes.
+
+	python3 -m bench.loadtest --rps 20 --duration 60
+	python3 -m bench.loadtest --mix create_post=1,update_post=4,update_privacy=2 --json results.json
+
+requests arrive open loop (poisson, seeded), so a slow server builds a backlog instead of lowering
+the offered load. the client shares the event loop with the server, so reported event loop lag is
+the lag the server itself would see plus a small, constant client overhead.
+"""
+from argparse import ArgumentParser, Namespace
+from asyncio import Task, create_task, gather, run, sleep
+from bisect import bisect_left
+from collections import defaultdict
+from contextvars import ContextVar
+from json import dump
+from os import environ
+from random import Random
+from shutil import which
+from sys import exit
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiohttp import ClientSession, FormData, TCPConnector
+
+from bench import corpus, fakes
+
+
+Buckets: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+Endpoints: Tuple[str, ...] = ('create_post', 'upload_image', 'update_post', 'update_privacy', 'set_icon')
+DefaultMix: str = 'create_post=2,upload_image=1,update_post=4,update_privacy=2,set_icon=1'
+current_user: ContextVar[Optional[int]] = ContextVar('current_user', default=None)
+
+
+def _percentile(values: List[float], p: float) -> float :
+	if not values :
+		return 0
+
+	ordered: List[float] = sorted(values)
+	return ordered[min(int(len(ordered) * p), len(ordered) - 1)]
+
+
+class Recorder :
+
+	def __init__(self: 'Recorder') -> None :
+		self.latencies: Dict[str, List[float]] = defaultdict(list)
+		self.statuses: Dict[str, Dict[int, int]] = defaultdict(lambda : defaultdict(int))
+		self.lag: List[float] = []
+
+
+	def record(self: 'Recorder', endpoint: str, status: int, latency: float) -> None :
+		self.latencies[endpoint].append(latency)
+		self.statuses[endpoint][status] += 1
+
+
+	def summary(self: 'Recorder', duration: float) -> Dict[str, Any] :
+		endpoints: Dict[str, Any] = { }
+
+		for endpoint, latencies in self.latencies.items() :
+			histogram: List[int] = [0] * (len(Buckets) + 1)
+
+			for latency in latencies :
+				histogram[bisect_left(Buckets, latency)] += 1
+
+			endpoints[endpoint] = {
+				'count': len(latencies),
+				'statuses': dict(self.statuses[endpoint]),
+				'p50': _percentile(latencies, 0.5),
+				'p90': _percentile(latencies, 0.9),
+				'p99': _percentile(latencies, 0.99),
+				'max': max(latencies),
+				'histogram': dict(zip([str(b) for b in Buckets] + ['+Inf'], histogram)),
+			}
+
+		return {
+			'duration': duration,
+			'achieved_rps': sum(len(v) for v in self.latencies.values()) / duration,
+			'endpoints': endpoints,
+			'event_loop_lag': {
+				'p50': _percentile(self.lag, 0.5),
+				'p99': _percentile(self.lag, 0.99),
+				'max': max(self.lag, default=0),
+			},
+		}
+
+
+class Harness :
+	"""
+	owns the fakes, the booted app and the per user state the traffic generators draw from.
+	"""
+
+	def __init__(self: 'Harness', root: str, users: int, posts_per_user: int, seed: int) -> None :
+		self.random: Random = Random(seed)
+		self.database: fakes.FakeDatabase = fakes.FakeDatabase()
+		self.uploader = fakes.fake_uploader(root, self.database)
+		self.images: List[Tuple[corpus.ImageSpec, bytes]] = [
+			(spec, corpus.generate(spec))
+			for spec in corpus.Corpus
+			if spec.name in { 'small_png', 'photo_jpeg', 'small_gif' }
+		]
+		self.users: List[int] = list(range(1, users + 1))
+		self._next_post: int = 1_000_000
+		self.app = self._boot()
+
+		for user_id in self.users :
+			for _ in range(posts_per_user) :
+				self._seed_post(user_id)
+
+
+	def _boot(self: 'Harness') :
+		import uploader as uploader_module
+		from kh_common.auth import KhUser
+
+		uploader_module.Uploader = lambda : self.uploader
+		uploader_module.client = fakes.FakeInternalClient(self.database)
+		uploader_module.request = fakes.fake_cdn(self.uploader.b2)
+
+		async def authenticated(user: KhUser, raise_error: bool = True) -> bool :
+			user.user_id = current_user.get()
+			return True
+
+		KhUser.authenticated = authenticated
+
+		# the fuzzly internal client is replaced above, so warming it up would only log in for nothing
+		environ.setdefault('UPLOADER_WARM_UP', 'uploader,wand,aerospike,scoring')
+		# the fake database doesn't answer the refresh's queries, and a run would skew the measured latencies
+		environ.setdefault('UPLOADER_HOT_REFRESH_INTERVAL', '0')
+
+		from server import app
+
+		async def with_user(scope: Dict[str, Any], receive: Callable, send: Callable) -> None :
+			# the load test authenticates by header instead of by token
+			if scope['type'] == 'http' :
+				user: Optional[bytes] = dict(scope['headers']).get(b'x-load-test-user')
+				if user :
+					current_user.set(int(user))
+
+			await app(scope, receive, send)
+
+		return with_user
+
+
+	def _seed_post(self: 'Harness', user_id: int) -> int :
+		self._next_post += 1
+		spec, data = self.random.choice(self.images)
+		self.uploader.b2.b2_upload(data, f'{self._post_id(self._next_post)}/{corpus.filename(spec)}')
+		self.database.add_post(
+			self._next_post,
+			user_id,
+			'public',
+			filename=corpus.filename(spec),
+			width=spec.width,
+			height=spec.height,
+		)
+		return self._next_post
+
+
+	def _post_id(self: 'Harness', post_id: int) -> str :
+		from fuzzly.models.post import PostId
+		return str(PostId(post_id))
+
+
+	def _user_post(self: 'Harness', user_id: int, uploaded: bool = False) -> Optional[Dict[str, Any]] :
+		posts: List[Dict[str, Any]] = [
+			post for post in self.database.posts.values()
+			if post['uploader'] == user_id and (post['filename'] or not uploaded)
+		]
+		return self.random.choice(posts) if posts else None
+
+
+	async def create_post(self: 'Harness', session: ClientSession, user_id: int) -> int :
+		body: Dict[str, Any] = { }
+
+		if self.random.random() < 0.5 :
+			body = { 'title': 'load test', 'rating': 'general' }
+
+		async with session.post('/v1/create_post', json=body, headers={ 'x-load-test-user': str(user_id) }) as response :
+			await response.read()
+			return response.status
+
+
+	async def upload_image(self: 'Harness', session: ClientSession, user_id: int) -> int :
+		post: Dict[str, Any] = self._user_post(user_id)
+		spec, data = self.random.choice(self.images)
+		form: FormData = FormData()
+		form.add_field('post_id', self._post_id(post['post_id']))
+		form.add_field('file', data, filename=corpus.filename(spec), content_type=f'image/{spec.format}')
+
+		async with session.post('/v1/upload_image', data=form, headers={ 'x-load-test-user': str(user_id) }) as response :
+			await response.read()
+			return response.status
+
+
+	async def update_post(self: 'Harness', session: ClientSession, user_id: int) -> int :
+		post: Dict[str, Any] = self._user_post(user_id)
+		body: Dict[str, Any] = {
+			'post_id': self._post_id(post['post_id']),
+			'title': f'title {self.random.getrandbits(16)}',
+			'description': 'updated by the load test',
+		}
+
+		async with session.post('/v1/update_post', json=body, headers={ 'x-load-test-user': str(user_id) }) as response :
+			await response.read()
+			return response.status
+
+
+	async def update_privacy(self: 'Harness', session: ClientSession, user_id: int) -> int :
+		post: Dict[str, Any] = self._user_post(user_id)
+		body: Dict[str, Any] = {
+			'post_id': self._post_id(post['post_id']),
+			'privacy': 'private' if post['privacy'] == 'public' else 'public',
+		}
+
+		async with session.post('/v1/update_privacy', json=body, headers={ 'x-load-test-user': str(user_id) }) as response :
+			await response.read()
+			return response.status
+
+
+	async def set_icon(self: 'Harness', session: ClientSession, user_id: int) -> int :
+		post: Dict[str, Any] = self._user_post(user_id, uploaded=True)
+		side: int = min(post['width'], post['height'])
+		body: Dict[str, Any] = {
+			'post_id': self._post_id(post['post_id']),
+			'coordinates': { 'top': 0, 'left': 0, 'width': side, 'height': side },
+		}
+
+		async with session.post('/v1/set_icon', json=body, headers={ 'x-load-test-user': str(user_id) }) as response :
+			await response.read()
+			return response.status
+
+
+async def _monitor_lag(recorder: Recorder, interval: float, until: float) -> None :
+	while perf_counter() < until :
+		start: float = perf_counter()
+		await sleep(interval)
+		recorder.lag.append(max(perf_counter() - start - interval, 0))
+
+
+async def _send(recorder: Recorder, endpoint: str, call: Awaitable[int]) -> None :
+	start: float = perf_counter()
+
+	try :
+		status: int = await call
+
+	except Exception :
+		status = 0
+
+	recorder.record(endpoint, status, perf_counter() - start)
+
+
+async def load_test(args: Namespace, mix: Dict[str, float]) -> Dict[str, Any] :
+	from uvicorn import Config, Server
+
+	with TemporaryDirectory() as root :
+		harness: Harness = Harness(root, args.users, args.posts, args.seed)
+		server: Server = Server(Config(harness.app, host='127.0.0.1', port=args.port, log_level='warning'))
+		serving: Task = create_task(server.serve())
+
+		while not server.started :
+			await sleep(0.01)
+
+		recorder: Recorder = Recorder()
+		endpoints: List[str] = list(mix)
+		weights: List[float] = list(mix.values())
+		pending: List[Task] = []
+
+		async with ClientSession(f'http://127.0.0.1:{args.port}', connector=TCPConnector(limit=args.connections)) as session :
+			start: float = perf_counter()
+			until: float = start + args.duration
+			monitor: Task = create_task(_monitor_lag(recorder, 0.05, until))
+			scheduled: float = start
+
+			while True :
+				scheduled += harness.random.expovariate(args.rps)
+
+				if scheduled >= until :
+					break
+
+				await sleep(max(scheduled - perf_counter(), 0))
+				endpoint: str = harness.random.choices(endpoints, weights)[0]
+				user_id: int = harness.random.choice(harness.users)
+				pending.append(create_task(_send(recorder, endpoint, getattr(harness, endpoint)(session, user_id))))
+
+			await gather(monitor, *pending)
+			elapsed: float = perf_counter() - start
+
+		server.should_exit = True
+		await serving
+
+	return recorder.summary(elapsed)
+
+
+def _parse_mix(mix: str) -> Dict[str, float] :
+	weights: Dict[str, float] = { }
+
+	for item in filter(None, mix.split(',')) :
+		endpoint, weight = item.split('=')
+		endpoint = endpoint.strip()
+
+		if endpoint not in Endpoints :
+			raise ValueError(f'unknown endpoint in mix: {endpoint}, expected one of {", ".join(Endpoints)}')
+
+		weights[endpoint] = float(weight)
+
+	return weights
+
+
+def _print(summary: Dict[str, Any]) -> None :
+	print(f'achieved {summary["achieved_rps"]:.1f} rps over {summary["duration"]:.1f}s')
+	print(f'{"endpoint":<16} {"count":>7} {"p50 ms":>9} {"p90 ms":>9} {"p99 ms":>9} {"max ms":>9}  statuses')
+
+	for endpoint, result in summary['endpoints'].items() :
+		print(
+			f'{endpoint:<16} {result["count"]:>7} {result["p50"] * 1000:>9.1f} {result["p90"] * 1000:>9.1f} '
+			f'{result["p99"] * 1000:>9.1f} {result["max"] * 1000:>9.1f}  {result["statuses"]}'
+		)
+
+	for endpoint, result in summary['endpoints'].items() :
+		print(f'\n{endpoint} latency histogram (le seconds: count)')
+		for bucket, count in result['histogram'].items() :
+			print(f'  {bucket:>6}: {count}')
+
+	lag: Dict[str, float] = summary['event_loop_lag']
+	print(f'\nevent loop lag: p50 {lag["p50"] * 1000:.1f}ms, p99 {lag["p99"] * 1000:.1f}ms, max {lag["max"] * 1000:.1f}ms')
+
+
+def main() -> int :
+	parser: ArgumentParser = ArgumentParser(description='replays uploader traffic against an in process server backed by local fakes.')
+	parser.add_argument('--rps', type=float, default=10, help='target requests per second.')
+	parser.add_argument('--duration', type=float, default=30, help='seconds to generate load for.')
+	parser.add_argument('--mix', default=DefaultMix, help='comma separated endpoint=weight pairs.')
+	parser.add_argument('--users', type=int, default=20)
+	parser.add_argument('--posts', type=int, default=5, help='posts seeded per user.')
+	parser.add_argument('--connections', type=int, default=100, help='maximum concurrent client connections.')
+	parser.add_argument('--port', type=int, default=5099)
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--json', help='also write the summary to this file.')
+	args: Namespace = parser.parse_args()
+
+	mix: Dict[str, float] = _parse_mix(args.mix)
+
+	if 'upload_image' in mix and not (which('exiftool') and which('thumbhash')) :
+		print('exiftool and thumbhash are required for upload_image, removing it from the mix.')
+		del mix['upload_image']
+
+	fakes.install()
+	summary: Dict[str, Any] = run(load_test(args, mix))
+	_print(summary)
+
+	if args.json :
+		with open(args.json, 'w') as file :
+			dump(summary, file, indent='\t')
+
+	return 0
+
+
+if __name__ == '__main__' :
+	exit(main())
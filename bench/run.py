@@ -0,0 +1,393 @@
+"""
+benchmarks the image pipeline, icon/banner cropping and scoring against the generated corpus, and
+the cached post and user encodings.
+
+	python3 -m bench.run                             # run everything, print a report
+	python3 -m bench.run -k upload -n 5              # only scenarios containing "upload", 5 iterations each
+	python3 -m bench.run --save bench/baseline.json  # store the results as a baseline
+	python3 -m bench.run --compare bench/baseline.json --tolerance 0.15
+
+each scenario runs in a fresh process so that peak rss is attributable to it alone. postgres, b2
+and aerospike are replaced by the fakes in bench.fakes; exiftool and thumbhash must be installed for
+the upload scenarios, which are skipped otherwise.
+"""
+from argparse import ArgumentParser, Namespace
+from asyncio import new_event_loop
+from json import dump, load
+from multiprocessing import get_context
+from platform import platform, python_version
+from resource import RUSAGE_SELF, getrusage
+from shutil import which
+from statistics import mean
+from sys import exit
+from sys import platform as os_name
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from bench import corpus, fakes
+
+
+Result = Dict[str, Any]
+_rss_scale: int = 1 if os_name == 'darwin' else 1024
+
+
+def _peak_rss() -> int :
+	return getrusage(RUSAGE_SELF).ru_maxrss * _rss_scale
+
+
+def _percentile(values: List[float], p: float) -> float :
+	ordered: List[float] = sorted(values)
+	index: float = (len(ordered) - 1) * p
+	low: int = int(index)
+	high: int = min(low + 1, len(ordered) - 1)
+	return ordered[low] + (ordered[high] - ordered[low]) * (index - low)
+
+
+def _measure(run: Callable[[], Any], iterations: int, warmup: int) -> Result :
+	for _ in range(warmup) :
+		run()
+
+	rss_start: int = _peak_rss()
+	latencies: List[float] = []
+	start: float = perf_counter()
+
+	for _ in range(iterations) :
+		iteration_start: float = perf_counter()
+		run()
+		latencies.append(perf_counter() - iteration_start)
+
+	elapsed: float = perf_counter() - start
+
+	return {
+		'iterations': iterations,
+		'throughput': iterations / elapsed,
+		'mean': mean(latencies),
+		'p50': _percentile(latencies, 0.5),
+		'p90': _percentile(latencies, 0.9),
+		'p99': _percentile(latencies, 0.99),
+		'max': max(latencies),
+		'peak_rss': _peak_rss(),
+		'peak_rss_growth': _peak_rss() - rss_start,
+	}
+
+
+def _upload_scenario(spec: corpus.ImageSpec, data: bytes, web_resize: int) -> Callable[[], Any] :
+	from fuzzly.models.post import PostId
+
+	scratch: TemporaryDirectory = TemporaryDirectory()
+	uploader = fakes.fake_uploader(scratch.name)
+	user: SimpleNamespace = SimpleNamespace(user_id=1)
+	loop = new_event_loop()
+	post_ids: List[int] = [0]
+
+	def run() -> None :
+		post_ids[0] += 1
+		uploader.database.add_post(post_ids[0], user.user_id)
+		loop.run_until_complete(uploader.uploadImage(
+			user=user,
+			file_data=data,
+			filename=corpus.filename(spec),
+			post_id=PostId(post_ids[0]),
+			web_resize=web_resize,
+		))
+
+	run.scratch = scratch  # keeps the directory alive for as long as the scenario
+	return run
+
+
+def _thumbnail_scenario(spec: corpus.ImageSpec, data: bytes) -> Callable[[], Any] :
+	from imaging import ImageProcessor
+	from wand.image import Image
+
+	processor: ImageProcessor = ImageProcessor()
+
+	def run() -> None :
+		with Image(blob=data) as image :
+			frame: Image = processor.first_frame(image)
+
+			if processor.is_animated(image) :
+				processor.animated_preview_data(image)
+
+		with frame :
+			for _ in processor.render_thumbnails(frame, processor.plan_sizes(frame.size)) :
+				pass
+
+	return run
+
+
+def _crop_scenario(spec: corpus.ImageSpec, data: bytes, kind: str) -> Callable[[], Any] :
+	from imaging import ImageProcessor
+	from models import Coordinates
+	from wand.image import Image
+
+	processor: ImageProcessor = ImageProcessor()
+
+	if kind == 'icon' :
+		side: int = min(spec.width, spec.height)
+		coordinates: Coordinates = Coordinates(top=0, left=0, width=side, height=side)
+		crop: Callable = processor.crop_icon
+
+	else :
+		width: int = min(spec.width, spec.height * 3)
+		coordinates: Coordinates = Coordinates(top=0, left=0, width=width, height=round(width / 3))
+		crop: Callable = processor.crop_banner
+
+	def run() -> None :
+		with Image(blob=data) as image :
+			crop(image, coordinates)
+			processor.get_image_data(image)
+
+			with image.convert('jpeg') as jpeg :
+				processor.get_image_data(jpeg)
+
+	return run
+
+
+def _scoring_scenario() -> Callable[[], Any] :
+	from scoring import best, confidence, controversial, hot
+
+	votes: List[Tuple[int, int]] = [(up, down) for up in range(0, 1000, 10) for down in range(0, 1000, 10)]
+	created: float = 1_700_000_000.0
+
+	def run() -> None :
+		for up, down in votes :
+			hot(up, down, created)
+			controversial(up, down)
+			confidence(up, up + down)
+			best(up, up + down)
+
+	return run
+
+
+def _cached_models() -> Dict[str, Any] :
+	from datetime import datetime, timezone
+
+	from fuzzly.models.internal import InternalPost, InternalUser
+	from fuzzly.models.post import MediaType, PostId, PostSize, Privacy, Rating
+	from fuzzly.models.user import Badge, UserPrivacy
+
+	now: datetime = datetime.now(timezone.utc)
+	return {
+		'post': InternalPost(
+			post_id=PostId('abcd1234').int(),
+			title='a fairly typical title for a post',
+			description='a description a few sentences long, which is about as long as most of them get. ' * 3,
+			user_id=1234567,
+			rating=Rating.general,
+			parent=None,
+			privacy=Privacy.public,
+			created=now,
+			updated=now,
+			filename='some_image-web.png',
+			media_type=MediaType(file_type='png', mime_type='image/png'),
+			size=PostSize(width=1500, height=1000),
+		),
+		'user': InternalUser(
+			user_id=1234567,
+			name='a display name',
+			handle='handle',
+			privacy=UserPrivacy.public,
+			icon=PostId('abcd1234'),
+			banner=None,
+			website='https://example.com',
+			created=now,
+			description='a short bio.',
+			verified=None,
+			badges=[Badge(emoji='sparkles', label='supporter')],
+		),
+	}
+
+
+def _cache_scenario(kind: str, encoding: str, rounds: int = 1000) -> Callable[[], Any] :
+	"""
+	a round trip through the cache encoding, repeated rounds times. pickle is what the aerospike client
+	does with models on its own. the edit scenarios apply updatePostMetadata's changes to a cached post.
+	"""
+	from pickle import dumps, loads
+
+	from cache_codec import PostCodec, UserCodec
+	from fuzzly.models.internal import InternalPost
+	from fuzzly.models.post import Rating
+
+	model: Any = _cached_models()[kind]
+	codec = PostCodec if kind == 'post' else UserCodec
+	changes: Dict[str, Any] = { 'title': 'a new title', 'rating': Rating.mature, 'updated': model.created }
+	stored: bytes
+
+	if encoding == 'pickle' :
+		stored = dumps(model)
+
+		def run() -> None :
+			for _ in range(rounds) :
+				loads(dumps(model))
+
+	elif encoding == 'codec' :
+		stored = codec.encode(model)
+
+		def run() -> None :
+			for _ in range(rounds) :
+				codec.decode(codec.encode(model))
+
+	elif encoding == 'edit.parse_obj' :
+		stored = dumps(model)
+
+		def run() -> None :
+			for _ in range(rounds) :
+				dumps(InternalPost.parse_obj({ **loads(stored).dict(), **changes }))
+
+	else :
+		stored = codec.encode(model)
+
+		def run() -> None :
+			for _ in range(rounds) :
+				codec.patch(stored, changes)
+
+	run.stored_bytes = len(stored)
+	return run
+
+
+def scenarios(available: Dict[str, bool]) -> Dict[str, Callable[[corpus.ImageSpec, bytes], Callable[[], Any]]] :
+	"""
+	maps scenario names to factories. image scenarios are expanded once per corpus image.
+	"""
+	image: Dict[str, Callable] = {
+		'thumbnails': _thumbnail_scenario,
+		'icon': lambda spec, data : _crop_scenario(spec, data, 'icon'),
+		'banner': lambda spec, data : _crop_scenario(spec, data, 'banner'),
+	}
+
+	if available['exiftool'] and available['thumbhash'] :
+		image['upload'] = lambda spec, data : _upload_scenario(spec, data, 0)
+		image['upload_web'] = lambda spec, data : _upload_scenario(spec, data, 1500)
+
+	named: Dict[str, Callable] = { }
+
+	for kind, factory in image.items() :
+		for spec in corpus.Corpus :
+			named[f'{kind}.{spec.name}'] = (lambda factory, spec : lambda data : factory(spec, data[spec.name]))(factory, spec)
+
+	named['scoring'] = lambda data : _scoring_scenario()
+
+	for kind, encoding in (('post', 'pickle'), ('post', 'codec'), ('user', 'pickle'), ('user', 'codec'), ('post', 'edit.parse_obj'), ('post', 'edit.patch')) :
+		named[f'cache.{kind}.{encoding}'] = (lambda kind, encoding : lambda data : _cache_scenario(kind, encoding))(kind, encoding)
+
+	return named
+
+
+def _run_scenario(name: str, data: Dict[str, bytes], available: Dict[str, bool], iterations: int, warmup: int) -> Result :
+	# runs inside a fresh process
+	fakes.install()
+	run: Callable[[], Any] = scenarios(available)[name](data)
+	result: Result = _measure(run, iterations, warmup)
+
+	if hasattr(run, 'stored_bytes') :
+		result['stored_bytes'] = run.stored_bytes
+
+	return result
+
+
+def compare(baseline: Dict[str, Any], results: Dict[str, Result], tolerance: float) -> List[str] :
+	regressions: List[str] = []
+
+	for name, result in results.items() :
+		previous: Optional[Result] = baseline.get('results', { }).get(name)
+
+		if not previous :
+			continue
+
+		for metric in ('p50', 'p90') :
+			if result[metric] > previous[metric] * (1 + tolerance) :
+				regressions.append(f'{name} {metric}: {previous[metric] * 1000:.1f}ms -> {result[metric] * 1000:.1f}ms')
+
+		if result['peak_rss_growth'] > previous['peak_rss_growth'] * (1 + tolerance) + 2**20 :
+			regressions.append(f'{name} peak_rss_growth: {previous["peak_rss_growth"] / 2**20:.1f}MiB -> {result["peak_rss_growth"] / 2**20:.1f}MiB')
+
+		if result.get('stored_bytes', 0) > previous.get('stored_bytes', float('inf')) :
+			regressions.append(f'{name} stored_bytes: {previous["stored_bytes"]} -> {result["stored_bytes"]}')
+
+	return regressions
+
+
+def report(results: Dict[str, Result]) -> str :
+	lines: List[str] = [f'{"scenario":<28} {"ops/s":>9} {"p50 ms":>9} {"p90 ms":>9} {"p99 ms":>9} {"max ms":>9} {"rss MiB":>9}']
+
+	for name, result in results.items() :
+		lines.append(
+			f'{name:<28} {result["throughput"]:>9.2f} {result["p50"] * 1000:>9.1f} {result["p90"] * 1000:>9.1f} '
+			f'{result["p99"] * 1000:>9.1f} {result["max"] * 1000:>9.1f} {result["peak_rss"] / 2**20:>9.1f}'
+			+ (f' {result["stored_bytes"]:>7} bytes' if 'stored_bytes' in result else '')
+		)
+
+	return '\n'.join(lines)
+
+
+def main() -> int :
+	parser: ArgumentParser = ArgumentParser(description='benchmarks the uploader image pipeline and scoring.')
+	parser.add_argument('-k', '--filter', default='', help='only run scenarios whose name contains this string.')
+	parser.add_argument('-n', '--iterations', type=int, default=10)
+	parser.add_argument('-w', '--warmup', type=int, default=1)
+	parser.add_argument('--save', help='write results to this json file.')
+	parser.add_argument('--compare', help='compare results against this json baseline, exits 1 on regressions.')
+	parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative slowdown before a result counts as a regression.')
+	args: Namespace = parser.parse_args()
+
+	available: Dict[str, bool] = {
+		'exiftool': bool(which('exiftool')),
+		'thumbhash': bool(which('thumbhash')),
+	}
+
+	if not all(available.values()) :
+		print('exiftool and thumbhash are required for the upload scenarios, skipping them.', { k: v for k, v in available.items() if not v })
+
+	images: Dict[corpus.ImageSpec, bytes] = corpus.load()
+	data: Dict[str, bytes] = { spec.name: blob for spec, blob in images.items() }
+	names: List[str] = [name for name in scenarios(available) if args.filter in name]
+	results: Dict[str, Result] = { }
+	context = get_context('spawn')
+
+	for name in names :
+		with context.Pool(1) as pool :
+			results[name] = pool.apply(_run_scenario, (name, data, available, args.iterations, args.warmup))
+
+		print(report({ name: results[name] }).splitlines()[-1], flush=True)
+
+	print()
+	print(report(results))
+
+	output: Dict[str, Any] = {
+		'environment': {
+			'python': python_version(),
+			'platform': platform(),
+		},
+		'corpus': corpus.fingerprint(images),
+		'iterations': args.iterations,
+		'results': results,
+	}
+
+	if args.save :
+		with open(args.save, 'w') as file :
+			dump(output, file, indent='\t', sort_keys=True)
+
+	if args.compare :
+		with open(args.compare) as file :
+			baseline: Dict[str, Any] = load(file)
+
+		if baseline.get('corpus') != output['corpus'] :
+			print('warning: the corpus differs from the baseline corpus, results may not be comparable.')
+
+		regressions: List[str] = compare(baseline, results, args.tolerance)
+
+		if regressions :
+			print('\nregressions:')
+			print('\n'.join(regressions))
+			return 1
+
+		print('\nno regressions against', args.compare)
+
+	return 0
+
+
+if __name__ == '__main__' :
+	exit(main())
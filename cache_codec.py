@@ -0,0 +1,144 @@
+from datetime import datetime, timedelta, timezone
+from enum import Enum
+from os import environ
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple, Type, Union
+
+import msgpack
+from pydantic import BaseModel
+
+from fuzzly.models.internal import InternalPost, InternalUser
+from fuzzly.models.post import MediaType, PostId, PostSize, Privacy, Rating
+from fuzzly.models.user import Badge, UserPrivacy, Verified
+
+
+# cached models are only written packed once every reader of the set can decode them, until then they're written as models
+PackCaches: bool = environ.get('UPLOADER_PACKED_CACHE', '').lower() in { '1', 'true' }
+Epoch: datetime = datetime(1970, 1, 1, tzinfo=timezone.utc)
+Microsecond: timedelta = timedelta(microseconds=1)
+
+
+class Field(NamedTuple) :
+	name: str
+	# neither is called for None, which is always stored as nil
+	encode: Optional[Callable[[Any], Any]] = None
+	decode: Optional[Callable[[Any], Any]] = None
+
+
+def _enum(name: str, cls: Type[Enum]) -> Field :
+	return Field(name, lambda value : cls(value).value, cls)
+
+
+def _datetime(name: str) -> Field :
+	# microseconds since the epoch, so timestamps survive the round trip exactly. naive datetimes are taken to be utc
+	return Field(
+		name,
+		lambda value : ((value if value.tzinfo else value.replace(tzinfo=timezone.utc)) - Epoch) // Microsecond,
+		lambda value : Epoch + value * Microsecond,
+	)
+
+
+def _post_id(name: str) -> Field :
+	return Field(name, lambda value : PostId(value).int(), PostId)
+
+
+class ModelCodec :
+	"""
+	packs a model into a msgpack array of its fields' values, in a fixed order, behind a version number.
+	decoding builds the model with construct, skipping validation, since the data was validated before it was
+	packed. patch rewrites individual fields of a packed record without building the model at all.
+	records packed by another version decode as None, so they're treated as a miss and repopulated.
+	"""
+
+	def __init__(self: 'ModelCodec', model: Type[BaseModel], version: int, fields: Tuple[Field, ...]) -> None :
+		self.model: Type[BaseModel] = model
+		self.version: int = version
+		self.fields: Tuple[Field, ...] = fields
+		# offset by one, the version comes first
+		self._index: Dict[str, int] = { field.name: i + 1 for i, field in enumerate(fields) }
+
+
+	def _encode_value(self: 'ModelCodec', field: Field, value: Any) -> Any :
+		return value if value is None or field.encode is None else field.encode(value)
+
+
+	def _unpack(self: 'ModelCodec', data: bytes) -> Optional[List[Any]] :
+		values: List[Any] = msgpack.unpackb(data)
+
+		if values[0] != self.version or len(values) != len(self.fields) + 1 :
+			return None
+
+		return values
+
+
+	def encode(self: 'ModelCodec', model: BaseModel) -> bytes :
+		return msgpack.packb([self.version, *(self._encode_value(field, getattr(model, field.name, None)) for field in self.fields)])
+
+
+	def decode(self: 'ModelCodec', data: bytes) -> Optional[BaseModel] :
+		values: Optional[List[Any]] = self._unpack(data)
+
+		if values is None :
+			return None
+
+		return self.model.construct(**{
+			field.name: value if value is None or field.decode is None else field.decode(value)
+			for field, value in zip(self.fields, values[1:])
+		})
+
+
+	def patch(self: 'ModelCodec', data: bytes, changes: Dict[str, Any]) -> Optional[bytes] :
+		"""
+		returns data with the given fields replaced, or None if data was packed by another version.
+		"""
+		values: Optional[List[Any]] = self._unpack(data)
+
+		if values is None :
+			return None
+
+		for name, value in changes.items() :
+			index: int = self._index[name]
+			values[index] = self._encode_value(self.fields[index - 1], value)
+
+		return msgpack.packb(values)
+
+
+	def load(self: 'ModelCodec', value: Union[bytes, BaseModel, None]) -> Optional[BaseModel] :
+		"""
+		decodes a cached value, which is either packed or a model written before the codec, or by a service that doesn't use it.
+		"""
+		return self.decode(value) if isinstance(value, bytes) else value
+
+
+	def dump(self: 'ModelCodec', model: BaseModel) -> Union[bytes, BaseModel] :
+		return self.encode(model) if PackCaches else model
+
+
+# fields are only ever appended, along with a version bump
+PostCodec: ModelCodec = ModelCodec(InternalPost, 1, (
+	Field('post_id'),
+	Field('title'),
+	Field('description'),
+	Field('user_id'),
+	_enum('rating', Rating),
+	Field('parent'),
+	_enum('privacy', Privacy),
+	_datetime('created'),
+	_datetime('updated'),
+	Field('filename'),
+	Field('media_type', lambda value : (value.file_type, value.mime_type), lambda value : MediaType.construct(file_type=value[0], mime_type=value[1])),
+	Field('size', lambda value : (value.width, value.height), lambda value : PostSize.construct(width=value[0], height=value[1])),
+))
+
+UserCodec: ModelCodec = ModelCodec(InternalUser, 1, (
+	Field('user_id'),
+	Field('name'),
+	Field('handle'),
+	_enum('privacy', UserPrivacy),
+	_post_id('icon'),
+	_post_id('banner'),
+	Field('website'),
+	_datetime('created'),
+	Field('description'),
+	_enum('verified', Verified),
+	Field('badges', lambda value : [(badge.emoji, badge.label) for badge in value], lambda value : [Badge.construct(emoji=emoji, label=label) for emoji, label in value]),
+))
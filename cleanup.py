@@ -0,0 +1,179 @@
+from asyncio import Semaphore, Task, ensure_future, gather, sleep
+from collections import deque
+from time import time
+from typing import Any, Callable, Deque, Dict, List, NamedTuple, Optional, Set
+
+from aiohttp import ClientTimeout, request
+from metrics import Counter, Gauge, registry
+
+
+B2Deletes: Counter = registry.register(Counter('uploader_b2_deletes_total', 'b2 file version deletes by outcome.', ('result',)))
+B2RetryQueue: Gauge = registry.register(Gauge('uploader_b2_delete_retry_queue', 'file versions waiting for a delete retry.'))
+
+
+class PendingDelete(NamedTuple) :
+	file: Dict[str, str]
+	attempts: int
+	not_before: float
+
+
+class B2Cleanup :
+	"""
+	deletes b2 objects in bulk. every version under a prefix is listed with paginated
+	b2_list_file_versions calls, then deleted concurrently, never more than concurrency at a time.
+	deletes that fail are queued and retried with backoff instead of being dropped. the retry task is started
+	when the first delete is queued and exits once the queue is empty.
+	relies on B2Interface's b2_api_url, b2_auth_token, b2_bucket_id and _b2_authorize.
+	"""
+
+	def __init__(self: 'B2Cleanup', concurrency: int = 8, max_attempts: int = 8, retry_backoff: float = 5, max_retry_backoff: float = 600) -> None :
+		self._cleanup_semaphore: Semaphore = Semaphore(concurrency)
+		self._cleanup_retries: Deque[PendingDelete] = deque()
+		self._cleanup_task: Optional[Task] = None
+		self.cleanup_max_attempts: int = max_attempts
+		self.cleanup_retry_backoff: float = retry_backoff
+		self.cleanup_max_retry_backoff: float = max_retry_backoff
+
+
+	async def _b2_post(self: 'B2Cleanup', endpoint: str, body: Dict[str, Any]) -> Dict[str, Any] :
+		for attempt in range(2) :
+			async with request(
+				'POST',
+				f'{self.b2_api_url}/b2api/v2/{endpoint}',
+				json=body,
+				headers={ 'authorization': self.b2_auth_token },
+				timeout=ClientTimeout(self.b2_timeout),
+			) as response :
+				if response.status == 401 and not attempt :
+					# auth token expired, obtain a new one and try once more
+					self._b2_authorize()
+					continue
+
+				response.raise_for_status()
+				return await response.json()
+
+
+	async def b2_list_versions(self: 'B2Cleanup', prefix: str) -> List[Dict[str, str]] :
+		"""
+		returns every version of every file whose name starts with prefix, ordered by name, newest version first.
+		"""
+		files: List[Dict[str, str]] = []
+		start_name: Optional[str] = None
+		start_id: Optional[str] = None
+
+		while True :
+			body: Dict[str, Any] = {
+				'bucketId': self.b2_bucket_id,
+				'prefix': prefix,
+				'maxFileCount': 1000,
+			}
+
+			if start_name :
+				body['startFileName'] = start_name
+				body['startFileId'] = start_id
+
+			page: Dict[str, Any] = await self._b2_post('b2_list_file_versions', body)
+			files += [{ 'fileName': file['fileName'], 'fileId': file['fileId'] } for file in page['files']]
+			start_name, start_id = page.get('nextFileName'), page.get('nextFileId')
+
+			if not start_name :
+				return files
+
+
+	async def _b2_delete_version(self: 'B2Cleanup', file: Dict[str, str]) -> None :
+		await self._b2_post('b2_delete_file_version', { 'fileName': file['fileName'], 'fileId': file['fileId'] })
+
+
+	async def _delete_or_queue(self: 'B2Cleanup', file: Dict[str, str], attempts: int = 0) -> bool :
+		async with self._cleanup_semaphore :
+			try :
+				await self._b2_delete_version(file)
+				B2Deletes.inc(1, 'deleted')
+				return True
+
+			except Exception as e :
+				attempts += 1
+
+				if attempts >= self.cleanup_max_attempts :
+					B2Deletes.inc(1, 'dropped')
+					self.logger.error(f'giving up deleting b2 file after {attempts} attempts: {file["fileName"]}', exc_info=e)
+					return False
+
+				B2Deletes.inc(1, 'failed')
+				backoff: float = min(self.cleanup_retry_backoff * 2 ** (attempts - 1), self.cleanup_max_retry_backoff)
+				self._cleanup_retries.append(PendingDelete(file, attempts, time() + backoff))
+				B2RetryQueue.set(len(self._cleanup_retries))
+
+				if not self._cleanup_task or self._cleanup_task.done() :
+					self._cleanup_task = ensure_future(self.run_cleanup_retries())
+
+				self.logger.warning(f'failed to delete b2 file, retrying in {backoff}s: {file["fileName"]}', exc_info=e)
+				return False
+
+
+	async def delete_versions(self: 'B2Cleanup', files: List[Dict[str, str]]) -> int :
+		"""
+		deletes the given file versions concurrently, returns how many were deleted now. failures are queued for retry.
+		"""
+		return sum(await gather(*map(self._delete_or_queue, files)))
+
+
+	async def delete_prefix(self: 'B2Cleanup', prefix: str, remove: Optional[Callable[[Dict[str, str], bool], bool]] = None) -> int :
+		"""
+		deletes the versions under prefix for which remove(file, superseded) is true, or all of them if remove is not given.
+		superseded is true for every version of a file except its newest one.
+		"""
+		files: List[Dict[str, str]] = await self.b2_list_versions(prefix)
+		seen: Set[str] = set()
+		doomed: List[Dict[str, str]] = []
+
+		for file in files :
+			superseded: bool = file['fileName'] in seen
+			seen.add(file['fileName'])
+
+			if remove is None or remove(file, superseded) :
+				doomed.append(file)
+
+		return await self.delete_versions(doomed)
+
+
+	async def cleanup_prefix(self: 'B2Cleanup', prefix: str, remove: Optional[Callable[[Dict[str, str], bool], bool]] = None) -> None :
+		"""
+		delete_prefix for background tasks, listing failures are logged rather than raised.
+		"""
+		try :
+			await self.delete_prefix(prefix, remove)
+
+		except Exception as e :
+			B2Deletes.inc(1, 'list_failed')
+			self.logger.error(f'failed to list b2 files for cleanup: {prefix}', exc_info=e)
+
+
+	async def run_cleanup_retries(self: 'B2Cleanup', interval: float = 5) -> None :
+		"""
+		retries queued deletes once they are due, until none are left.
+		"""
+		while self._cleanup_retries :
+			await sleep(interval)
+			now: float = time()
+			due: List[PendingDelete] = []
+
+			for _ in range(len(self._cleanup_retries)) :
+				pending: PendingDelete = self._cleanup_retries.popleft()
+
+				if pending.not_before <= now :
+					due.append(pending)
+
+				else :
+					self._cleanup_retries.append(pending)
+
+			B2RetryQueue.set(len(self._cleanup_retries))
+
+			if due :
+				B2Deletes.inc(len(due), 'retried')
+				await gather(*(self._delete_or_queue(pending.file, pending.attempts) for pending in due))
+
+
+	def stop_cleanup_retries(self: 'B2Cleanup') -> None :
+		if self._cleanup_task :
+			self._cleanup_task.cancel()
@@ -0,0 +1,281 @@
+from asyncio import Semaphore, gather, get_running_loop
+from io import BytesIO
+from re import Pattern, compile
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Set, Tuple, Union
+from zipfile import BadZipFile, ZipFile, ZipInfo
+
+from admission import WeightedAdmission
+from async_sql import AsyncTransaction
+from imaging import pool_render_emojis
+from kh_common.auth import KhUser
+from kh_common.exceptions.http_error import BadRequest, Forbidden, HttpErrorHandler
+from metrics import count_in, count_out, stage
+
+
+EmojiName: Pattern = compile(r'^[a-z0-9_-]{1,32}$')
+EmojiExtensions: Set[str] = { 'png', 'jpg', 'jpeg', 'gif', 'webp' }
+MaxPackEmojis: int = 1000
+MaxPackBytes: int = 256 * 2**20  # uncompressed
+MaxEmojiBytes: int = 8 * 2**20
+# emojis are sent to the image pool in chunks of this many, so a pack costs a few round trips rather than one per emoji
+EmojiChunkSize: int = 16
+
+
+class Emojis :
+	"""
+	emojis are stored in b2 as emoji/{name}.webp and owned by the user that created them. they're either
+	created from a post's image by uploadImage, or imported in bulk from a zip archive of small images.
+	packs are decoded, resized and encoded in the image process pool and uploaded concurrently, and every
+	emoji in a pack is claimed with a single statement before any of them are uploaded, so an upload never
+	overwrites an emoji someone else owns. only pack_concurrency packs are imported at once per worker.
+	"""
+
+	def __init__(self: 'Emojis', upload_concurrency: int = 16, pack_concurrency: int = 2) -> None :
+		self._emoji_uploads: Semaphore = Semaphore(upload_concurrency)
+		self._emoji_packs: WeightedAdmission = WeightedAdmission(
+			capacity = pack_concurrency,
+			max_waiters = pack_concurrency * 2,
+			deadline = 15,
+		)
+
+
+	def _validateEmojiName(self: 'Emojis', name: str) -> None :
+		if not EmojiName.match(name) :
+			raise BadRequest('the given emoji name is invalid, emoji names can only contain 1 to 32 lowercase letters, numbers, underscores and dashes.', logdata={ 'emoji': name })
+
+
+	def _emoji_url(self: 'Emojis', name: str) -> str :
+		return f'emoji/{name}.webp'
+
+
+	def _emoji_query(self: 'Emojis', transaction: Optional[AsyncTransaction]) -> Callable :
+		return transaction.query if transaction else self.async_query
+
+
+	async def _emoji_owners(self: 'Emojis', names: List[str], transaction: Optional[AsyncTransaction] = None) -> Dict[str, int] :
+		data: List[Tuple[str, int]] = await self._emoji_query(transaction)("""
+			SELECT emojis.emoji, emojis.owner
+			FROM kheina.public.emojis
+			WHERE emojis.emoji = any(%s);
+			""",
+			(names,),
+			fetch_all=True,
+		)
+		return dict(data or [])
+
+
+	async def _upsert_emojis(self: 'Emojis', user: KhUser, names: List[str], post_id: Optional[int] = None, transaction: Optional[AsyncTransaction] = None) -> Set[str] :
+		# emojis belonging to someone else are left alone, and are missing from the returned names
+		data: List[Tuple[str]] = await self._emoji_query(transaction)("""
+			INSERT INTO kheina.public.emojis
+			(emoji, owner, post_id, filename)
+			SELECT unnest(%s::text[]), %s, %s, unnest(%s::text[])
+			ON CONFLICT (emoji) DO
+				UPDATE SET
+					post_id = excluded.post_id,
+					filename = excluded.filename
+				WHERE emojis.owner = excluded.owner
+			RETURNING emojis.emoji;
+			""",
+			(names, user.user_id, post_id, list(map(self._emoji_url, names))),
+			fetch_all=True,
+		)
+		return { row[0] for row in data or [] }
+
+
+	async def _release_emojis(self: 'Emojis', user: KhUser, names: List[str]) -> None :
+		await self.async_query("""
+			DELETE FROM kheina.public.emojis
+			WHERE emojis.emoji = any(%s)
+				AND emojis.owner = %s;
+			""",
+			(names, user.user_id),
+		)
+
+
+	async def _claim_emoji(self: 'Emojis', transaction: AsyncTransaction, user: KhUser, name: str, post_id: int) -> str :
+		"""
+		claims the name for the user within transaction and returns the emoji's url, or raises Forbidden if someone else owns it.
+		the row stays locked until the transaction ends, so a concurrent claim waits and then fails.
+		"""
+		if not await self._upsert_emojis(user, [name], post_id, transaction) :
+			raise Forbidden('the given emoji name is already taken.', logdata={ 'emoji': name })
+
+		return self._emoji_url(name)
+
+
+	def _probe_pack(self: 'Emojis', files: Dict[str, bytes]) -> int :
+		# files over the limit are rejected by the pool without being decoded, so they cost nothing
+		return sum(pixels for pixels in (self.probe_pixels(BytesIO(data)) for data in files.values()) if pixels <= self.emoji_max_pixels)
+
+
+	def _read_pack(self: 'Emojis', file: BinaryIO) -> Tuple[Dict[str, bytes], Dict[str, Dict[str, Any]]] :
+		"""
+		returns the image data for every usable file in the archive, and a result for every name that wasn't usable, both by
+		emoji name. names are taken as-is, so they're held to the same rules as uploadImage's. a name used by more than one
+		file is rejected, whichever of them came first. sizes are checked against the archive's directory before anything
+		is decompressed, then enforced while reading.
+		"""
+		files: Dict[str, bytes] = { }
+		rejected: Dict[str, Dict[str, Any]] = { }
+		seen: Set[str] = set()
+		total: int = 0
+
+		try :
+			with ZipFile(file) as archive :
+				entries: List[ZipInfo] = [
+					entry for entry in archive.infolist()
+					if not entry.is_dir() and not entry.filename.startswith('__MACOSX/') and not entry.filename.rsplit('/', 1)[-1].startswith('.')
+				]
+
+				if len(entries) > MaxPackEmojis :
+					raise BadRequest(f'emoji packs cannot contain more than {MaxPackEmojis} files.')
+
+				if sum(entry.file_size for entry in entries) > MaxPackBytes :
+					raise BadRequest(f'emoji packs cannot be larger than {MaxPackBytes // 2**20}MiB uncompressed.')
+
+				for entry in entries :
+					basename: str = entry.filename.rsplit('/', 1)[-1]
+					name, dot, extension = basename.rpartition('.')
+
+					if not dot :
+						name, extension = basename, ''
+
+					if name in seen :
+						files.pop(name, None)
+						rejected[name] = { 'success': False, 'status': 400, 'error': f'the pack contains more than one {name} emoji.' }
+						continue
+
+					seen.add(name)
+
+					if extension.lower() not in EmojiExtensions :
+						rejected[name] = { 'success': False, 'status': 400, 'error': f'emoji images must be one of: {", ".join(sorted(EmojiExtensions))}.' }
+						continue
+
+					if not EmojiName.match(name) :
+						rejected[name] = { 'success': False, 'status': 400, 'error': 'emoji names can only contain 1 to 32 lowercase letters, numbers, underscores and dashes.' }
+						continue
+
+					if entry.file_size > MaxEmojiBytes :
+						rejected[name] = { 'success': False, 'status': 400, 'error': f'emoji images cannot be larger than {MaxEmojiBytes // 2**20}MiB.' }
+						continue
+
+					with archive.open(entry) as f :
+						# the directory's sizes can lie, so never read more than the limit allows
+						data: bytes = f.read(MaxEmojiBytes + 1)
+
+					total += len(data)
+
+					if len(data) > MaxEmojiBytes or total > MaxPackBytes :
+						raise BadRequest('the emoji pack is larger than its archive claims.')
+
+					files[name] = data
+
+		except BadZipFile :
+			raise BadRequest('emoji packs must be zip archives.')
+
+		return files, rejected
+
+
+	async def _render_emojis(self: 'Emojis', files: Dict[str, bytes]) -> Dict[str, Union[bytes, str]] :
+		names: List[str] = list(files)
+		loop = get_running_loop()
+		chunks: List[List[Union[bytes, str]]] = await gather(*(
+			loop.run_in_executor(self.image_pool, pool_render_emojis, [files[name] for name in names[i:i + EmojiChunkSize]])
+			for i in range(0, len(names), EmojiChunkSize)
+		))
+		return dict(zip(names, (rendered for chunk in chunks for rendered in chunk)))
+
+
+	async def _upload_emoji(self: 'Emojis', name: str, data: bytes) -> Optional[str] :
+		async with self._emoji_uploads :
+			try :
+				await self.b2_upload_async(data, self._emoji_url(name), content_type=self.mime_types['webp'])
+				count_out('emoji', len(data))
+				return None
+
+			except Exception as e :
+				self.logger.warning(f'failed to upload emoji {name}.', exc_info=e)
+				return 'unable to upload the emoji, try again later.'
+
+
+	@HttpErrorHandler('importing emoji pack')
+	async def importEmojiPack(self: 'Emojis', user: KhUser, file: BinaryIO, admission: WeightedAdmission) -> Dict[str, List[Dict[str, Any]]] :
+		"""
+		the pack is rendered within admission, charged the pack's total pixel count. raises AdmissionRejected
+		when too many packs are being imported, or when the pack can't be admitted in time.
+		"""
+		async with self._emoji_packs.admit(1) :
+			return await self._import_emoji_pack(user, file, admission)
+
+
+	async def _import_emoji_pack(self: 'Emojis', user: KhUser, file: BinaryIO, admission: WeightedAdmission) -> Dict[str, List[Dict[str, Any]]] :
+		with stage('unpack') :
+			files, results = await get_running_loop().run_in_executor(None, self._read_pack, file)
+
+		if not files and not results :
+			raise BadRequest('the emoji pack does not contain any images.')
+
+		count_in(sum(map(len, files.values())))
+		order: List[str] = list(dict.fromkeys([*results, *files]))
+
+		# names owned by someone else are dropped before rendering, the claim below is what actually decides ownership
+		owners: Dict[str, int] = await self._emoji_owners(list(files))
+
+		for name, owner in owners.items() :
+			if owner != user.user_id :
+				results[name] = { 'success': False, 'status': 403, 'error': 'the given emoji name is already taken.' }
+				del files[name]
+
+		with stage('probe') :
+			pixels: int = await get_running_loop().run_in_executor(None, self._probe_pack, files)
+
+		async with admission.admit(pixels) :
+			with stage('render') :
+				rendered: Dict[str, Union[bytes, str]] = await self._render_emojis(files)
+
+		del files
+		emojis: Dict[str, bytes] = { }
+
+		for name, data in rendered.items() :
+			if isinstance(data, str) :
+				results[name] = { 'success': False, 'status': 400, 'error': data }
+
+			else :
+				emojis[name] = data
+
+		del rendered
+
+		with stage('db.upsert') :
+			claimed: Set[str] = await self._upsert_emojis(user, list(emojis)) if emojis else set()
+
+		for name in list(emojis) :
+			if name not in claimed :
+				# claimed by someone else after the ownership check
+				results[name] = { 'success': False, 'status': 403, 'error': 'the given emoji name is already taken.' }
+				del emojis[name]
+
+		with stage('upload') :
+			errors: List[Optional[str]] = await gather(*(self._upload_emoji(name, data) for name, data in emojis.items()))
+
+		# names that were claimed by this import, rather than already owned, are released again if their upload failed
+		unclaimed: List[str] = []
+
+		for name, error in zip(list(emojis), errors) :
+			if error :
+				results[name] = { 'success': False, 'status': 502, 'error': error }
+
+				if name not in owners :
+					unclaimed.append(name)
+
+			else :
+				results[name] = { 'success': True, 'status': 200, 'url': self._emoji_url(name) }
+
+		del emojis
+
+		if unclaimed :
+			await self._release_emojis(user, unclaimed)
+
+		return {
+			'results': [{ 'emoji': name, **results[name] } for name in order],
+		}
@@ -0,0 +1,221 @@
+from asyncio import sleep
+from datetime import timedelta
+from importlib import import_module
+from time import perf_counter, time
+from typing import Any, Dict, List, Optional, Tuple
+
+from lazy import Lazy, lazy_import
+from metrics import Counter, Gauge, registry
+
+from fuzzly.models.post import PostId
+
+
+HotRefreshPosts: Counter = registry.register(Counter('uploader_hot_refresh_posts_total', 'posts read and rewritten by the hot rank refresh.', ('result',)))
+HotRefreshSeconds: Gauge = registry.register(Gauge('uploader_hot_refresh_last_run_seconds', 'wall time of the last complete hot rank refresh.'))
+HotRefreshRuns: Counter = registry.register(Counter('uploader_hot_refresh_runs_total', 'hot rank refreshes this worker was due to run, by whether it ran them or another worker held the lease.', ('result',)))
+
+hot: Lazy = lazy_import('scoring', 'scoring', 'hot')
+best: Lazy = lazy_import('scoring', 'scoring', 'confidence')
+controversial: Lazy = lazy_import('scoring', 'scoring', 'controversial')
+InternalScore: Lazy = lazy_import('fuzzly', 'fuzzly.models.internal', 'InternalScore')
+ScoreKVS: Lazy = lazy_import('fuzzly', 'fuzzly.models.internal', 'ScoreCache')
+ScoreCache: Lazy = Lazy('aerospike', lambda : import_module('batch_cache').BatchCache(ScoreKVS))
+KeyValueStore: Lazy = lazy_import('aerospike', 'kh_common.caching.key_value_store', 'KeyValueStore')
+# shared by every worker in every replica: the lease on the next refresh, and when the last one started
+HotRefreshState: Lazy = Lazy('aerospike', lambda : import_module('batch_cache').BatchCache(KeyValueStore('kheina', 'hot_refresh', local_TTL=0)))
+
+# hot is stored as a double, anything closer than this was computed from the same inputs
+HotTolerance: float = 1e-9
+
+
+class HotRefresh :
+	"""
+	recomputes post_scores for public posts created within the active window whose stored scores no
+	longer match their votes and creation time. this happens when a post is published again, which resets
+	created_on but leaves its scores alone, or when votes are removed without a new vote being cast.
+	only posts that were voted on, or published, since the previous refresh started are candidates.
+	posts are read in chunks of chunk_size, keyset paginated on (created_on, post_id), with a pause between
+	chunks. only rows that drifted are written, and only if no vote rewrote them in the meantime.
+	ScoreCache is refreshed in a single batch per chunk for posts whose vote counts changed.
+	"""
+
+	def __init__(self: 'HotRefresh', window: timedelta = timedelta(days=7), chunk_size: int = 500, pause: float = 0.25) -> None :
+		self.hot_refresh_window: timedelta = window
+		self.hot_refresh_chunk_size: int = chunk_size
+		self.hot_refresh_pause: float = pause
+
+
+	async def _select_score_chunk(self: 'HotRefresh', since: float, created_on: float, post_id: int) -> List[Tuple] :
+		return await self.async_query("""
+			WITH chunk AS (
+				SELECT posts.post_id, posts.created_on
+				FROM kheina.public.posts
+				WHERE (posts.created_on, posts.post_id) > (to_timestamp(%s), %s)
+					AND posts.privacy_id = privacy_to_id('public')
+					AND (
+						posts.created_on > to_timestamp(%s)
+						OR EXISTS (
+							SELECT 1
+							FROM kheina.public.post_votes
+							WHERE post_votes.post_id = posts.post_id
+								AND post_votes.updated_on > to_timestamp(%s)
+						)
+					)
+				ORDER BY posts.created_on, posts.post_id
+				LIMIT %s
+			)
+			SELECT
+				chunk.post_id,
+				chunk.created_on,
+				post_scores.upvotes,
+				post_scores.downvotes,
+				post_scores.hot,
+				COUNT(post_votes.upvote),
+				COALESCE(SUM(post_votes.upvote::int), 0)
+			FROM chunk
+				LEFT JOIN kheina.public.post_scores
+					ON post_scores.post_id = chunk.post_id
+				LEFT JOIN kheina.public.post_votes
+					ON post_votes.post_id = chunk.post_id
+						AND post_votes.upvote IS NOT NULL
+			GROUP BY chunk.post_id, chunk.created_on, post_scores.post_id
+			ORDER BY chunk.created_on, chunk.post_id;
+			""",
+			(created_on, post_id, since, since, self.hot_refresh_chunk_size),
+			fetch_all=True,
+		)
+
+
+	async def _write_scores(self: 'HotRefresh', rows: List[Tuple[int, int, int, int, int, float, float, float, float]]) -> List[int] :
+		# the stored counts and hot are compared again in the update, so a vote that landed after the chunk was read wins
+		columns: List[List[Any]] = list(map(list, zip(*rows)))
+		updated: List[Tuple[int]] = await self.async_query("""
+			UPDATE kheina.public.post_scores
+				SET upvotes = scores.up,
+					downvotes = scores.down,
+					top = scores.up - scores.down,
+					hot = scores.hot,
+					best = scores.best,
+					controversial = scores.controversial
+			FROM unnest(
+				%s::bigint[], %s::int[], %s::int[], %s::int[], %s::int[],
+				%s::double precision[], %s::double precision[], %s::double precision[], %s::double precision[]
+			) AS scores(post_id, old_up, old_down, up, down, old_hot, hot, best, controversial)
+			WHERE post_scores.post_id = scores.post_id
+				AND post_scores.upvotes = scores.old_up
+				AND post_scores.downvotes = scores.old_down
+				AND post_scores.hot = scores.old_hot
+			RETURNING post_scores.post_id;
+			""",
+			tuple(columns),
+			fetch_all=True,
+		)
+		return [row[0] for row in updated]
+
+
+	async def _refresh_chunk(self: 'HotRefresh', rows: List[Tuple]) -> int :
+		drifted: List[Tuple[int, int, int, int, int, float, float, float, float]] = []
+		recounted: Dict[int, Tuple[int, int]] = { }
+
+		for post_id, created_on, old_up, old_down, old_hot, total, up in rows :
+			if old_up is None :
+				# published posts always have a score row, so this one is being published right now
+				continue
+
+			down: int = total - up
+			h: float = hot(up, down, created_on.timestamp())
+
+			if up == old_up and down == old_down and abs(h - old_hot) <= HotTolerance :
+				continue
+
+			drifted.append((post_id, old_up, old_down, up, down, old_hot, h, best(up, total), controversial(up, down)))
+
+			if up != old_up or down != old_down :
+				recounted[post_id] = (up, down)
+
+		HotRefreshPosts.inc(len(rows), 'read')
+
+		if not drifted :
+			return 0
+
+		updated: List[int] = await self._write_scores(drifted)
+		HotRefreshPosts.inc(len(updated), 'updated')
+		HotRefreshPosts.inc(len(drifted) - len(updated), 'raced')
+
+		scores: Dict[str, Any] = {
+			PostId(post_id): InternalScore(up=recounted[post_id][0], down=recounted[post_id][1], total=sum(recounted[post_id]))
+			for post_id in updated
+			if post_id in recounted
+		}
+
+		if scores :
+			try :
+				await ScoreCache.put_many(scores)
+
+			except Exception as e :
+				self.logger.warning(f'failed to refresh {len(scores)} cached scores.', exc_info=e)
+
+		return len(updated)
+
+
+	async def claim_hot_refresh(self: 'HotRefresh', lease: int) -> bool :
+		"""
+		returns whether this worker holds the lease on the next refresh. the lease isn't released, it expires
+		after lease seconds, so however many workers share the schedule, one refresh runs per lease.
+		"""
+		claimed: bool = await HotRefreshState.create('lease', time(), ttl=lease)
+		HotRefreshRuns.inc(1, 'ran' if claimed else 'leased')
+		return claimed
+
+
+	async def refresh_hot(self: 'HotRefresh') -> int :
+		"""
+		runs a single refresh over the active window, returns how many posts were rewritten.
+		"""
+		start: float = perf_counter()
+		started: float = time()
+		# the cursor is an epoch timestamp, so it means the same thing whatever type created_on comes back as
+		cursor: Tuple[float, int] = (started - self.hot_refresh_window.total_seconds(), 0)
+		last: Optional[float] = (await HotRefreshState.get_many(['last_run']))['last_run']
+		# votes cast while the previous refresh was running are picked up again, since it started before they were read
+		since: float = max(last or 0, cursor[0])
+		updated: int = 0
+
+		while True :
+			rows: List[Tuple] = await self._select_score_chunk(since, *cursor)
+
+			if rows :
+				updated += await self._refresh_chunk(rows)
+				cursor = (rows[-1][1].timestamp(), rows[-1][0])
+
+			if len(rows) < self.hot_refresh_chunk_size :
+				break
+
+			await sleep(self.hot_refresh_pause)
+
+		# only recorded once the whole window was refreshed, so a failed refresh is covered by the next one
+		await HotRefreshState.put_many({ 'last_run': started })
+		HotRefreshSeconds.set(perf_counter() - start)
+		self.logger.info({
+			'message': 'refreshed hot ranks.',
+			'updated': updated,
+			'seconds': perf_counter() - start,
+		})
+
+		return updated
+
+
+async def run_hot_refresh(refresher: Lazy, interval: float) -> None :
+	"""
+	calls refresher.refresh_hot every interval seconds, on whichever worker claims the lease first. the first
+	run waits a full interval, so a lazily loaded refresher isn't built just because the server started.
+	"""
+	while True :
+		await sleep(interval)
+
+		try :
+			if await refresher.claim_hot_refresh(max(int(interval), 1)) :
+				await refresher.refresh_hot()
+
+		except Exception as e :
+			refresher.logger.error('hot rank refresh failed.', exc_info=e)
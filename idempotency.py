@@ -0,0 +1,172 @@
+from asyncio import Future, get_running_loop, shield, sleep
+from hashlib import sha256
+from logging import Logger
+from time import monotonic
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+import aerospike
+import ujson
+from batch_cache import BatchCache
+from fastapi.encoders import jsonable_encoder
+from kh_common.caching.key_value_store import KeyValueStore
+from kh_common.exceptions.http_error import BadRequest, Conflict, UnprocessableEntity
+from kh_common.logging import getLogger
+from metrics import Counter, registry
+
+
+IdempotentRequests: Counter = registry.register(Counter('uploader_idempotent_requests_total', 'requests carrying an idempotency key, by how they were answered.', ('endpoint', 'outcome')))
+
+MaxKeyLength: int = 255
+Pending: str = 'pending'
+Done: str = 'done'
+# returned while waiting on another worker, when its request failed and the key can be claimed again
+Released: object = object()
+
+
+class Idempotency :
+	"""
+	runs each request carrying an idempotency key at most once per ttl. the first request with a key claims it
+	with a create only write, runs, and stores its response. retries that reach the same worker join the
+	running request directly, retries that reach another worker poll the store until the response appears.
+	a retry is only answered from the store if it carries the same fingerprint as the original request.
+	requests that fail release their key, so the client's next retry runs again.
+	"""
+
+	def __init__(self: 'Idempotency', ttl: int = 86400, lock_ttl: int = 600, wait: float = 30, poll: float = 0.25) -> None :
+		self.ttl: int = ttl
+		self.lock_ttl: int = lock_ttl
+		self.wait: float = wait
+		self.poll: float = poll
+		self._store: KeyValueStore = KeyValueStore('kheina', 'idempotency', local_TTL=0)
+		self._batch: BatchCache = BatchCache(self._store)
+		self._inflight: Dict[str, Tuple[str, Future]] = { }
+		self.logger: Logger = getLogger()
+
+
+	@staticmethod
+	def fingerprint(*parts: Any) -> str :
+		digest = sha256()
+
+		for part in parts :
+			digest.update(part if isinstance(part, bytes) else repr(part).encode())
+			digest.update(b'\0')
+
+		return digest.hexdigest()
+
+
+	async def _read(self: 'Idempotency', key: str) -> Optional[Dict[str, Any]] :
+		try :
+			return await self._store.get_async(key)
+
+		except aerospike.exception.RecordNotFound :
+			return None
+
+
+	def _check(self: 'Idempotency', endpoint: str, original: str, fingerprint: str) -> None :
+		if original != fingerprint :
+			IdempotentRequests.inc(1, endpoint, 'mismatch')
+			raise UnprocessableEntity('this idempotency key was already used for a different request.')
+
+
+	def _replay(self: 'Idempotency', endpoint: str, record: Dict[str, Any], fingerprint: str) -> Any :
+		self._check(endpoint, record['fingerprint'], fingerprint)
+		IdempotentRequests.inc(1, endpoint, 'replayed')
+		return ujson.loads(record['response'])
+
+
+	async def _await_other_worker(self: 'Idempotency', endpoint: str, key: str, fingerprint: str) -> Any :
+		deadline: float = monotonic() + self.wait
+
+		while monotonic() < deadline :
+			record: Optional[Dict[str, Any]] = await self._read(key)
+
+			if record is None :
+				# the original request failed and released the key, so this retry is free to claim it
+				return Released
+
+			if record['status'] == Done :
+				return self._replay(endpoint, record, fingerprint)
+
+			self._check(endpoint, record['fingerprint'], fingerprint)
+			await sleep(self.poll)
+
+		IdempotentRequests.inc(1, endpoint, 'conflict')
+		raise Conflict('a request with this idempotency key is still in progress, retry later.')
+
+
+	async def _release(self: 'Idempotency', key: str) -> None :
+		try :
+			await self._batch.remove(key)
+
+		except Exception as e :
+			# the lock expires on its own after lock_ttl, which is as long as retries will be held off
+			self.logger.warning(f'failed to release idempotency key {key}.', exc_info=e)
+
+
+	async def _execute(self: 'Idempotency', endpoint: str, key: str, fingerprint: str, func: Callable[[], Awaitable[Any]]) -> Any :
+		future: Future = get_running_loop().create_future()
+		self._inflight[key] = (fingerprint, future)
+
+		try :
+			response: Any = await func()
+
+		except BaseException as e :
+			future.set_exception(e)
+			# retrieved here, so asyncio doesn't warn about an exception that no retry joined to see
+			future.exception()
+			await self._release(key)
+			raise
+
+		finally :
+			del self._inflight[key]
+
+		IdempotentRequests.inc(1, endpoint, 'executed')
+		future.set_result(response)
+
+		try :
+			await self._store.put_async(
+				key,
+				{ 'status': Done, 'fingerprint': fingerprint, 'response': ujson.dumps(jsonable_encoder(response)) },
+				self.ttl,
+			)
+
+		except Exception as e :
+			# the request itself succeeded, so failing to store it only means that a retry runs it again
+			self.logger.warning(f'failed to store the response for idempotency key {key}.', exc_info=e)
+			await self._release(key)
+
+		return response
+
+
+	async def run(self: 'Idempotency', endpoint: str, user_id: int, key: str, fingerprint: str, func: Callable[[], Awaitable[Any]]) -> Any :
+		"""
+		returns func's response, running it only if no other request with the same key has, or is.
+		"""
+		if len(key) > MaxKeyLength :
+			raise BadRequest(f'idempotency keys cannot be longer than {MaxKeyLength} characters.')
+
+		# keys are scoped to the user and endpoint, so clients can't collide with, or read, each other's responses
+		key = f'{user_id}|{endpoint}|{key}'
+
+		while key not in self._inflight :
+			if await self._batch.create(key, { 'status': Pending, 'fingerprint': fingerprint }, ttl=self.lock_ttl) :
+				return await self._execute(endpoint, key, fingerprint, func)
+
+			record: Optional[Dict[str, Any]] = await self._read(key)
+
+			if record is None :
+				# released between the create and the read
+				continue
+
+			if record['status'] == Done :
+				return self._replay(endpoint, record, fingerprint)
+
+			response: Any = await self._await_other_worker(endpoint, key, fingerprint)
+
+			if response is not Released :
+				return response
+
+		original, future = self._inflight[key]
+		self._check(endpoint, original, fingerprint)
+		IdempotentRequests.inc(1, endpoint, 'joined')
+		return await shield(future)
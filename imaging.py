@@ -0,0 +1,329 @@
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from multiprocessing import get_context
+from os import cpu_count, environ
+from subprocess import PIPE, Popen
+from typing import Any, BinaryIO, Dict, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+from kh_common.base64 import b64decode
+from kh_common.exceptions.http_error import InternalServerError
+from lazy import Lazy, lazy_import
+from metrics import stage
+from models import Coordinates
+
+
+# ImageMagick is only loaded once an image is actually processed
+Image: Lazy = lazy_import('wand', 'wand.image', 'Image')
+wand_exceptions: Lazy = lazy_import('wand', 'wand.exceptions')
+
+
+class Thumbnail(NamedTuple) :
+	key: Union[int, str]  # the thumbnail size, or 'jpeg'
+	name: str  # the file name under the post's thumbnails/
+	data: bytes
+
+
+def thumbnail_names(sizes: List[int]) -> List[str] :
+	"""
+	the file names render_thumbnails writes for the given sizes, the jpeg is rendered at the largest of them.
+	"""
+	return [f'{size}.webp' for size in sizes] + [f'{max(sizes)}.jpg']
+
+
+class Derivatives(NamedTuple) :
+	width: int
+	height: int
+	thumbhash: bytes
+	sizes: List[int]
+	thumbnails: List[Thumbnail]
+	animated_preview: Optional[bytes]
+
+
+class ImageProcessor :
+
+	def __init__(self: 'ImageProcessor') -> None :
+		self.thumbnail_sizes: List[int] = [
+			# the length of the longest side, in pixels
+			100,
+			200,
+			400,
+			800,
+			1200,
+		]
+		self.web_size: int = 1500
+		self.emoji_size: int = 256
+		self.emoji_max_pixels: int = 16_000_000
+		self.icon_size: int = 400
+		self.banner_size: int = 600
+		self.output_quality: int = 85
+		self.filter_function: str = 'catrom'
+
+		# animated previews are only generated for multi-frame sources, and only within these budgets
+		self.animated_preview: bool = True
+		self.animated_preview_size: int = 400
+		self.animated_preview_frames: int = 150
+		self.animated_preview_max_pixels: int = 250_000_000  # source width * height * frames
+		self.animated_preview_max_bytes: int = 8_000_000
+
+		# batch work (emoji packs, the backfill) is spread across a process pool, started on first use
+		self.image_workers: int = int(environ.get('UPLOADER_IMAGE_WORKERS', 0)) or cpu_count() or 1
+		self._image_pool: Optional[ProcessPoolExecutor] = None
+
+
+	@property
+	def image_pool(self: 'ImageProcessor') -> ProcessPoolExecutor :
+		if self._image_pool is None :
+			self._image_pool = ProcessPoolExecutor(
+				self.image_workers,
+				# spawned rather than forked, so workers don't inherit the parent's connections
+				mp_context=get_context('spawn'),
+				initializer=init_worker,
+			)
+
+		return self._image_pool
+
+
+	def close_image_pool(self: 'ImageProcessor') -> None :
+		if self._image_pool is not None :
+			self._image_pool.shutdown()
+			self._image_pool = None
+
+
+	def derivative_settings(self: 'ImageProcessor') -> Dict[str, Any] :
+		"""
+		the settings that shape a post's derivatives, changing any of them changes every post's media version.
+		"""
+		return {
+			'thumbnail_sizes': self.thumbnail_sizes,
+			'output_quality': self.output_quality,
+			'filter_function': self.filter_function,
+			'animated_preview': self.animated_preview,
+		}
+
+
+	def probe_pixels(self: 'ImageProcessor', file: BinaryIO) -> int :
+		"""
+		estimates the number of pixels decoding the given file will produce by only reading its headers.
+		unreadable files return 0 and are left for the full decode to reject. the file is rewound afterwards.
+		"""
+		try :
+			with Image.ping(file=file) as image :
+				return image.size[0] * image.size[1] * len(image.sequence)
+
+		except wand_exceptions.WandException :
+			return 0
+
+		finally :
+			file.seek(0)
+
+
+	def is_animated(self: 'ImageProcessor', image: Image) -> bool :
+		return len(image.sequence) > 1
+
+
+	def first_frame(self: 'ImageProcessor', image: Image) -> Image :
+		"""
+		returns a new, static image containing only the first frame of the given image, which is left unmodified.
+		only the first frame of an animated image is coalesced, onto its canvas, however many frames follow it.
+		the caller is responsible for closing the returned image.
+		"""
+		if not self.is_animated(image) :
+			return image.clone()
+
+		frame: Image = Image(image=image.sequence[0])
+		frame.coalesce()
+		frame.reset_coords()
+		return frame
+
+
+	def needs_resize(self: 'ImageProcessor', dimensions: Tuple[int, int], size: int) -> bool :
+		# mirrors the check in convert_image, images are only ever scaled down
+		return max(dimensions) > size
+
+
+	def plan_sizes(self: 'ImageProcessor', dimensions: Tuple[int, int]) -> List[int] :
+		"""
+		the thumbnail sizes worth generating for a source of the given dimensions. sizes that would equal
+		or exceed the source's long side are skipped, since they'd only re-encode it at its own resolution.
+		sources smaller than every size still get the smallest one, so that every post has a thumbnail.
+		"""
+		return [size for size in self.thumbnail_sizes if self.needs_resize(dimensions, size)] or self.thumbnail_sizes[:1]
+
+
+	def convert_image(self: 'ImageProcessor', image: Image, size: int) -> Image :
+		long_side = 0 if image.size[0] > image.size[1] else 1
+		ratio = size / image.size[long_side]
+
+		if ratio < 1 :
+			output_size = (round(image.size[0] * ratio), size) if long_side else (size, round(image.size[1] * ratio))
+			image.resize(width=output_size[0], height=output_size[1], filter=self.filter_function)
+
+		return image
+
+
+	def crop_icon(self: 'ImageProcessor', image: Image, coordinates: Coordinates) -> Image :
+		image.crop(**coordinates.dict())
+		return self.convert_image(image, self.icon_size)
+
+
+	def crop_banner(self: 'ImageProcessor', image: Image, coordinates: Coordinates) -> Image :
+		image.crop(**coordinates.dict())
+		if image.size[0] > self.banner_size * 3 or image.size[1] > self.banner_size :
+			image.resize(width=self.banner_size * 3, height=self.banner_size, filter=self.filter_function)
+
+		return image
+
+
+	def emoji_data(self: 'ImageProcessor', image: Image) -> bytes :
+		"""
+		encodes a static webp emoji from the first frame of the given image, with its metadata stripped.
+		"""
+		with self.first_frame(image) as frame :
+			frame.strip()
+			self.convert_image(frame, self.emoji_size)
+			frame.format = 'webp'
+			return self.get_image_data(frame)
+
+
+	def thumbhash(self: 'ImageProcessor', image: Image) -> bytes :
+		long_side = 0 if image.size[0] > image.size[1] else 1
+		size = 100
+		ratio = size / image.size[long_side]
+
+		if ratio < 1 :
+			output_size = (round(image.size[0] * ratio), size) if long_side else (size, round(image.size[1] * ratio))
+			image.resize(width=output_size[0], height=output_size[1], filter='point')
+
+		hash, err = Popen(['thumbhash', 'encode-image'], stdin=PIPE, stdout=PIPE, stderr=PIPE).communicate(self.get_image_data(image))
+
+		if err :
+			raise InternalServerError(f'Failed to generate image thumbhash: {err.decode()}.')
+
+		return b64decode(hash.strip(b'\n\r= ')).rstrip(b'\x00')
+
+
+	def render_thumbnails(self: 'ImageProcessor', frame: Image, sizes: List[int]) -> Iterator[Thumbnail] :
+		"""
+		encodes the webp thumbnails for the given sizes, then the jpeg thumbnail at the largest of them, one at
+		a time so that each can be uploaded and dropped before the next is encoded. the frame is left unmodified.
+		"""
+		names: List[str] = thumbnail_names(sizes)
+
+		for size, name in zip(sizes, names) :
+			with stage(f'resize.{size}'), frame.clone() as image :
+				data: bytes = self.get_image_data(self.convert_image(image, size))
+
+			yield Thumbnail(size, name, data)
+
+		with stage('resize.jpeg'), frame.clone() as image :
+			with self.convert_image(image, max(sizes)).convert('jpeg') as jpeg :
+				data: bytes = self.get_image_data(jpeg)
+
+		yield Thumbnail('jpeg', names[-1], data)
+
+
+	def render_derivatives(self: 'ImageProcessor', data: bytes) -> Derivatives :
+		"""
+		builds every derivative uploadImage produces for an already stripped image, other than the fullsize image itself.
+		"""
+		with Image(blob=data) as image :
+			frame: Image = self.first_frame(image)
+			animated_preview: Optional[bytes] = self.animated_preview_data(image) if self.is_animated(image) else None
+
+		try :
+			sizes: List[int] = self.plan_sizes(frame.size)
+
+			with frame.clone() as image :
+				thumbhash: bytes = self.thumbhash(image)
+
+			return Derivatives(
+				width = frame.size[0],
+				height = frame.size[1],
+				thumbhash = thumbhash,
+				sizes = sizes,
+				thumbnails = list(self.render_thumbnails(frame, sizes)),
+				animated_preview = animated_preview,
+			)
+
+		finally :
+			frame.close()
+
+
+	def animated_preview_data(self: 'ImageProcessor', image: Image) -> Optional[bytes] :
+		"""
+		builds an animated webp preview from an animated image, modifying it in place. the budget is checked
+		against the canvas and frame count before anything is coalesced, and only the frames that are kept are.
+		returns None when the source or the encoded preview falls outside of the configured budgets.
+		"""
+		if not self.animated_preview :
+			return None
+
+		frames: int = min(len(image.sequence), self.animated_preview_frames)
+		# every coalesced frame covers the whole canvas, which can be larger than the first frame
+		canvas: int = (image.page_width or image.size[0]) * (image.page_height or image.size[1])
+
+		if canvas * frames > self.animated_preview_max_pixels :
+			return None
+
+		# drop frames from the end so the remaining ones keep their original delays. a coalesced frame only
+		# depends on the frames before it, so the ones that are dropped never need to be coalesced
+		for i in range(len(image.sequence) - 1, frames - 1, -1) :
+			del image.sequence[i]
+
+		image.coalesce()
+		self.convert_image(image, self.animated_preview_size)
+		image.format = 'webp'
+		data: bytes = self.get_image_data(image)
+
+		if len(data) > self.animated_preview_max_bytes :
+			return None
+
+		return data
+
+
+	def get_image_data(self: 'ImageProcessor', image: Image, compress: bool = True) -> bytes :
+		if compress :
+			image.compression_quality = self.output_quality
+
+		image_data = BytesIO()
+		image.save(file=image_data)
+		return image_data.getvalue()
+
+
+# each process in an image pool keeps its own ImageProcessor, built once when the process starts
+_worker: Optional[ImageProcessor] = None
+
+
+def init_worker() -> None :
+	global _worker
+	_worker = ImageProcessor()
+
+
+def pool_render_derivatives(data: bytes) -> Derivatives :
+	try :
+		return _worker.render_derivatives(data)
+
+	except Exception as e :
+		# wand's exceptions don't always survive pickling, so only the message is sent back
+		raise RuntimeError(f'{type(e).__name__}: {e}') from None
+
+
+def pool_render_emojis(files: List[bytes]) -> List[Union[bytes, str]] :
+	"""
+	encodes a chunk of emojis, returning the webp data for each file or, if it couldn't be used, the reason why.
+	"""
+	results: List[Union[bytes, str]] = []
+
+	for data in files :
+		if _worker.probe_pixels(BytesIO(data)) > _worker.emoji_max_pixels :
+			results.append(f'emoji images cannot be larger than {_worker.emoji_max_pixels:,} pixels.')
+			continue
+
+		try :
+			with Image(blob=data) as image :
+				results.append(_worker.emoji_data(image))
+
+		except wand_exceptions.WandException :
+			results.append('the file is not a valid image.')
+
+	return results
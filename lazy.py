@@ -0,0 +1,122 @@
+from importlib import import_module
+from logging import Logger
+from os import environ
+from threading import RLock
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from kh_common.logging import getLogger
+from metrics import Gauge, registry
+
+
+"""
+heavy dependencies (ImageMagick, aerospike, exiftool, the fuzzly internal client and the uploader's own
+database and b2 connections) are wrapped in Lazy proxies, which import or construct them on first use.
+server startup calls warm_up for the subsystems listed in UPLOADER_WARM_UP, so a worker that only serves
+metadata endpoints can start without loading image processing at all.
+
+	UPLOADER_WARM_UP=all            # default, load everything before reporting ready
+	UPLOADER_WARM_UP=uploader,fuzzly
+	UPLOADER_WARM_UP=none           # load every subsystem on first use
+"""
+
+
+StartupSeconds: Gauge = registry.register(Gauge('uploader_startup_seconds', 'time spent importing or initializing each subsystem.', ('subsystem',)))
+
+_subsystems: Dict[str, List['Lazy']] = { }
+_lock: RLock = RLock()
+logger: Logger = getLogger()
+
+
+class Lazy :
+	"""
+	stands in for an object that is expensive to import or build. attribute access and calls are
+	forwarded to the real object, which is loaded once, the first time either happens.
+	"""
+
+	def __init__(self: 'Lazy', subsystem: str, loader: Callable[[], Any]) -> None :
+		self.__dict__['_subsystem'] = subsystem
+		self.__dict__['_loader'] = loader
+		self.__dict__['_value'] = None
+		self.__dict__['_loaded'] = False
+		_subsystems.setdefault(subsystem, []).append(self)
+
+
+	def _load(self: 'Lazy') -> Any :
+		if self._loaded :
+			return self._value
+
+		with _lock :
+			if not self._loaded :
+				start: float = perf_counter()
+				self.__dict__['_value'] = self._loader()
+				self.__dict__['_loaded'] = True
+				StartupSeconds.inc(perf_counter() - start, self._subsystem)
+
+		return self._value
+
+
+	def __getattr__(self: 'Lazy', name: str) -> Any :
+		return getattr(self._load(), name)
+
+
+	def __setattr__(self: 'Lazy', name: str, value: Any) -> None :
+		setattr(self._load(), name, value)
+
+
+	def __call__(self: 'Lazy', *args: Any, **kwargs: Any) -> Any :
+		return self._load()(*args, **kwargs)
+
+
+	@property
+	def loaded(self: 'Lazy') -> bool :
+		return self._loaded
+
+
+	def __repr__(self: 'Lazy') -> str :
+		return repr(self._value) if self._loaded else f'<lazy {self._subsystem}>'
+
+
+def lazy_import(subsystem: str, module: str, attribute: Optional[str] = None) -> Lazy :
+	if attribute :
+		return Lazy(subsystem, lambda : getattr(import_module(module), attribute))
+
+	return Lazy(subsystem, lambda : import_module(module))
+
+
+def warm_up(subsystems: Optional[Iterable[str]] = None) -> Dict[str, float] :
+	"""
+	loads the given subsystems, or all of them, and returns the seconds spent loading each.
+	"""
+	timings: Dict[str, float] = { }
+
+	for subsystem in (_subsystems if subsystems is None else subsystems) :
+		start: float = perf_counter()
+
+		for proxy in _subsystems.get(subsystem, []) :
+			proxy._load()
+
+		timings[subsystem] = perf_counter() - start
+
+	logger.info({
+		'message': 'warmed up subsystems.',
+		'seconds': timings,
+		'total': sum(timings.values()),
+	})
+
+	return timings
+
+
+def configured_subsystems() -> Optional[List[str]] :
+	"""
+	the subsystems named by UPLOADER_WARM_UP, None meaning all of them.
+	"""
+	warm: str = environ.get('UPLOADER_WARM_UP', 'all').strip()
+
+	if warm == 'all' :
+		return None
+
+	if warm == 'none' :
+		return []
+
+	return [subsystem.strip() for subsystem in warm.split(',') if subsystem.strip()]
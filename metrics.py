@@ -0,0 +1,299 @@
+import tracemalloc
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from logging import Logger
+from os import environ, sysconf
+from random import random
+from resource import RUSAGE_SELF, getrusage
+from sys import platform
+from threading import Lock
+from time import perf_counter, process_time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from kh_common.logging import getLogger
+
+
+"""
+stage timings are taken on the event loop thread, so wall and cpu time of stages that await
+can include work done for other requests in between. stages that only run blocking code (exiftool,
+wand, encoding, b2 uploads) are measured exactly. cpu time is process wide so that ImageMagick's
+worker threads are included.
+"""
+
+
+TimeBuckets: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+ByteBuckets: Tuple[float, ...] = tuple(float(2**i) for i in range(16, 32, 2))  # 64KiB to 1GiB
+LogSampleRate: float = float(environ.get('UPLOADER_TRACE_SAMPLE_RATE', 0))
+
+if environ.get('UPLOADER_TRACEMALLOC') :
+	tracemalloc.start()
+
+# ru_maxrss is reported in kilobytes on linux and in bytes on macos
+_rss_scale: int = 1 if platform == 'darwin' else 1024
+_page_size: int = sysconf('SC_PAGE_SIZE')
+
+
+def _rss() -> int :
+	"""
+	the current rss. ru_maxrss is a high-water mark that stops moving once the worker has warmed up,
+	so it's only used where /proc isn't available.
+	"""
+	try :
+		with open('/proc/self/statm', 'rb') as statm :
+			return int(statm.read().split()[1]) * _page_size
+
+	except OSError :
+		return getrusage(RUSAGE_SELF).ru_maxrss * _rss_scale
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str :
+	if not names :
+		return ''
+
+	return '{' + ','.join(f'{k}="{v}"' for k, v in zip(names, values)) + '}'
+
+
+class Counter :
+
+	def __init__(self: 'Counter', name: str, description: str, labels: Tuple[str, ...] = ()) -> None :
+		self.name: str = name
+		self.description: str = description
+		self.labels: Tuple[str, ...] = labels
+		self._values: Dict[Tuple[str, ...], float] = { }
+		self._lock: Lock = Lock()
+
+
+	def inc(self: 'Counter', value: float = 1, *labels: str) -> None :
+		with self._lock :
+			self._values[labels] = self._values.get(labels, 0) + value
+
+
+	def render(self: 'Counter') -> List[str] :
+		lines: List[str] = [
+			f'# HELP {self.name} {self.description}',
+			f'# TYPE {self.name} counter',
+		]
+
+		with self._lock :
+			for labels, value in self._values.items() :
+				lines.append(f'{self.name}{_labels(self.labels, labels)} {value}')
+
+		return lines
+
+
+class Gauge(Counter) :
+
+	def set(self: 'Gauge', value: float, *labels: str) -> None :
+		with self._lock :
+			self._values[labels] = value
+
+
+	def render(self: 'Gauge') -> List[str] :
+		lines: List[str] = Counter.render(self)
+		lines[1] = f'# TYPE {self.name} gauge'
+		return lines
+
+
+class Histogram :
+
+	def __init__(self: 'Histogram', name: str, description: str, buckets: Tuple[float, ...], labels: Tuple[str, ...] = ()) -> None :
+		self.name: str = name
+		self.description: str = description
+		self.buckets: Tuple[float, ...] = buckets
+		self.labels: Tuple[str, ...] = labels
+		# per label set: bucket counts (with a trailing +Inf bucket), sum, count
+		self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = { }
+		self._lock: Lock = Lock()
+
+
+	def observe(self: 'Histogram', value: float, *labels: str) -> None :
+		with self._lock :
+			if labels not in self._values :
+				self._values[labels] = ([0] * (len(self.buckets) + 1), [0.0, 0])
+
+			counts, totals = self._values[labels]
+			counts[bisect_left(self.buckets, value)] += 1
+			totals[0] += value
+			totals[1] += 1
+
+
+	def render(self: 'Histogram') -> List[str] :
+		lines: List[str] = [
+			f'# HELP {self.name} {self.description}',
+			f'# TYPE {self.name} histogram',
+		]
+
+		with self._lock :
+			for labels, (counts, totals) in self._values.items() :
+				cumulative: int = 0
+
+				for bound, count in zip(self.buckets + (float('inf'),), counts) :
+					cumulative += count
+					le: str = '+Inf' if bound == float('inf') else repr(bound)
+					lines.append(f'{self.name}_bucket{_labels(self.labels + ("le",), labels + (le,))} {cumulative}')
+
+				lines.append(f'{self.name}_sum{_labels(self.labels, labels)} {totals[0]}')
+				lines.append(f'{self.name}_count{_labels(self.labels, labels)} {totals[1]}')
+
+		return lines
+
+
+class Registry :
+
+	def __init__(self: 'Registry') -> None :
+		self._metrics: Dict[str, object] = { }
+
+
+	def register(self: 'Registry', metric) :
+		self._metrics[metric.name] = metric
+		return metric
+
+
+	def render(self: 'Registry') -> str :
+		lines: List[str] = []
+
+		for metric in self._metrics.values() :
+			lines += metric.render()
+
+		return '\n'.join(lines) + '\n'
+
+
+registry: Registry = Registry()
+
+StageSeconds: Histogram = registry.register(Histogram('uploader_stage_seconds', 'wall time spent in each pipeline stage.', TimeBuckets, ('pipeline', 'stage')))
+StageCpuSeconds: Histogram = registry.register(Histogram('uploader_stage_cpu_seconds', 'process cpu time spent in each pipeline stage.', TimeBuckets, ('pipeline', 'stage')))
+StageRssGrowth: Histogram = registry.register(Histogram('uploader_stage_rss_growth_bytes', 'growth of the process rss over each pipeline stage, 0 when it shrank.', ByteBuckets, ('pipeline', 'stage')))
+StageTracemallocGrowth: Histogram = registry.register(Histogram('uploader_stage_tracemalloc_growth_bytes', 'growth of traced python allocations over each pipeline stage, only when tracemalloc is enabled.', ByteBuckets, ('pipeline', 'stage')))
+PipelineSeconds: Histogram = registry.register(Histogram('uploader_pipeline_seconds', 'total wall time of each pipeline run.', TimeBuckets, ('pipeline', 'outcome')))
+BytesIn: Counter = registry.register(Counter('uploader_bytes_in_total', 'bytes received by each pipeline.', ('pipeline',)))
+BytesOut: Counter = registry.register(Counter('uploader_bytes_out_total', 'bytes produced by each pipeline, per derivative.', ('pipeline', 'derivative')))
+
+current_trace: ContextVar[Optional['Trace']] = ContextVar('current_trace', default=None)
+# set by the slow request capture in profiler.py, so the traces a request runs can be reported with it
+request_traces: ContextVar[Optional[List['Trace']]] = ContextVar('request_traces', default=None)
+
+
+class Trace :
+	"""
+	collects per stage timings for a single pipeline run. entering the trace makes it current for the
+	running context, so stage() and the byte counters below record into it without being passed around.
+	"""
+
+	logger: Logger = getLogger()
+
+	def __init__(self: 'Trace', pipeline: str, sample_rate: float = LogSampleRate) -> None :
+		self.pipeline: str = pipeline
+		self.sample_rate: float = sample_rate
+		self.stages: List[Dict[str, float]] = []
+		self.bytes_in: int = 0
+		self.bytes_out: Dict[str, int] = { }
+		self._start: float = 0
+		self._token: Optional[Token] = None
+
+
+	def __enter__(self: 'Trace') -> 'Trace' :
+		self._start = perf_counter()
+		self._token = current_trace.set(self)
+		traces: Optional[List[Trace]] = request_traces.get()
+
+		if traces is not None :
+			traces.append(self)
+
+		return self
+
+
+	def __exit__(self: 'Trace', exc_type, exc, tb) -> None :
+		current_trace.reset(self._token)
+		elapsed: float = perf_counter() - self._start
+		outcome: str = 'success' if exc_type is None else 'error'
+		PipelineSeconds.observe(elapsed, self.pipeline, outcome)
+
+		if self.sample_rate and random() < self.sample_rate :
+			self.logger.info({
+				'pipeline': self.pipeline,
+				'outcome': outcome,
+				'elapsed': elapsed,
+				'bytes_in': self.bytes_in,
+				'bytes_out': self.bytes_out,
+				'stages': self.stages,
+			})
+
+
+	@contextmanager
+	def stage(self: 'Trace', name: str) -> Iterator[None] :
+		tracing: bool = tracemalloc.is_tracing()
+		traced_start: int = 0
+
+		# the traced peak is process wide and resetting it would clobber concurrent stages, so only the current size is compared
+		if tracing :
+			traced_start = tracemalloc.get_traced_memory()[0]
+
+		rss_start: int = _rss()
+		cpu_start: float = process_time()
+		wall_start: float = perf_counter()
+
+		try :
+			yield
+
+		finally :
+			wall: float = perf_counter() - wall_start
+			cpu: float = process_time() - cpu_start
+			rss: int = max(_rss() - rss_start, 0)
+
+			StageSeconds.observe(wall, self.pipeline, name)
+			StageCpuSeconds.observe(cpu, self.pipeline, name)
+			StageRssGrowth.observe(rss, self.pipeline, name)
+
+			timing: Dict[str, float] = {
+				'stage': name,
+				'wall': wall,
+				'cpu': cpu,
+				'rss_growth': rss,
+			}
+
+			if tracing :
+				traced: int = max(tracemalloc.get_traced_memory()[0] - traced_start, 0)
+				StageTracemallocGrowth.observe(traced, self.pipeline, name)
+				timing['tracemalloc_growth'] = traced
+
+			self.stages.append(timing)
+
+
+	def count_in(self: 'Trace', size: int) -> None :
+		self.bytes_in += size
+		BytesIn.inc(size, self.pipeline)
+
+
+	def count_out(self: 'Trace', derivative: str, size: int) -> None :
+		self.bytes_out[derivative] = self.bytes_out.get(derivative, 0) + size
+		BytesOut.inc(size, self.pipeline, derivative)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None] :
+	"""
+	times the enclosed block as a stage of the current trace, or does nothing outside of one.
+	"""
+	trace: Optional[Trace] = current_trace.get()
+
+	if trace is None :
+		yield
+		return
+
+	with trace.stage(name) :
+		yield
+
+
+def count_in(size: int) -> None :
+	trace: Optional[Trace] = current_trace.get()
+
+	if trace is not None :
+		trace.count_in(size)
+
+
+def count_out(derivative: str, size: int) -> None :
+	trace: Optional[Trace] = current_trace.get()
+
+	if trace is not None :
+		trace.count_out(derivative, size)
@@ -0,0 +1,3 @@
+-- the thumbnail sizes generated for each post's current image, NULL for posts uploaded before they were planned per image
+ALTER TABLE kheina.public.posts
+	ADD COLUMN IF NOT EXISTS thumbnail_sizes smallint[];
@@ -0,0 +1,16 @@
+-- emojis are owned by the user that created them, and may have been created from a post's image
+CREATE TABLE IF NOT EXISTS kheina.public.emojis (
+	emoji TEXT PRIMARY KEY,
+	owner BIGINT NOT NULL REFERENCES kheina.public.users (user_id),
+	post_id BIGINT REFERENCES kheina.public.posts (post_id) ON DELETE SET NULL,
+	filename TEXT NOT NULL
+);
+
+-- for databases where the table predates the uploader creating emojis
+ALTER TABLE kheina.public.emojis
+	ADD COLUMN IF NOT EXISTS owner BIGINT REFERENCES kheina.public.users (user_id),
+	ADD COLUMN IF NOT EXISTS post_id BIGINT REFERENCES kheina.public.posts (post_id) ON DELETE SET NULL,
+	ADD COLUMN IF NOT EXISTS filename TEXT;
+
+-- the upsert's ON CONFLICT (emoji) needs a unique index on the name, which the primary key already is on new tables
+CREATE UNIQUE INDEX IF NOT EXISTS emojis_emoji_key ON kheina.public.emojis (emoji);
@@ -0,0 +1,7 @@
+-- the version of each post's media and each user's icon and banner, NULL when only the legacy, unversioned keys were written
+ALTER TABLE kheina.public.posts
+	ADD COLUMN IF NOT EXISTS media_version TEXT;
+
+ALTER TABLE kheina.public.users
+	ADD COLUMN IF NOT EXISTS icon_version TEXT,
+	ADD COLUMN IF NOT EXISTS banner_version TEXT;
@@ -0,0 +1,3 @@
+-- the version of the derivative settings each post's current thumbnails were rendered with, NULL for posts rendered before it was recorded
+ALTER TABLE kheina.public.posts
+	ADD COLUMN IF NOT EXISTS derivatives_version TEXT;
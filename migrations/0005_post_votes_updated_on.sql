@@ -0,0 +1,6 @@
+-- when each vote was last cast or changed, so the hot rank refresh only reads posts that were voted on since its last run
+ALTER TABLE kheina.public.post_votes
+	ADD COLUMN IF NOT EXISTS updated_on TIMESTAMPTZ NOT NULL DEFAULT NOW();
+
+CREATE INDEX IF NOT EXISTS post_votes_updated_on_idx
+	ON kheina.public.post_votes (updated_on);
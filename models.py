@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import List, Optional
 
 from pydantic import BaseModel, validator
 
@@ -35,6 +35,42 @@ class PrivacyRequest(BaseModel) :
 	privacy: Privacy
 
 
+MaxBatchSize: int = 100
+
+
+def _validate_batch(value: List[BaseModel]) -> List[BaseModel] :
+	if len(value) > MaxBatchSize :
+		raise ValueError(f'batches cannot contain more than {MaxBatchSize} posts.')
+
+	if len({ item.post_id for item in value }) != len(value) :
+		raise ValueError('each post can only appear in a batch once.')
+
+	return value
+
+
+class BatchUpdateRequest(BaseModel) :
+	posts: List[UpdateRequest]
+
+	_batch_validator = validator('posts', allow_reuse=True)(_validate_batch)
+
+
+class BatchPrivacyRequest(BaseModel) :
+	posts: List[PrivacyRequest]
+
+	_batch_validator = validator('posts', allow_reuse=True)(_validate_batch)
+
+
+class ScoresRequest(BaseModel) :
+	post_ids: List[PostId]
+
+	@validator('post_ids', pre=True)
+	def _post_ids_validator(value: List) -> List[PostId] :
+		if len(value) > MaxBatchSize :
+			raise ValueError(f'batches cannot contain more than {MaxBatchSize} posts.')
+
+		return list(map(PostId, value))
+
+
 class Coordinates(BaseModel) :
 	top: int
 	left: int
@@ -0,0 +1,269 @@
+from asyncio import Task, current_task, ensure_future, sleep
+from collections import Counter as Tally
+from collections import deque
+from contextlib import contextmanager
+from logging import Logger
+from os import environ, path
+from sys import _current_frames
+from threading import Event, Lock, Thread, enumerate as threads, get_ident
+from time import perf_counter
+from time import sleep as sleep_sync
+from types import FrameType
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional
+
+from fastapi.routing import APIRoute
+from kh_common.exceptions.http_error import BadRequest, Conflict
+from kh_common.logging import getLogger
+from metrics import Counter, Histogram, TimeBuckets, Trace, registry, request_traces
+
+
+LoopLag: Histogram = registry.register(Histogram('uploader_event_loop_lag_seconds', 'how much later than scheduled the event loop monitor woke up.', TimeBuckets))
+LoopStalls: Counter = registry.register(Counter('uploader_event_loop_stalls_total', 'times the event loop was blocked for longer than the stall threshold.'))
+SlowRequests: Counter = registry.register(Counter('uploader_slow_requests_total', 'requests slower than the slow request threshold, by route.', ('route',)))
+
+
+def _frame_name(frame: FrameType, lines: bool = False) -> str :
+	code = frame.f_code
+	name: str = f'{path.basename(code.co_filename)}:{code.co_name}'
+	return f'{name}:{frame.f_lineno}' if lines else name
+
+
+def thread_stack(frame: Optional[FrameType], lines: bool = False) -> List[str] :
+	"""
+	returns a thread's stack from the given frame as frame names, outermost first.
+	"""
+	stack: List[str] = []
+
+	while frame is not None :
+		stack.append(_frame_name(frame, lines))
+		frame = frame.f_back
+
+	stack.reverse()
+	return stack
+
+
+def await_stack(task: Task) -> List[str] :
+	"""
+	returns the chain of coroutines the task is suspended in, outermost first. Task.get_stack only
+	returns the outermost frame of a suspended task, so the chain is followed through cr_await instead.
+	"""
+	stack: List[str] = []
+	awaiting: Any = task.get_coro()
+
+	while awaiting is not None :
+		frame: Optional[FrameType] = getattr(awaiting, 'cr_frame', None) or getattr(awaiting, 'gi_frame', None)
+
+		if frame is None :
+			break
+
+		stack.append(_frame_name(frame, lines=True))
+		awaiting = getattr(awaiting, 'cr_await', None) or getattr(awaiting, 'gi_yieldfrom', None)
+
+	return stack
+
+
+class SamplingProfiler :
+	"""
+	samples the stacks of the worker's threads from a separate thread, every interval seconds, and returns
+	them in the collapsed format flamegraph.pl and speedscope read, one line per distinct stack with the
+	thread's name as its root frame. nothing is instrumented, so the cost is one stack walk per thread per
+	sample, and only while a profile is running. only one profile runs at a time.
+	"""
+
+	def __init__(self: 'SamplingProfiler', max_seconds: float = 60, min_interval: float = 0.001) -> None :
+		self.max_seconds: float = max_seconds
+		self.min_interval: float = min_interval
+		self._lock: Lock = Lock()
+
+
+	def profile(self: 'SamplingProfiler', seconds: float, interval: float = 0.005, thread_id: Optional[int] = None) -> str :
+		"""
+		blocks for seconds, so it should be run in an executor. only thread_id is sampled, if given.
+		"""
+		if not 0 < seconds <= self.max_seconds :
+			raise BadRequest(f'profiles must be between 0 and {self.max_seconds} seconds long.')
+
+		if interval < self.min_interval :
+			raise BadRequest(f'the sampling interval cannot be shorter than {self.min_interval} seconds.')
+
+		if not self._lock.acquire(blocking=False) :
+			raise Conflict('a profile is already running on this worker.')
+
+		try :
+			samples: Tally = Tally()
+			sampler: int = get_ident()
+			deadline: float = perf_counter() + seconds
+
+			while perf_counter() < deadline :
+				names: Dict[int, str] = { thread.ident: thread.name for thread in threads() }
+
+				for ident, frame in _current_frames().items() :
+					if ident == sampler or (thread_id and ident != thread_id) :
+						continue
+
+					samples[';'.join([names.get(ident, str(ident)), *thread_stack(frame)])] += 1
+
+				sleep_sync(interval)
+
+			return '\n'.join(f'{stack} {count}' for stack, count in samples.most_common())
+
+		finally :
+			self._lock.release()
+
+
+class RequestCapture :
+
+	def __init__(self: 'RequestCapture', route: str, task: Optional[Task]) -> None :
+		self.route: str = route
+		self.task: Optional[Task] = task
+		self.start: float = perf_counter()
+		self.error: Optional[str] = None
+		self.stack: Optional[List[str]] = None
+		self.stalls: List[Dict[str, Any]] = []
+		self.traces: List[Trace] = []
+
+
+class LoopMonitor :
+	"""
+	measures event loop lag by how late a periodic tick wakes up. a watchdog thread captures the loop
+	thread's stack whenever a tick is overdue by more than stall seconds, which is whatever is blocking the
+	loop. requests are tracked while they run: each tick captures the await stack of any request that passed
+	the slow threshold, and slow requests are logged when they finish, with their pipeline stage timings and
+	the stalls that happened while they ran. the most recent ones are kept for the admin endpoint.
+	a stall or slow threshold of 0 disables that capture.
+	"""
+
+	logger: Logger = getLogger()
+
+	def __init__(self: 'LoopMonitor', interval: float = 0.1, stall: float = 0.5, slow: float = 5, keep: int = 50) -> None :
+		self.interval: float = interval
+		self.stall: float = stall
+		self.slow: float = slow
+		self.recent: Deque[Dict[str, Any]] = deque(maxlen=keep)
+		self.inflight: Dict[int, RequestCapture] = { }
+		self.loop_thread: Optional[int] = None
+		self._heartbeat: float = perf_counter()
+		self._task: Optional[Task] = None
+		self._stop: Event = Event()
+
+
+	def start(self: 'LoopMonitor') -> None :
+		"""
+		must be called from the event loop's thread.
+		"""
+		self.loop_thread = get_ident()
+		self._heartbeat = perf_counter()
+		self._stop.clear()
+		self._task = ensure_future(self._tick())
+
+		if self.stall :
+			Thread(target=self._watch, name='loop-watchdog', daemon=True).start()
+
+
+	def stop(self: 'LoopMonitor') -> None :
+		self._stop.set()
+
+		if self._task :
+			self._task.cancel()
+
+
+	async def _tick(self: 'LoopMonitor') -> None :
+		while True :
+			start: float = perf_counter()
+			await sleep(self.interval)
+			now: float = perf_counter()
+			LoopLag.observe(max(now - start - self.interval, 0))
+			self._heartbeat = now
+
+			if self.slow :
+				for capture in self.inflight.values() :
+					if capture.stack is None and capture.task and now - capture.start >= self.slow :
+						capture.stack = await_stack(capture.task)
+
+
+	def _watch(self: 'LoopMonitor') -> None :
+		captured: Optional[float] = None
+
+		while not self._stop.wait(self.stall / 2) :
+			heartbeat: float = self._heartbeat
+			blocked: float = perf_counter() - heartbeat - self.interval
+
+			# one capture per stall, however long it lasts
+			if blocked < self.stall or heartbeat == captured :
+				continue
+
+			captured = heartbeat
+			stall: Dict[str, Any] = {
+				'blocked_for_at_least': blocked,
+				'stack': thread_stack(_current_frames().get(self.loop_thread), lines=True),
+			}
+			LoopStalls.inc()
+			self.logger.warning({ 'message': 'event loop stalled.', **stall })
+
+			# the loop is blocked, so the requests in flight can't change underneath this
+			for capture in list(self.inflight.values()) :
+				capture.stalls.append(stall)
+
+
+	@contextmanager
+	def track(self: 'LoopMonitor', route: str) -> Iterator[None] :
+		if not self.slow :
+			yield
+			return
+
+		capture: RequestCapture = RequestCapture(route, current_task())
+		self.inflight[id(capture)] = capture
+		# pipeline traces started within the request register themselves here, so their stages can be reported
+		token = request_traces.set(capture.traces)
+
+		try :
+			yield
+
+		except BaseException as e :
+			capture.error = type(e).__name__
+			raise
+
+		finally :
+			request_traces.reset(token)
+			del self.inflight[id(capture)]
+			elapsed: float = perf_counter() - capture.start
+
+			if elapsed >= self.slow :
+				self._report(capture, elapsed)
+
+
+	def _report(self: 'LoopMonitor', capture: RequestCapture, elapsed: float) -> None :
+		SlowRequests.inc(1, capture.route)
+		record: Dict[str, Any] = {
+			'route': capture.route,
+			'elapsed': elapsed,
+			'error': capture.error,
+			'stages': [{ 'pipeline': trace.pipeline, **stage } for trace in capture.traces for stage in trace.stages],
+			'stack': capture.stack,
+			'stalls': capture.stalls,
+		}
+		self.recent.append(record)
+		self.logger.warning({ 'message': 'slow request.', **record })
+
+
+profiler: SamplingProfiler = SamplingProfiler()
+monitor: LoopMonitor = LoopMonitor(
+	stall=float(environ.get('UPLOADER_LOOP_STALL_SECONDS', 0.5)),
+	slow=float(environ.get('UPLOADER_SLOW_REQUEST_SECONDS', 5)),
+)
+
+
+class MonitoredRoute(APIRoute) :
+	"""
+	tracks every request with the loop monitor. handlers run in the task the endpoint runs in, unlike
+	middleware, which may be separated from it by the tasks other middleware start.
+	"""
+
+	def get_route_handler(self: 'MonitoredRoute') -> Callable :
+		handler: Callable = super().get_route_handler()
+
+		async def monitored(request: Any) -> Any :
+			with monitor.track(self.path) :
+				return await handler(request)
+
+		return monitored
@@ -0,0 +1,125 @@
+from asyncio import ensure_future
+from importlib import import_module
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from kh_common.auth import KhUser
+from lazy import Lazy, lazy_import
+from metrics import Counter, registry
+
+from fuzzly.models.post import PostId, Privacy, Score
+
+
+ScoreReads: Counter = registry.register(Counter('uploader_score_reads_total', 'posts whose score and vote were served by the batch score read, by source.', ('source',)))
+
+KeyValueStore: Lazy = lazy_import('aerospike', 'kh_common.caching.key_value_store', 'KeyValueStore')
+InternalScore: Lazy = lazy_import('fuzzly', 'fuzzly.models.internal', 'InternalScore')
+PostCodec: Lazy = lazy_import('fuzzly', 'cache_codec', 'PostCodec')
+ScoreKVS: Lazy = lazy_import('fuzzly', 'fuzzly.models.internal', 'ScoreCache')
+VoteKVS: Lazy = lazy_import('fuzzly', 'fuzzly.models.internal', 'VoteCache')
+PostCache: Lazy = Lazy('aerospike', lambda : import_module('batch_cache').BatchCache(KeyValueStore('kheina', 'posts')))
+ScoreCache: Lazy = Lazy('aerospike', lambda : import_module('batch_cache').BatchCache(ScoreKVS))
+VoteCache: Lazy = Lazy('aerospike', lambda : import_module('batch_cache').BatchCache(VoteKVS))
+get_many_across: Lazy = lazy_import('aerospike', 'batch_cache', 'get_many_across')
+
+
+def _user_vote(upvote: Optional[bool]) -> int :
+	return 0 if upvote is None else (1 if upvote else -1)
+
+
+def _visible(post: Any, user_id: Optional[int]) -> bool :
+	return post.privacy == Privacy.public or (user_id is not None and post.user_id == user_id)
+
+
+class BatchScores :
+	"""
+	reads the scores of many posts, with the user's vote on each, for feed pages. posts, scores and votes are
+	read from their caches in a single aerospike call, anything missing from any of them is read from postgres
+	in a single query, and the score and vote caches are backfilled with one batch write per set in the background.
+	only public posts, and the user's own, are returned, whether they were cached or not. posts without a
+	score row, such as unpublished ones, are left out.
+	"""
+
+	async def _select_scores(self: 'BatchScores', user_id: Optional[int], post_ids: List[PostId]) -> List[Tuple[int, int, int, Optional[bool]]] :
+		return await self.async_query("""
+			SELECT post_scores.post_id, post_scores.upvotes, post_scores.downvotes, post_votes.upvote
+			FROM kheina.public.post_scores
+				INNER JOIN kheina.public.posts
+					ON posts.post_id = post_scores.post_id
+				LEFT JOIN kheina.public.post_votes
+					ON post_votes.post_id = post_scores.post_id
+						AND post_votes.user_id = %s
+			WHERE post_scores.post_id = any(%s)
+				AND (posts.privacy_id = privacy_to_id('public') OR posts.uploader = %s);
+			""",
+			(user_id, [post_id.int() for post_id in post_ids], user_id),
+			fetch_all=True,
+		) or []
+
+
+	async def _backfill_scores(self: 'BatchScores', scores: Dict[str, Any], votes: Dict[str, int]) -> None :
+		try :
+			await ScoreCache.put_many(scores)
+			await VoteCache.put_many(votes)
+
+		except Exception as e :
+			self.logger.warning(f'failed to backfill {len(scores)} cached scores and {len(votes)} votes.', exc_info=e)
+
+
+	async def scores_many(self: 'BatchScores', user: KhUser, post_ids: Iterable[PostId]) -> Dict[PostId, Score] :
+		post_ids = list(dict.fromkeys(post_ids))
+		# anonymous users have no votes, so only scores are read for them
+		voter: Optional[int] = user.user_id if user.token else None
+		vote_keys: Dict[PostId, str] = { post_id: f'{voter}|{post_id}' for post_id in post_ids } if voter is not None else { }
+
+		try :
+			posts, scores, votes = await get_many_across([(PostCache, post_ids), (ScoreCache, post_ids), (VoteCache, vote_keys.values())])
+
+		except Exception as e :
+			self.logger.warning(f'failed to read {len(post_ids)} cached scores.', exc_info=e)
+			posts, scores, votes = { }, { }, { }
+
+		visible: Set[PostId] = set()
+		missing: List[PostId] = []
+
+		for post_id in post_ids :
+			# a post the cache can't decode, packed by another version of the codec, is read from postgres like a miss
+			post: Optional[Any] = PostCodec.load(posts.get(post_id))
+
+			if post is None or scores.get(post_id) is None or (voter is not None and votes.get(vote_keys[post_id]) is None) :
+				missing.append(post_id)
+
+			elif _visible(post, voter) :
+				visible.add(post_id)
+
+		ScoreReads.inc(len(post_ids) - len(missing), 'cache')
+
+		if missing :
+			ScoreReads.inc(len(missing), 'database')
+			backfill_scores: Dict[str, Any] = { }
+			backfill_votes: Dict[str, int] = { }
+
+			for post_id, up, down, upvote in await self._select_scores(voter, missing) :
+				post_id: PostId = PostId(post_id)
+				visible.add(post_id)
+				backfill_scores[post_id] = scores[post_id] = InternalScore(up=up, down=down, total=up + down)
+
+				if voter is not None :
+					backfill_votes[vote_keys[post_id]] = votes[vote_keys[post_id]] = _user_vote(upvote)
+
+			ensure_future(self._backfill_scores(backfill_scores, backfill_votes))
+
+		results: Dict[PostId, Score] = { }
+
+		for post_id in post_ids :
+			if post_id not in visible :
+				continue
+
+			score: Any = scores[post_id]
+			results[post_id] = Score(
+				up = score.up,
+				down = score.down,
+				total = score.total,
+				user_vote = (votes.get(vote_keys[post_id]) or 0) if voter is not None else 0,
+			)
+
+		return results
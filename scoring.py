@@ -5,7 +5,6 @@ from typing import Optional, Union
 from kh_common.auth import KhUser
 from kh_common.config.constants import epoch
 from kh_common.exceptions.http_error import BadRequest
-from scipy.stats import norm
 
 from fuzzly.models._database import DBI, ScoreCache, VoteCache
 from fuzzly.models.internal import InternalScore
@@ -22,8 +21,9 @@ resources:
 """
 
 
-# this is the z-score of 0.8, z is calulated via: norm.ppf(1-(1-0.8)/2)
-z_score_08 = norm.ppf(0.9)
+# this is the z-score of 0.8, z is calulated via: scipy.stats.norm.ppf(1-(1-0.8)/2)
+# it's a constant, so it's inlined rather than importing scipy at startup
+z_score_08 = 1.2815515655446004
 
 
 def _sign(x: Union[int, float]) -> int :
@@ -75,7 +75,8 @@ class Scoring(DBI) :
 				(%s, %s, %s)
 				ON CONFLICT ON CONSTRAINT post_votes_pkey DO 
 					UPDATE SET
-						upvote = %s
+						upvote = %s,
+						updated_on = NOW()
 					WHERE post_votes.user_id = %s
 						AND post_votes.post_id = %s;
 
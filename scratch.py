@@ -0,0 +1,169 @@
+from logging import Logger
+from mmap import ACCESS_READ, mmap
+from os import environ, fsdecode, fsencode, getpid, kill, listdir, makedirs, path, remove
+from time import time
+from typing import Optional
+from uuid import uuid4
+
+from admission import WeightedAdmission
+from kh_common.logging import getLogger
+from metrics import Gauge, registry
+
+
+ScratchBytes: Gauge = registry.register(Gauge('uploader_scratch_bytes', 'scratch space reserved by in flight uploads.'))
+ScratchOrphans: Gauge = registry.register(Gauge('uploader_scratch_orphans_removed', 'orphaned scratch files removed by the last startup sweep.'))
+DefaultRoot: str = '/dev/shm/uploader' if path.isdir('/dev/shm') else 'images'
+
+
+class ScratchFile :
+	"""
+	a temporary file written exactly once. tools that can read a file (exiftool, ImageMagick) use path,
+	everything else reads through a single read only mmap, opened the first time it is needed.
+	"""
+
+	def __init__(self: 'ScratchFile', space: 'ScratchSpace', file_path: bytes, weight: int) -> None :
+		self.path: bytes = file_path
+		self._space: ScratchSpace = space
+		self._weight: int = weight
+		self._file = None
+		self._view: Optional[mmap] = None
+
+
+	def view(self: 'ScratchFile') -> mmap :
+		# mapped lazily, since exiftool rewrites the file in place after it's written
+		if self._view is None :
+			self._file = open(self.path, 'rb')
+			self._view = mmap(self._file.fileno(), 0, access=ACCESS_READ)
+
+		return self._view
+
+
+	@property
+	def filename(self: 'ScratchFile') -> str :
+		return fsdecode(self.path)
+
+
+	def read(self: 'ScratchFile') -> bytes :
+		"""
+		copies the whole file, so it's only for callers that need bytes, like uploads. use filename or view otherwise.
+		"""
+		return self.view()[:]
+
+
+	def close(self: 'ScratchFile') -> None :
+		if self._view is not None :
+			self._view.close()
+			self._file.close()
+			self._view = self._file = None
+
+		if self._weight :
+			try :
+				remove(self.path)
+
+			except FileNotFoundError :
+				self._space.logger.exception(f'failed to delete scratch file, as it does not exist. path: {self.path}')
+
+			self._space._release(self._weight)
+			self._weight = 0
+
+
+class ScratchSpace :
+	"""
+	hands out temporary files under root, which should be a tmpfs mount. the bytes held by live
+	files are capped at quota using admission control, so a burst of large uploads waits for space
+	rather than filling the disk. file names start with the owning pid, so files left behind by
+	workers that crashed can be recognized and swept when a new worker starts.
+
+	configured with UPLOADER_SCRATCH_DIR and UPLOADER_SCRATCH_QUOTA (bytes).
+	"""
+
+	def __init__(
+		self: 'ScratchSpace',
+		root: Optional[str] = None,
+		quota: Optional[int] = None,
+		max_waiters: int = 32,
+		deadline: float = 15,
+		orphan_age: float = 3600,
+	) -> None :
+		self.logger: Logger = getLogger()
+		self.root: str = root or environ.get('UPLOADER_SCRATCH_DIR', DefaultRoot)
+		self.orphan_age: float = orphan_age
+		self.admission: WeightedAdmission = WeightedAdmission(
+			capacity = quota or int(environ.get('UPLOADER_SCRATCH_QUOTA', 2**30)),
+			max_waiters = max_waiters,
+			deadline = deadline,
+		)
+		makedirs(self.root, exist_ok=True)
+
+
+	async def write(self: 'ScratchSpace', filename: str, data: bytes) -> ScratchFile :
+		"""
+		reserves space for, and writes, data to a new scratch file. the caller must close the returned file.
+		raises AdmissionRejected if space doesn't free up in time.
+		"""
+		# exiftool writes a stripped copy next to the original before replacing it, so reserve room for both
+		weight: int = await self.admission.acquire(len(data) * 2)
+		ScratchBytes.set(self.admission.in_use)
+		# only the extension is kept, so the path never holds anything ImageMagick would read as a format prefix or frame selector
+		extension: str = path.splitext(filename)[1].lower()
+		extension = extension if extension[1:].isalnum() else ''
+		file_path: bytes = fsencode(path.join(self.root, f'{getpid()}_{uuid4().hex}{extension}'))
+
+		try :
+			with open(file_path, 'xb') as file :
+				file.write(data)
+
+		except :
+			self._release(weight)
+			raise
+
+		return ScratchFile(self, file_path, weight)
+
+
+	def _release(self: 'ScratchSpace', weight: int) -> None :
+		self.admission.release(weight)
+		ScratchBytes.set(self.admission.in_use)
+
+
+	def _orphaned(self: 'ScratchSpace', name: str, now: float) -> bool :
+		pid: str = name.split('_', 1)[0]
+
+		if not pid.isdigit() or int(pid) == getpid() :
+			return False
+
+		try :
+			kill(int(pid), 0)
+
+		except ProcessLookupError :
+			return True
+
+		except PermissionError :
+			# the pid belongs to another user's process, so it has been reused
+			return True
+
+		# a live process may have reused the pid, so fall back to age
+		return now - path.getmtime(path.join(self.root, name)) > self.orphan_age
+
+
+	def sweep(self: 'ScratchSpace') -> int :
+		"""
+		removes files left behind by workers that are no longer running, returns how many were removed.
+		"""
+		now: float = time()
+		removed: int = 0
+
+		for name in listdir(self.root) :
+			try :
+				if self._orphaned(name, now) :
+					remove(path.join(self.root, name))
+					removed += 1
+
+			except FileNotFoundError :
+				pass
+
+		ScratchOrphans.set(removed)
+
+		if removed :
+			self.logger.info(f'removed {removed} orphaned scratch files from {self.root}.')
+
+		return removed
@@ -1,9 +1,19 @@
-from typing import Dict, List, Optional, Union
+from asyncio import Task, ensure_future, get_running_loop
+from hashlib import sha256
+from importlib import import_module
+from os import environ
+from typing import Any, Awaitable, BinaryIO, Callable, Dict, List, Optional, Tuple, Union
 
-from fastapi import File, Form, UploadFile
-from fastapi.responses import UJSONResponse
+from admission import AdmissionRejected, WeightedAdmission
+from fastapi import File, Form, Query, UploadFile
+from fastapi.responses import PlainTextResponse, UJSONResponse
+from hot_refresh import run_hot_refresh
+from kh_common.models.auth import Scope
 from kh_common.server import NoContentResponse, Request, ServerApp
-from models import CreateRequest, IconRequest, PrivacyRequest, UpdateRequest
+from lazy import Lazy, configured_subsystems, warm_up
+from metrics import Trace, registry
+from models import BatchPrivacyRequest, BatchUpdateRequest, CreateRequest, IconRequest, PrivacyRequest, ScoresRequest, UpdateRequest
+from profiler import MonitoredRoute, monitor, profiler
 
 from fuzzly.models.post import PostId
 from uploader import Uploader
@@ -28,12 +38,78 @@ app = ServerApp(
 		'fuzz.ly',
 	],
 )
-uploader = Uploader()
+# every route declared below is tracked by the loop monitor, for the slow request capture
+app.router.route_class = MonitoredRoute
+# connects to postgres and authorizes with b2, so it is built during warm up or by the first request that needs it
+uploader: Lazy = Lazy('uploader', Uploader)
+# seconds between hot rank refreshes, 0 disables them on this worker
+hot_refresh_interval: float = float(environ.get('UPLOADER_HOT_REFRESH_INTERVAL', 900))
+hot_refresh_task: Optional[Task] = None
+# retried uploads and post creations carrying an Idempotency-Key header are answered from here
+idempotency: Lazy = Lazy('aerospike', lambda : import_module('idempotency').Idempotency())
+
+# image work is admitted by decoded pixel count, so a burst of large uploads queues instead of driving the worker into swap
+image_admission = WeightedAdmission(
+	capacity = 100_000_000,
+	max_waiters = 32,
+	deadline = 15,
+)
+# icons and banners are charged at least this much, since the full source image is decoded before cropping
+min_crop_weight: int = 4_000_000
+
+
+def overloaded(e: AdmissionRejected) -> UJSONResponse :
+	return UJSONResponse(
+		{ 'status': 503, 'error': f'ServiceUnavailable: {e}' },
+		status_code=503,
+		headers={ 'Retry-After': str(e.retry_after) },
+	)
+
+
+def _file_digest(file: BinaryIO) -> str :
+	digest = sha256()
+
+	for chunk in iter(lambda : file.read(2**20), b'') :
+		digest.update(chunk)
+
+	file.seek(0)
+	return digest.hexdigest()
+
+
+async def idempotent(req: Request, endpoint: str, fingerprint: Callable[[], Tuple], func: Callable[[], Awaitable[Any]]) -> Any :
+	"""
+	runs func once per Idempotency-Key header, or every time if the request doesn't have one.
+	"""
+	key: Optional[str] = req.headers.get('idempotency-key')
+
+	if not key :
+		return await func()
+
+	return await idempotency.run(endpoint, req.user.user_id, key, idempotency.fingerprint(*fingerprint()), func)
+
+
+@app.on_event('startup')
+async def startup() :
+	global hot_refresh_task
+	warm_up(configured_subsystems())
+	monitor.start()
+
+	if hot_refresh_interval :
+		hot_refresh_task = ensure_future(run_hot_refresh(uploader, hot_refresh_interval))
 
 
 @app.on_event('shutdown')
 async def shutdown() :
-	uploader.close()
+	monitor.stop()
+
+	if hot_refresh_task :
+		hot_refresh_task.cancel()
+
+	if uploader.loaded :
+		uploader.stop_cleanup_retries()
+		uploader.close_image_pool()
+		uploader.close()
+		await uploader.close_pool()
 
 
 @app.post('/v1/create_post')
@@ -43,26 +119,30 @@ async def v1CreatePost(req: Request, body: CreateRequest) :
 	"""
 	await req.user.authenticated()
 
-	if any(body.dict().values()) :
-		return await uploader.createPostWithFields(
-			req.user,
-			body.reply_to,
-			body.title,
-			body.description,
-			body.privacy,
-			body.rating,
-		)
+	async def create() :
+		if any(body.dict().values()) :
+			return await uploader.createPostWithFields(
+				req.user,
+				body.reply_to,
+				body.title,
+				body.description,
+				body.privacy,
+				body.rating,
+			)
+
+		return await uploader.createPost(req.user)
 
-	return await uploader.createPost(req.user)
+	return await idempotent(req, 'create_post', lambda : (body.dict(),), create)
 
 
 @app.post('/v1/upload_image')
-async def v1UploadImage(req: Request, file: UploadFile = File(None), post_id: PostId = Form(None), web_resize: Optional[int] = Form(None)) :
+async def v1UploadImage(req: Request, file: UploadFile = File(None), post_id: PostId = Form(None), web_resize: Optional[int] = Form(None), emoji_name: Optional[str] = Form(None)) :
 	"""
 	FORMDATA: {
 		"post_id": Optional[str],
 		"file": image file,
 		"web_resize": Optional[bool],
+		"emoji_name": Optional[str],
 	}
 	"""
 	await req.user.authenticated()
@@ -93,13 +173,41 @@ async def v1UploadImage(req: Request, file: UploadFile = File(None), post_id: Po
 	if detail :
 		return UJSONResponse({ 'detail': detail }, status_code=422)
 
-	return await uploader.uploadImage(
-		user=req.user,
-		file_data=file.file.read(),
-		filename=file.filename,
-		post_id=PostId(post_id),
-		web_resize=web_resize,
-	)
+	async def upload() :
+		async with image_admission.admit(uploader.probe_pixels(file.file)) :
+			with Trace('upload_image') :
+				return await uploader.uploadImage(
+					user=req.user,
+					file_data=file.file.read(),
+					filename=file.filename,
+					post_id=PostId(post_id),
+					emoji_name=emoji_name,
+					web_resize=web_resize,
+				)
+
+	try :
+		# retries are joined before admission, so they don't queue for capacity the original request already holds
+		return await idempotent(req, 'upload_image', lambda : (PostId(post_id), file.filename, web_resize, emoji_name, _file_digest(file.file)), upload)
+
+	except AdmissionRejected as e :
+		return overloaded(e)
+
+
+@app.post('/v1/import_emoji_pack')
+async def v1ImportEmojiPack(req: Request, file: UploadFile = File(...)) :
+	"""
+	FORMDATA: {
+		"file": zip archive of images, each named {emoji}.{extension},
+	}
+	"""
+	await req.user.authenticated()
+
+	try :
+		with Trace('import_emoji_pack') :
+			return await uploader.importEmojiPack(req.user, file.file, image_admission)
+
+	except AdmissionRejected as e :
+		return overloaded(e)
 
 
 @app.post('/v1/update_post')
@@ -138,20 +246,116 @@ async def v1UpdatePrivacy(req: Request, body: PrivacyRequest) :
 		return NoContentResponse
 
 
+@app.post('/v1/update_post_batch')
+async def v1UpdatePostBatch(req: Request, body: BatchUpdateRequest) :
+	"""
+	{
+		"posts": [
+			{
+				"post_id": str,
+				"title": Optional[str],
+				"description": Optional[str],
+				"rating": Optional[str],
+				"privacy": Optional[str]
+			}
+		]
+	}
+	"""
+	await req.user.authenticated()
+	return await uploader.updatePostMetadataBatch(req.user, body.posts)
+
+
+@app.post('/v1/update_privacy_batch')
+async def v1UpdatePrivacyBatch(req: Request, body: BatchPrivacyRequest) :
+	"""
+	{
+		"posts": [
+			{
+				"post_id": str,
+				"privacy": str
+			}
+		]
+	}
+	"""
+	await req.user.authenticated()
+	return await uploader.updatePrivacyBatch(req.user, body.posts)
+
+
 @app.post('/v1/set_icon')
 async def v1SetIcon(req: Request, body: IconRequest) :
 	await req.user.authenticated()
-	await uploader.setIcon(req.user, body.post_id, body.coordinates)
+
+	try :
+		async with image_admission.admit(max(body.coordinates.width * body.coordinates.height, min_crop_weight)) :
+			with Trace('set_icon') :
+				await uploader.setIcon(req.user, body.post_id, body.coordinates)
+
+	except AdmissionRejected as e :
+		return overloaded(e)
+
 	return NoContentResponse
 
 
 @app.post('/v1/set_banner')
 async def v1SetBanner(req: Request, body: IconRequest) :
 	await req.user.authenticated()
-	await uploader.setBanner(req.user, body.post_id, body.coordinates)
+
+	try :
+		async with image_admission.admit(max(body.coordinates.width * body.coordinates.height, min_crop_weight)) :
+			with Trace('set_banner') :
+				await uploader.setBanner(req.user, body.post_id, body.coordinates)
+
+	except AdmissionRejected as e :
+		return overloaded(e)
+
 	return NoContentResponse
 
 
+@app.post('/v1/scores')
+async def v1Scores(req: Request, body: ScoresRequest) :
+	"""
+	{
+		"post_ids": [str]
+	}
+	returns { post_id: { "up": int, "down": int, "total": int, "user_vote": int } }, leaving out posts that have no score
+	and posts the requester can't see, which is any post that isn't public or their own. user_vote is always 0 for anonymous requests.
+	"""
+	return await uploader.scores_many(req.user, body.post_ids)
+
+
+@app.get('/v1/admin/profile')
+async def v1Profile(req: Request, seconds: float = Query(10), interval: float = Query(0.005), loop_only: bool = Query(False)) :
+	"""
+	samples this worker's stacks for the given number of seconds, returned in collapsed format for flamegraph.pl or speedscope.
+	only the event loop's thread is sampled when loop_only is set.
+	"""
+	await req.user.verify_scope(Scope.admin)
+	stacks: str = await get_running_loop().run_in_executor(
+		None,
+		profiler.profile,
+		seconds,
+		interval,
+		monitor.loop_thread if loop_only else None,
+	)
+	return PlainTextResponse(stacks)
+
+
+@app.get('/v1/admin/slow_requests')
+async def v1SlowRequests(req: Request) :
+	"""
+	the most recent requests on this worker that were slower than UPLOADER_SLOW_REQUEST_SECONDS, newest first.
+	"""
+	await req.user.verify_scope(Scope.admin)
+	return list(reversed(monitor.recent))
+
+
+@app.get('/metrics')
+async def metrics(req: Request) :
+	# scrapers authenticate with an internal token, which includes the admin scope
+	await req.user.verify_scope(Scope.admin)
+	return PlainTextResponse(registry.render(), media_type='text/plain; version=0.0.4')
+
+
 if __name__ == '__main__' :
 	from uvicorn.main import run
 	run(app, host='0.0.0.0', port=5001)
@@ -1,72 +1,87 @@
 from asyncio import Task, ensure_future
 from datetime import datetime
 from enum import Enum
-from io import BytesIO
-from os import makedirs, path, remove
+from importlib import import_module
 from secrets import token_bytes
 from time import time
-from typing import Any, Dict, List, Optional, Set, Tuple, Union
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
 from urllib.parse import quote
 from uuid import UUID, uuid4
-from subprocess import PIPE, Popen
 
-import aerospike
 from aiohttp import ClientResponseError, request
-from exiftool import ExifTool
+from async_sql import AsyncSqlInterface, AsyncTransaction
+from cleanup import B2Cleanup
+from emoji import Emojis
+from hot_refresh import HotRefresh
+from imaging import Image, ImageProcessor
 from kh_common.auth import KhUser
 from kh_common.backblaze import B2Interface
-from kh_common.caching.key_value_store import KeyValueStore
 from kh_common.config.credentials import fuzzly_client_token
 from kh_common.exceptions.http_error import BadGateway, BadRequest, Forbidden, HttpErrorHandler, InternalServerError, NotFound
-from kh_common.sql import SqlInterface, Transaction
-from kh_common.utilities import flatten, int_from_bytes
-from models import Coordinates
-from scoring import confidence
-from scoring import controversial as calc_cont
-from scoring import hot as calc_hot
-from wand.image import Image
-from kh_common.base64 import b64decode, b64encode
-
-from fuzzly.internal import InternalClient
-from fuzzly.models.internal import InternalPost, InternalUser, UserKVS, VoteCache
-from fuzzly.models.post import MediaType, Post, PostId, PostSize, Privacy, Rating
-from fuzzly.models.tag import TagGroups
-
-
-KVS: KeyValueStore = KeyValueStore('kheina', 'posts')
-CountKVS: KeyValueStore = KeyValueStore('kheina', 'tag_count')
+from kh_common.sql import SqlInterface
+from kh_common.utilities import int_from_bytes
+from lazy import Lazy, lazy_import
+from metrics import count_in, count_out, stage
+from models import Coordinates, PrivacyRequest, UpdateRequest
+from scores import BatchScores
+from scratch import ScratchFile, ScratchSpace
+from versioning import VersionedMedia, content_version, media_prefix, media_version, settings_version
+
+from fuzzly.models.post import PostId, PostSize, Privacy, Rating
+
+
+# everything below connects to, or spawns, something when loaded, so it is deferred until first use or warm_up
+aerospike: Lazy = lazy_import('aerospike', 'aerospike')
+KeyValueStore: Lazy = lazy_import('aerospike', 'kh_common.caching.key_value_store', 'KeyValueStore')
+ExifTool: Lazy = lazy_import('exiftool', 'exiftool', 'ExifTool')
+confidence: Lazy = lazy_import('scoring', 'scoring', 'confidence')
+calc_cont: Lazy = lazy_import('scoring', 'scoring', 'controversial')
+calc_hot: Lazy = lazy_import('scoring', 'scoring', 'hot')
+InternalPost: Lazy = lazy_import('fuzzly', 'fuzzly.models.internal', 'InternalPost')
+InternalUser: Lazy = lazy_import('fuzzly', 'fuzzly.models.internal', 'InternalUser')
+UserKVS: Lazy = lazy_import('fuzzly', 'fuzzly.models.internal', 'UserKVS')
+VoteCache: Lazy = lazy_import('fuzzly', 'fuzzly.models.internal', 'VoteCache')
+PostCodec: Lazy = lazy_import('fuzzly', 'cache_codec', 'PostCodec')
+
+KVS: Lazy = Lazy('aerospike', lambda : KeyValueStore('kheina', 'posts'))
+CountKVS: Lazy = Lazy('aerospike', lambda : KeyValueStore('kheina', 'tag_count'))
+PostCache: Lazy = Lazy('aerospike', lambda : import_module('batch_cache').BatchCache(KVS))
+CountCache: Lazy = Lazy('aerospike', lambda : import_module('batch_cache').BatchCache(CountKVS))
+UserCache: Lazy = Lazy('aerospike', lambda : import_module('batch_cache').BatchCache(UserKVS))
 UnpublishedPrivacies: Set[Privacy] = { Privacy.unpublished, Privacy.draft }
-client: InternalClient = InternalClient(fuzzly_client_token)
+client: Lazy = Lazy('fuzzly', lambda : import_module('fuzzly.internal').InternalClient(fuzzly_client_token))
 
 
-if not path.isdir('images') :
-	makedirs('images')
+class CountKind(Enum) :
+	# what a counter in the tag_count set counts, which can't be told from its key: tags may share a rating's name
+	total = 'total'  # '_', every public post
+	user = 'user'  # '@{user_id}', a user's public posts
+	rating = 'rating'  # a rating's name
+	tag = 'tag'
 
 
-class Uploader(SqlInterface, B2Interface) :
+# added to each sql interface's own defaults
+SqlConversions: Dict[type, Callable] = {
+	Enum: lambda x: x.name,
+}
+
+
+class Uploader(SqlInterface, AsyncSqlInterface, B2Interface, B2Cleanup, VersionedMedia, HotRefresh, BatchScores, Emojis, ImageProcessor) :
 
 	def __init__(self: 'Uploader') -> None :
 		SqlInterface.__init__(
 			self,
-			conversions={
-				Enum: lambda x: x.name,
-			},
+			conversions=SqlConversions,
 		)
+		AsyncSqlInterface.__init__(self, max_connections=10, conversions=SqlConversions)
 		B2Interface.__init__(self, max_retries=5)
-		self.thumbnail_sizes: List[int] = [
-			# the length of the longest side, in pixels
-			100,
-			200,
-			400,
-			800,
-			1200,
-		]
-		self.web_size: int = 1500
-		self.emoji_size: int = 256
-		self.icon_size: int = 400
-		self.banner_size: int = 600
-		self.output_quality: int = 85
-		self.filter_function: str = 'catrom'
+		B2Cleanup.__init__(self, concurrency=8)
+		VersionedMedia.__init__(self)
+		HotRefresh.__init__(self, chunk_size=500)
+		Emojis.__init__(self, upload_concurrency=16)
+		ImageProcessor.__init__(self)
+		self.scratch: ScratchSpace = ScratchSpace()
+		self.scratch.sweep()
 
 
 	def _convert_item(self: 'SqlInterface', item: Any) -> Any :
@@ -76,141 +91,138 @@ class Uploader(SqlInterface, B2Interface) :
 		return item
 
 
-	async def _populate_tag_cache(self, tag: str) -> None :
-		if not await CountKVS.exists_async(tag) :
-			# we gotta populate it here (sad)
-			data = await self.query_async("""
-				SELECT COUNT(1)
-				FROM kheina.public.tags
-					INNER JOIN kheina.public.tag_post
-						ON tags.tag_id = tag_post.tag_id
-					INNER JOIN kheina.public.posts
-						ON tag_post.post_id = posts.post_id
-							AND posts.privacy_id = privacy_to_id('public')
-				WHERE tags.tag = %s;
-				""",
-				(tag,),
-				fetch_one=True,
-			)
-			await CountKVS.put_async(tag, int(data[0]), -1)
-
-
-	async def _get_tag_count(self, tag: str) -> int :
-		await self._populate_tag_cache(tag)
-		return await CountKVS.get_async(tag)
-
-
-	async def _increment_total_post_count(self, value: int = 1) -> None :
-		if not await CountKVS.exists_async('_') :
-			# we gotta populate it here (sad)
-			data = await self.query_async("""
+	def _count_query(self: 'Uploader', kind: CountKind, key: str) -> Tuple[str, Tuple] :
+		if kind == CountKind.total :
+			return """
 				SELECT COUNT(1)
 				FROM kheina.public.posts
 				WHERE posts.privacy_id = privacy_to_id('public');
-				""",
-				fetch_one=True,
-			)
-			await CountKVS.put_async('_', int(data[0]) + value, -1)
+				""", ()
 
-		else :
-			KeyValueStore._client.increment(
-				(CountKVS._namespace, CountKVS._set, '_'),
-				'data',
-				value,
-				meta={
-					'ttl': -1,
-				},
-				policy={
-					'max_retries': 3,
-				},
-			)
-
-
-	async def _increment_user_count(self, user_id: int, value: int = 1) -> None :
-		if not await CountKVS.exists_async(f'@{user_id}') :
-			# we gotta populate it here (sad)
-			data = await self.query_async("""
+		if kind == CountKind.user :
+			return """
 				SELECT COUNT(1)
 				FROM kheina.public.posts
 				WHERE posts.uploader = %s
 					AND posts.privacy_id = privacy_to_id('public');
-				""",
-				(user_id,),
-				fetch_one=True,
-			)
-			await CountKVS.put_async('_', int(data[0]) + value, -1)
+				""", (int(key[1:]),)
 
-		else :
-			KeyValueStore._client.increment(
-				(CountKVS._namespace, CountKVS._set, f'@{user_id}'),
-				'data',
-				value,
-				meta={
-					'ttl': -1,
-				},
-				policy={
-					'max_retries': 3,
-				},
-			)
-
-
-	async def _increment_rating_count(self, rating: Rating, value: int = 1) -> None :
-		if not await CountKVS.exists_async(rating.name) :
-			# we gotta populate it here (sad)
-			data = await self.query_async("""
+		if kind == CountKind.rating :
+			return """
 				SELECT COUNT(1)
 				FROM kheina.public.posts
 				WHERE posts.rating = rating_to_id(%s)
 					AND posts.privacy_id = privacy_to_id('public');
-				""",
-				(rating,),
-				fetch_one=True,
-			)
-			await CountKVS.put_async('_', int(data[0]) + value, -1)
+				""", (key,)
 
-		else :
-			KeyValueStore._client.increment(
-				(CountKVS._namespace, CountKVS._set, rating.name),
-				'data',
-				value,
-				meta={
-					'ttl': -1,
-				},
-				policy={
-					'max_retries': 3,
-				},
-			)
+		return """
+			SELECT COUNT(1)
+			FROM kheina.public.tags
+				INNER JOIN kheina.public.tag_post
+					ON tags.tag_id = tag_post.tag_id
+				INNER JOIN kheina.public.posts
+					ON tag_post.post_id = posts.post_id
+						AND posts.privacy_id = privacy_to_id('public')
+			WHERE tags.tag = %s;
+			""", (key,)
 
 
-	async def _increment_tag_count(self, tag: str, value: int = 1) -> None :
-		await self._populate_tag_cache(tag)
-		KeyValueStore._client.increment(
-			(CountKVS._namespace, CountKVS._set, tag),
-			'data',
-			value,
-			meta={
-				'ttl': -1,
-			},
-			policy={
-				'max_retries': 3,
-			},
-		)
+	async def _populate_count(self: 'Uploader', kind: CountKind, key: str, value: int = 0) -> int :
+		# we gotta populate it here (sad)
+		data = await self.async_query(*self._count_query(kind, key), fetch_one=True)
+		count: int = int(data[0]) + value
+
+		if await CountCache.create(key, count) :
+			return count
 
+		# another request populated it first, so apply the change on top of theirs
+		return await CountCache.increment(key, value)
 
-	async def kvs_get(self: 'Uploader', post_id: PostId) -> Optional[InternalPost] :
+
+	async def _get_tag_count(self: 'Uploader', tag: str) -> int :
 		try :
-			return await KVS.get_async(post_id)
+			return await CountKVS.get_async(tag)
 
 		except aerospike.exception.RecordNotFound :
-			return None
+			return await self._populate_count(CountKind.tag, tag)
 
 
-	def delete_file(self: 'Uploader', path: str) :
-		try :
-			remove(path)
+	async def _increment_counts(self: 'Uploader', deltas: Dict[Tuple[CountKind, str], int]) -> None :
+		"""
+		applies every counter change in one aerospike batch. only counters that aren't cached yet fall back to the database.
+		"""
+		kinds: Dict[str, CountKind] = { key: kind for kind, key in deltas }
+		values: Dict[str, int] = { key: value for (_, key), value in deltas.items() if value }
+
+		if not values :
+			return
+
+		counts: Dict[str, Optional[int]] = await CountCache.increment_many(values)
+
+		for key, count in counts.items() :
+			if count is None :
+				await self._populate_count(kinds[key], key, values[key])
+
+
+	async def _patch_cached_post(self: 'Uploader', post_id: PostId, changes: Dict[str, Any]) -> None :
+		# only a post that's already cached is patched, a miss is left for the next read to populate
+		cached: Any = (await PostCache.get_many([post_id]))[post_id]
+
+		if cached is None :
+			return
+
+		if isinstance(cached, bytes) :
+			patched: Optional[bytes] = PostCodec.patch(cached, changes)
+
+			if patched is None :
+				# packed by another version of the codec
+				await PostCache.remove(post_id)
+				return
+
+			await KVS.put_async(post_id, patched)
+
+		else :
+			# trusted data straight from the cache, so the changes are applied without validating the whole post again
+			await KVS.put_async(post_id, PostCodec.dump(cached.copy(update=changes)))
+
+
+	def _upload_derivative(self: 'Uploader', data: bytes, url: str, content_type: str, derivative: str, immutable: bool = True) -> None :
+		# only keys that include a content version are immutable, fixed keys like emojis are overwritten in place
+		with stage(f'upload.{derivative}') :
+			if immutable :
+				self.b2_upload_immutable(data, url, content_type)
+
+			else :
+				self.b2_upload(data, url, content_type=content_type)
+
+		count_out(derivative, len(data))
+
+
+	def _upload_media(self: 'Uploader', data: bytes, legacy_url: str, versioned_url: Optional[str], content_type: str, derivative: str) -> str :
+		# readers still build unversioned urls, so the legacy key is always written, and overwritten in place
+		self._upload_derivative(data, legacy_url, content_type, derivative, immutable=False)
+
+		if not versioned_url :
+			return legacy_url
+
+		self._upload_derivative(data, versioned_url, content_type, derivative)
+		return versioned_url
 
-		except FileNotFoundError :
-			self.logger.exception(f'failed to delete local file, as it does not exist. path: {path}')
+
+	async def _media_path(self: 'Uploader', post_id: PostId) -> str :
+		data: Optional[Tuple[Optional[str], Optional[str]]] = await self.async_query("""
+			SELECT posts.filename, posts.media_version
+			FROM kheina.public.posts
+			WHERE posts.post_id = %s;
+			""",
+			(post_id.int(),),
+			fetch_one=True,
+		)
+
+		if not data or not data[0] :
+			raise BadRequest('the given post does not have an image.', logdata={ 'post_id': post_id })
+
+		return media_prefix(post_id, data[1]) + quote(data[0])
 
 
 	def _validateTitle(self: 'Uploader', title: str) :
@@ -225,31 +237,35 @@ class Uploader(SqlInterface, B2Interface) :
 
 	@HttpErrorHandler('creating new post')
 	async def createPost(self: 'Uploader', user: KhUser) -> Dict[str, Union[str, int]] :
-		with self.transaction() as transaction :
+		async with self.async_transaction() as transaction :
 			post_id: int
 
 			while True :
 				post_id = int_from_bytes(token_bytes(6))
-				data = transaction.query("SELECT count(1) FROM kheina.public.posts WHERE post_id = %s;", (post_id,), fetch_one=True)
+				data = await transaction.query("SELECT count(1) FROM kheina.public.posts WHERE post_id = %s;", (post_id,), fetch_one=True)
 				if not data[0] :
 					break
 
-			data: List[str] = transaction.query("""
+			await transaction.query("""
 				INSERT INTO kheina.public.posts
 				(post_id, uploader, privacy_id)
 				VALUES
 				(%s, %s, privacy_to_id('unpublished'))
 				ON CONFLICT (uploader, privacy_id) WHERE privacy_id = 4 DO NOTHING;
+				""",
+				(post_id, user.user_id),
+			)
 
+			data: List[str] = await transaction.query("""
 				SELECT post_id FROM kheina.public.posts
 				WHERE uploader = %s
 					AND privacy_id = privacy_to_id('unpublished');
 				""",
-				(post_id, user.user_id, user.user_id),
+				(user.user_id,),
 				fetch_one=True,
 			)
 
-			transaction.commit()
+			await transaction.commit()
 
 		return {
 			'user_id': user.user_id,
@@ -301,16 +317,16 @@ class Uploader(SqlInterface, B2Interface) :
 		internal_post_id: int
 		post_id: PostId
 
-		with self.transaction() as transaction :
+		async with self.async_transaction() as transaction :
 			while True :
 				internal_post_id = int_from_bytes(token_bytes(6))
-				data = transaction.query("SELECT count(1) FROM kheina.public.posts WHERE post_id = %s;", (internal_post_id,), fetch_one=True)
+				data = await transaction.query("SELECT count(1) FROM kheina.public.posts WHERE post_id = %s;", (internal_post_id,), fetch_one=True)
 				if not data[0] :
 					break
 
 			return_cols: List[str] = ['created_on', 'updated_on']
 
-			data = transaction.query(f"""
+			data = await transaction.query(f"""
 				INSERT INTO kheina.public.posts
 				(privacy_id, {','.join(columns)})
 				VALUES
@@ -327,53 +343,16 @@ class Uploader(SqlInterface, B2Interface) :
 				await self._update_privacy(user, post_id, privacy, transaction=transaction, commit=False)
 				post.privacy = privacy
 
-			transaction.commit()
+			await transaction.commit()
 
 		post.post_id = post_id.int()
-		KVS.put(post_id, post)
+		KVS.put(post_id, PostCodec.dump(post))
 
 		return {
 			'post_id': post_id,
 		}
 
 
-	def convert_image(self: 'Uploader', image: Image, size: int) -> Image :
-		long_side = 0 if image.size[0] > image.size[1] else 1
-		ratio = size / image.size[long_side]
-
-		if ratio < 1 :
-			output_size = (round(image.size[0] * ratio), size) if long_side else (size, round(image.size[1] * ratio))
-			image.resize(width=output_size[0], height=output_size[1], filter=self.filter_function)
-
-		return image
-
-
-	def thumbhash(self: 'Uploader', image: Image) -> bytes :
-		long_side = 0 if image.size[0] > image.size[1] else 1
-		size = 100
-		ratio = size / image.size[long_side]
-
-		if ratio < 1 :
-			output_size = (round(image.size[0] * ratio), size) if long_side else (size, round(image.size[1] * ratio))
-			image.resize(width=output_size[0], height=output_size[1], filter='point')
-
-		hash, err = Popen(['thumbhash', 'encode-image'], stdin=PIPE, stdout=PIPE, stderr=PIPE).communicate(self.get_image_data(image))
-
-		if err :
-			raise InternalServerError(f'Failed to generate image thumbhash: {err.decode()}.')
-
-		return b64decode(hash.strip(b'\n\r= ')).rstrip(b'\x00')
-
-
-	def get_image_data(self: 'Uploader', image: Image, compress: bool = True) -> bytes :
-		if compress :
-			image.compression_quality = self.output_quality
-
-		image_data = BytesIO()
-		image.save(file=image_data)
-		return image_data.getvalue()
-
-
 	async def uploadImage(
 		self: 'Uploader',
 		user: KhUser,
@@ -383,32 +362,55 @@ class Uploader(SqlInterface, B2Interface) :
 		emoji_name: str = None,
 		web_resize: int = 0,
 	) -> Dict[str, Union[str, int, List[str]]] :
+		count_in(len(file_data))
+
+		if emoji_name :
+			self._validateEmojiName(emoji_name)
+
 		# validate it's an actual photo
-		with Image(blob=file_data) as image :
+		with stage('validate'), Image(blob=file_data) as image :
 			pass
 
-		file_on_disk: bytes = f'images/{uuid4().hex}_{filename}'.encode()
-
-		with open(file_on_disk, 'wb') as file :
-			file.write(file_data)
+		with stage('write') :
+			scratch: ScratchFile = await self.scratch.write(filename, file_data)
 
 		del file_data
 		content_type: str
 
 		try :
-			with ExifTool() as et :
-				content_type = et.get_tag('File:MIMEType', file_on_disk)
-				et.execute(b'-overwrite_original_in_place', b'-ALL=', file_on_disk)
+			with stage('exiftool'), ExifTool() as et :
+				content_type = et.get_tag('File:MIMEType', scratch.path)
+				et.execute(b'-overwrite_original_in_place', b'-ALL=', scratch.path)
 
 		except :
-			self.delete_file(file_on_disk)
+			scratch.close()
 			refid: UUID = uuid4()
 			self.logger.exception({ 'refid': refid })
 			raise InternalServerError('Failed to strip file metadata.', refid=refid)
 
-		if content_type != self._get_mime_from_filename(filename.lower()) :
-			self.delete_file(file_on_disk)
-			raise BadRequest('file extension does not match file type.')
+		# decode animated sources once, static derivatives only ever use the first frame, and only the preview coalesces the rest
+		frame: Image
+		animated_preview: Optional[bytes] = None
+
+		try :
+			if content_type != self._get_mime_from_filename(filename.lower()) :
+				raise BadRequest('file extension does not match file type.')
+
+			with stage('decode'), Image(filename=scratch.filename) as image :
+				frame = self.first_frame(image)
+
+				if self.is_animated(image) :
+					with stage('animated_preview') :
+						animated_preview = self.animated_preview_data(image)
+
+		except :
+			scratch.close()
+			raise
+
+		sizes: List[int] = self.plan_sizes(frame.size)
+
+		# when the image already fits within web_resize, the stripped file is uploaded as-is rather than re-encoded
+		web_resize = web_resize if web_resize and self.needs_resize(frame.size, web_resize) else 0
 
 		if web_resize :
 			dot_index: int = filename.rfind('.')
@@ -416,124 +418,144 @@ class Uploader(SqlInterface, B2Interface) :
 			if dot_index and filename[dot_index + 1:].lower() in self.mime_types :
 				filename = filename[:dot_index] + '-web' + filename[dot_index:]
 
-		# thumbhash
-		with Image(file=open(file_on_disk, 'rb')) as image :
-			thumbhash = self.thumbhash(image)
-
 		try :
-			with self.transaction() as transaction :
-				data: List[str] = transaction.query("""
-					SELECT posts.filename from kheina.public.posts
-					WHERE posts.post_id = %s
-						AND uploader = %s;
-					""",
-					(post_id.int(), user.user_id),
-					fetch_one=True,
-				)
+			# thumbhash
+			with stage('thumbhash'), frame.clone() as image :
+				thumbhash = self.thumbhash(image)
+
+			async with self.async_transaction() as transaction :
+				with stage('db.select') :
+					data: List[str] = await transaction.query("""
+						SELECT posts.filename from kheina.public.posts
+						WHERE posts.post_id = %s
+							AND uploader = %s;
+						""",
+						(post_id.int(), user.user_id),
+						fetch_one=True,
+					)
 
 				# if the user owns the above post, then data should always be populated, even if it's just [None]
 				if not data :
 					raise Forbidden('the post you are trying to upload to does not belong to this account.')
 
 				old_filename: str = data[0]
+				emoji: Optional[str] = None
+
+				if emoji_name :
+					# claimed before any media is uploaded, so a name someone else owns fails the upload before it overwrites anything
+					with stage('db.emoji') :
+						emoji = await self._claim_emoji(transaction, user, emoji_name, post_id.int())
+
 				fullsize_image: bytes
+				image_size: PostSize
 
-				with Image(file=open(file_on_disk, 'rb')) as image :
-					if web_resize :
+				if web_resize :
+					with stage('resize.web'), Image(filename=scratch.filename) as image :
 						image: Image = self.convert_image(image, web_resize)
 						fullsize_image = self.get_image_data(image, compress = False)
+						image_size = PostSize(
+							width=image.size[0],
+							height=image.size[1],
+						)
+
+				else :
+					# the first frame is coalesced onto the full canvas
+					image_size = PostSize(
+						width=frame.size[0],
+						height=frame.size[1],
+					)
+					# the only copy of the file, since the upload needs bytes
+					fullsize_image = scratch.read()
 
-					# optimize
-					updated: Tuple[datetime] = transaction.query("""
+				version: Optional[str] = None
+
+				if self.versioned_media :
+					# every derivative follows from the stored original and these settings, so uploading the same file again lands on the same keys
+					with stage('version') :
+						version = media_version(fullsize_image, self.derivative_settings(), filename)
+
+				# optimize
+				with stage('db.update') :
+					updated: Tuple[datetime] = await transaction.query("""
 						UPDATE kheina.public.posts
 							SET updated_on = NOW(),
 								media_type_id = media_mime_type_to_id(%s),
 								filename = %s,
 								width = %s,
 								height = %s,
-								thumbhash = %s
+								thumbhash = %s,
+								thumbnail_sizes = %s,
+								media_version = %s,
+								derivatives_version = %s
 						WHERE posts.post_id = %s
 							AND posts.uploader = %s
 						RETURNING posts.updated_on;
 						""", (
 							content_type,
 							filename,
-							image.size[0],
-							image.size[1],
+							image_size.width,
+							image_size.height,
 							thumbhash,
+							sizes,
+							version,
+							settings_version(self.derivative_settings()),
 							post_id.int(),
 							user.user_id,
 						),
 						fetch_one=True,
 					)
-					updated: datetime = updated[0]
-					image_size: PostSize = PostSize(
-						width=image.size[0],
-						height=image.size[1],
-					)
-
-				if old_filename :
-					if not await self.b2_delete_file_async(f'{post_id}/{old_filename}') :
-						self.logger.error(f'failed to delete old image: {post_id}/{old_filename}')
+				updated: datetime = updated[0]
 
-				url: str = f'{post_id}/{filename}'
-
-				if not web_resize :
-					# this would have been populated earlier, if resized
-					fullsize_image = open(file_on_disk, 'rb').read()
+				legacy: str = media_prefix(post_id, None)
+				prefix: Optional[str] = media_prefix(post_id, version) if version else None
 
 				# upload fullsize
-				self.b2_upload(fullsize_image, url, content_type=content_type)
+				url: str = self._upload_media(fullsize_image, legacy + filename, prefix and prefix + filename, content_type, 'fullsize')
 
 				del fullsize_image
 
 				# upload thumbnails
 				thumbnails = { }
 
-				for size in self.thumbnail_sizes :
-					thumbnail_url: str = f'{post_id}/thumbnails/{size}.webp'
-					with Image(file=open(file_on_disk, 'rb')) as image :
-						image = self.convert_image(image, size)
-						self.b2_upload(self.get_image_data(image), thumbnail_url, self.mime_types['webp'])
+				for thumbnail in self.render_thumbnails(frame, sizes) :
+					thumbnail_name: str = f'thumbnails/{thumbnail.name}'
+					thumbnails[thumbnail.key] = self._upload_media(thumbnail.data, legacy + thumbnail_name, prefix and prefix + thumbnail_name, self._get_mime_from_filename(thumbnail.name), str(thumbnail.key))
 
-					thumbnails[size] = thumbnail_url
+				del thumbnail
 
-				# jpeg thumbnail
-				with Image(file=open(file_on_disk, 'rb')) as image :
-					thumbnail_url: str = f'{post_id}/thumbnails/{self.thumbnail_sizes[-1]}.jpg'
-					image = self.convert_image(image, self.thumbnail_sizes[-1]).convert('jpeg')
-					self.b2_upload(self.get_image_data(image), thumbnail_url, self.mime_types['jpeg'])
+				if animated_preview :
+					thumbnails['animated'] = self._upload_media(animated_preview, f'{legacy}thumbnails/animated.webp', prefix and f'{prefix}thumbnails/animated.webp', self.mime_types['webp'], 'animated')
 
-					thumbnails['jpeg'] = thumbnail_url
+				del animated_preview
 
-				# TODO: implement emojis
-				emoji: str = None
+				if emoji :
+					with stage('resize.emoji'), frame.clone() as image :
+						emoji_data: bytes = self.emoji_data(image)
 
-				transaction.commit()
+					self._upload_derivative(emoji_data, emoji, self.mime_types['webp'], 'emoji', immutable=False)
+					del emoji_data
 
-			post: Optional[InternalPost] = await self.kvs_get(post_id)
-			if post :
-				# post is populated in cache, so we can safely update it
-				post.updated = updated
-				post.media_type = MediaType(
-					file_type=content_type[content_type.find('/')+1:],
-					mime_type=content_type,
-				)
-				post.size = image_size
-				post.filename = filename
-				post.thumbhash = thumbhash
+				await transaction.commit()
+
+			if old_filename :
+				# the previous version is removed once clients have had the chance to pick up the new one
+				ensure_future(self.collect_post_media(post_id))
 
-				KVS.put(post_id, post)
+			# the cached post has nowhere to keep media_version, so it's dropped and rebuilt from the database on the next read
+			await PostCache.remove(post_id)
 
 			return {
 				'post_id': post_id,
+				'media_version': version,
 				'url': url,
 				'emoji': emoji,
 				'thumbnails': thumbnails,
+				'thumbnail_sizes': sizes,
 			}
 
 		finally :
-			self.delete_file(file_on_disk)
+			frame.close()
+			scratch.close()
 
 
 	@HttpErrorHandler('updating post metadata')
@@ -570,10 +592,10 @@ class Uploader(SqlInterface, B2Interface) :
 		if not params :
 			raise BadRequest('no params were provided.')
 
-		with self.transaction() as t :
+		async with self.async_transaction() as t :
 			return_cols: List[str] = ['created_on', 'updated_on']
 
-			data = t.query(
+			data = await t.query(
 				query + f"""
 				WHERE uploader = %s
 					AND post_id = %s
@@ -583,35 +605,44 @@ class Uploader(SqlInterface, B2Interface) :
 				fetch_one=True,
 			)
 
+			if not data :
+				raise NotFound('the provided post does not exist or it does not belong to this account.')
+
 			if privacy :
-				await self._update_privacy(user, post_id.int(), privacy, transaction=t, commit=True)
+				await self._update_privacy(user, post_id, privacy, transaction=t, commit=True)
 
 			else :
-				t.commit()
+				await t.commit()
 
-		post: Optional[InternalPost] = await self.kvs_get(post_id)
-		if post :
-			# post is populated in cache, so we can safely update it
+		changes: Dict[str, Any] = dict(zip(columns + ['created', 'updated'], params + list(data)))
 
-			if privacy :
-				post.privacy = privacythumbhash
-
-			post = InternalPost.parse_obj({
-				**post.dict(),
-				**dict(zip(columns + ['created', 'updated'], params + list(data))),
-			})
+		if privacy :
+			changes['privacy'] = privacy
 
-			KVS.put(post_id, post)
+		await self._patch_cached_post(post_id, changes)
 
 		return True
 
 
-	async def _update_privacy(self: 'Uploader', user: KhUser, post_id: PostId, privacy: Privacy, transaction: Transaction = None, commit: bool = True) :
+	def _privacy_change_error(self: 'Uploader', old_privacy: Privacy, privacy: Privacy) -> Optional[str] :
+		if privacy == Privacy.unpublished :
+			return 'post privacy cannot be updated to unpublished.'
+
+		if old_privacy == privacy :
+			return 'post privacy cannot be updated to the current privacy level.'
+
+		if privacy == Privacy.draft and old_privacy != Privacy.unpublished :
+			return 'only unpublished posts can be marked as drafts.'
+
+		return None
+
+
+	async def _update_privacy(self: 'Uploader', user: KhUser, post_id: PostId, privacy: Privacy, transaction: AsyncTransaction = None, commit: bool = True) :
 		if privacy == Privacy.unpublished :
 			raise BadRequest('post privacy cannot be updated to unpublished.')
 
-		with transaction or self.transaction() as t :
-			data = t.query("""
+		async with transaction or self.async_transaction() as t :
+			data = await t.query("""
 				SELECT privacy.type
 				FROM kheina.public.posts
 					INNER JOIN kheina.public.privacy
@@ -627,81 +658,65 @@ class Uploader(SqlInterface, B2Interface) :
 				raise NotFound('the provided post does not exist or it does not belong to this account.')
 
 			old_privacy: Privacy = Privacy[data[0]]
+			error: Optional[str] = self._privacy_change_error(old_privacy, privacy)
 
-			if old_privacy == privacy :
-				raise BadRequest('post privacy cannot be updated to the current privacy level.')
-
-			if privacy == Privacy.draft and old_privacy != Privacy.unpublished :
-				raise BadRequest('only unpublished posts can be marked as drafts.')
+			if error :
+				raise BadRequest(error)
 
-			tags_task: Task[TagGroups] = client.post_tags(post_id)
 			vote_task: Task = None
 
 			if old_privacy in UnpublishedPrivacies and privacy not in UnpublishedPrivacies :
-				query = """
+				await t.query("""
 					INSERT INTO kheina.public.post_votes
 					(user_id, post_id, upvote)
 					VALUES
 					(%s, %s, %s)
 					ON CONFLICT DO NOTHING;
+					""",
+					(user.user_id, post_id.int(), True),
+				)
 
+				await t.query("""
 					INSERT INTO kheina.public.post_scores
 					(post_id, upvotes, downvotes, top, hot, best, controversial)
 					VALUES
 					(%s, %s, %s, %s, %s, %s, %s)
 					ON CONFLICT DO NOTHING;
+					""",
+					(post_id.int(), 1, 0, 1, calc_hot(1, 0, time()), confidence(1, 1), calc_cont(1, 0)),
+				)
 
+				await t.query("""
 					UPDATE kheina.public.posts
 						SET created_on = NOW(),
 							updated_on = NOW(),
 							privacy_id = privacy_to_id(%s)
 					WHERE posts.uploader = %s
 						AND posts.post_id = %s;
-				"""
-				params = (
-					user.user_id, post_id.int(), True,
-					post_id.int(), 1, 0, 1, calc_hot(1, 0, time()), confidence(1, 1), calc_cont(1, 0),
-					privacy.name, user.user_id, post_id.int(),
+					""",
+					(privacy.name, user.user_id, post_id.int()),
 				)
+
 				vote_task = VoteCache.put_async(f'{user.user_id}|{post_id}', 1)
 
 			else :
-				query = """
+				await t.query("""
 					UPDATE kheina.public.posts
 						SET updated_on = NOW(),
 							privacy_id = privacy_to_id(%s)
 					WHERE posts.uploader = %s
 						AND posts.post_id = %s;
-				"""
-				params = (
-					privacy.name, user.user_id, post_id.int(),
+					""",
+					(privacy.name, user.user_id, post_id.int()),
 				)
 
-			await t.query_async(query, params)
-
-			try :
-				tags: TagGroups = await tags_task
-
-				if privacy == Privacy.public :
-					ensure_future(self._increment_total_post_count(1))
-					ensure_future(self._increment_user_count(user.user_id, 1))
-					for tag in filter(None, flatten(tags)) :
-						ensure_future(self._increment_tag_count(tag, 1))
-
-				elif old_privacy == Privacy.public :
-					ensure_future(self._increment_total_post_count(-1))
-					ensure_future(self._increment_user_count(user.user_id, -1))
-					for tag in filter(None, flatten(tags)) :
-						ensure_future(self._increment_tag_count(tag, -1))
-
-			except ClientResponseError as e :
-				if e.status == 404 :
-					return True
-
-				raise
+			if Privacy.public in (old_privacy, privacy) :
+				# tags are read inside this transaction, so privacy changes never wait on the tagger service
+				tags: Dict[int, List[str]] = await self._post_tags_many(t, [post_id.int()])
+				self._apply_privacy_counts(user, { post_id.int(): (old_privacy, privacy) }, tags)
 
 			if commit :
-				t.commit()
+				await t.commit()
 
 			if vote_task :
 				await vote_task
@@ -713,9 +728,271 @@ class Uploader(SqlInterface, B2Interface) :
 	async def updatePrivacy(self: 'Uploader', user: KhUser, post_id: PostId, privacy: Privacy) :
 		await self._update_privacy(user, post_id, privacy)
 
-		if await KVS.exists_async(post_id) :
-			# we need the created and updated values set by db, so just remove
-			ensure_future(KVS.remove_async(post_id))
+		# we need the created and updated values set by db, so just remove
+		ensure_future(PostCache.remove(post_id))
+
+
+	async def _select_owned_privacy(self: 'Uploader', t: AsyncTransaction, user: KhUser, post_ids: List[int]) -> Dict[int, Privacy] :
+		data = await t.query("""
+			SELECT posts.post_id, privacy.type
+			FROM kheina.public.posts
+				INNER JOIN kheina.public.privacy
+					ON posts.privacy_id = privacy.privacy_id
+			WHERE posts.uploader = %s
+				AND posts.post_id = ANY(%s::bigint[]);
+			""",
+			(user.user_id, post_ids),
+			fetch_all=True,
+		)
+
+		return { row[0]: Privacy[row[1]] for row in data }
+
+
+	async def _post_tags_many(self: 'Uploader', t: AsyncTransaction, post_ids: List[int]) -> Dict[int, List[str]] :
+		tags: Dict[int, List[str]] = { post_id: [] for post_id in post_ids }
+
+		if not post_ids :
+			return tags
+
+		data = await t.query("""
+			SELECT tag_post.post_id, tags.tag
+			FROM kheina.public.tag_post
+				INNER JOIN kheina.public.tags
+					ON tags.tag_id = tag_post.tag_id
+			WHERE tag_post.post_id = ANY(%s::bigint[]);
+			""",
+			(post_ids,),
+			fetch_all=True,
+		)
+
+		for post_id, tag in data :
+			tags[post_id].append(tag)
+
+		return tags
+
+
+	async def _update_privacy_many(
+		self: 'Uploader',
+		user: KhUser,
+		t: AsyncTransaction,
+		changes: Dict[int, Privacy],
+		current: Dict[int, Privacy],
+		results: Dict[int, Dict[str, Any]],
+	) -> Dict[int, Tuple[Privacy, Privacy]] :
+		"""
+		validates and applies privacy changes for many posts with set based sql, recording failures in results.
+		returns the (old, new) privacy of every post that was changed.
+		"""
+		applied: Dict[int, Tuple[Privacy, Privacy]] = { }
+		published: Dict[int, str] = { }
+		updated: Dict[int, str] = { }
+
+		for post_id, privacy in changes.items() :
+			if post_id not in current :
+				results[post_id] = { 'success': False, 'status': 404, 'error': 'the provided post does not exist or it does not belong to this account.' }
+				continue
+
+			error: Optional[str] = self._privacy_change_error(current[post_id], privacy)
+
+			if error :
+				results[post_id] = { 'success': False, 'status': 400, 'error': error }
+				continue
+
+			applied[post_id] = (current[post_id], privacy)
+
+			if current[post_id] in UnpublishedPrivacies and privacy not in UnpublishedPrivacies :
+				published[post_id] = privacy.name
+
+			else :
+				updated[post_id] = privacy.name
+
+		if published :
+			await t.query("""
+				INSERT INTO kheina.public.post_votes
+				(user_id, post_id, upvote)
+				SELECT %s, unnest(%s::bigint[]), true
+				ON CONFLICT DO NOTHING;
+				""",
+				(user.user_id, list(published)),
+			)
+
+			await t.query("""
+				INSERT INTO kheina.public.post_scores
+				(post_id, upvotes, downvotes, top, hot, best, controversial)
+				SELECT unnest(%s::bigint[]), 1, 0, 1, %s, %s, %s
+				ON CONFLICT DO NOTHING;
+				""",
+				(list(published), calc_hot(1, 0, time()), confidence(1, 1), calc_cont(1, 0)),
+			)
+
+			await t.query("""
+				UPDATE kheina.public.posts
+					SET created_on = NOW(),
+						updated_on = NOW(),
+						privacy_id = privacy_to_id(changes.privacy)
+				FROM unnest(%s::bigint[], %s::text[]) AS changes(post_id, privacy)
+				WHERE posts.post_id = changes.post_id
+					AND posts.uploader = %s;
+				""",
+				(list(published), list(published.values()), user.user_id),
+			)
+
+		if updated :
+			await t.query("""
+				UPDATE kheina.public.posts
+					SET updated_on = NOW(),
+						privacy_id = privacy_to_id(changes.privacy)
+				FROM unnest(%s::bigint[], %s::text[]) AS changes(post_id, privacy)
+				WHERE posts.post_id = changes.post_id
+					AND posts.uploader = %s;
+				""",
+				(list(updated), list(updated.values()), user.user_id),
+			)
+
+		return applied
+
+
+	def _apply_privacy_counts(self: 'Uploader', user: KhUser, applied: Dict[int, Tuple[Privacy, Privacy]], tags: Dict[int, List[str]]) -> None :
+		# sums the counter changes of every privacy transition so they're all applied in a single batch
+		deltas: Dict[Tuple[CountKind, str], int] = { }
+
+		for post_id, (old_privacy, privacy) in applied.items() :
+			delta: int = 1 if privacy == Privacy.public else -1 if old_privacy == Privacy.public else 0
+
+			if not delta :
+				continue
+
+			for key in [(CountKind.total, '_'), (CountKind.user, f'@{user.user_id}'), *((CountKind.tag, tag) for tag in filter(None, tags.get(post_id, [])))] :
+				deltas[key] = deltas.get(key, 0) + delta
+
+		if deltas :
+			ensure_future(self._increment_counts(deltas))
+
+
+	def _finish_privacy_batch(self: 'Uploader', user: KhUser, applied: Dict[int, Tuple[Privacy, Privacy]], tags: Dict[int, List[str]]) -> None :
+		self._apply_privacy_counts(user, applied, tags)
+
+		for post_id, (old_privacy, privacy) in applied.items() :
+			if old_privacy in UnpublishedPrivacies and privacy not in UnpublishedPrivacies :
+				ensure_future(VoteCache.put_async(f'{user.user_id}|{PostId(post_id)}', 1))
+
+
+	async def _invalidate_posts(self: 'Uploader', post_ids: List[int]) -> None :
+		# we need the created and updated values set by db, so just remove
+		ensure_future(PostCache.remove_many(list(map(PostId, post_ids))))
+
+
+	def _batch_response(self: 'Uploader', post_ids: List[int], results: Dict[int, Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]] :
+		return {
+			'results': [
+				{ 'post_id': PostId(post_id), **results.get(post_id, { 'success': True, 'status': 204 }) }
+				for post_id in post_ids
+			],
+		}
+
+
+	@HttpErrorHandler('updating post privacy in bulk')
+	async def updatePrivacyBatch(self: 'Uploader', user: KhUser, posts: List[PrivacyRequest]) -> Dict[str, List[Dict[str, Any]]] :
+		changes: Dict[int, Privacy] = { item.post_id.int(): item.privacy for item in posts }
+		results: Dict[int, Dict[str, Any]] = { }
+
+		async with self.async_transaction() as t :
+			current: Dict[int, Privacy] = await self._select_owned_privacy(t, user, list(changes))
+			applied: Dict[int, Tuple[Privacy, Privacy]] = await self._update_privacy_many(user, t, changes, current, results)
+			tags: Dict[int, List[str]] = await self._post_tags_many(t, [post_id for post_id, privacies in applied.items() if Privacy.public in privacies])
+			await t.commit()
+
+		self._finish_privacy_batch(user, applied, tags)
+		await self._invalidate_posts(list(applied))
+
+		return self._batch_response(list(changes), results)
+
+
+	@HttpErrorHandler('updating post metadata in bulk')
+	async def updatePostMetadataBatch(self: 'Uploader', user: KhUser, posts: List[UpdateRequest]) -> Dict[str, List[Dict[str, Any]]] :
+		results: Dict[int, Dict[str, Any]] = { }
+		metadata: List[UpdateRequest] = []
+		privacy_changes: Dict[int, Privacy] = { }
+
+		for item in posts :
+			post_id: int = item.post_id.int()
+
+			try :
+				self._validateTitle(item.title)
+				self._validateDescription(item.description)
+
+			except BadRequest as e :
+				results[post_id] = { 'success': False, 'status': 400, 'error': str(e) }
+				continue
+
+			if item.title is None and item.description is None and not item.rating and not item.privacy :
+				results[post_id] = { 'success': False, 'status': 400, 'error': 'no params were provided.' }
+				continue
+
+			if item.title is not None or item.description is not None or item.rating :
+				metadata.append(item)
+
+			if item.privacy :
+				privacy_changes[post_id] = item.privacy
+
+		applied: Dict[int, Tuple[Privacy, Privacy]] = { }
+		tags: Dict[int, List[str]] = { }
+		updated: List[int] = []
+
+		async with self.async_transaction() as t :
+			current: Dict[int, Privacy] = await self._select_owned_privacy(t, user, [item.post_id.int() for item in posts if item.post_id.int() not in results])
+
+			for item in metadata :
+				if item.post_id.int() not in current :
+					results[item.post_id.int()] = { 'success': False, 'status': 404, 'error': 'the provided post does not exist or it does not belong to this account.' }
+
+			# privacy changes are validated before anything is written, so an item whose privacy change is rejected keeps its old metadata too
+			for post_id, privacy in privacy_changes.items() :
+				error: Optional[str] = self._privacy_change_error(current[post_id], privacy) if post_id in current else None
+
+				if error :
+					results[post_id] = { 'success': False, 'status': 400, 'error': error }
+
+			metadata = [item for item in metadata if item.post_id.int() in current and item.post_id.int() not in results]
+
+			if metadata :
+				data = await t.query("""
+					UPDATE kheina.public.posts
+						SET updated_on = NOW(),
+							title = CASE WHEN changes.set_title THEN changes.title ELSE posts.title END,
+							description = CASE WHEN changes.set_description THEN changes.description ELSE posts.description END,
+							rating = CASE WHEN changes.rating IS NULL THEN posts.rating ELSE rating_to_id(changes.rating) END
+					FROM unnest(%s::bigint[], %s::boolean[], %s::text[], %s::boolean[], %s::text[], %s::text[])
+						AS changes(post_id, set_title, title, set_description, description, rating)
+					WHERE posts.post_id = changes.post_id
+						AND posts.uploader = %s
+					RETURNING posts.post_id;
+					""",
+					(
+						[item.post_id.int() for item in metadata],
+						[item.title is not None for item in metadata],
+						[item.title or None for item in metadata],
+						[item.description is not None for item in metadata],
+						[item.description or None for item in metadata],
+						[item.rating.name if item.rating else None for item in metadata],
+						user.user_id,
+					),
+					fetch_all=True,
+				)
+				updated = [row[0] for row in data]
+
+			privacy_changes = { post_id: privacy for post_id, privacy in privacy_changes.items() if post_id not in results }
+
+			if privacy_changes :
+				applied = await self._update_privacy_many(user, t, privacy_changes, current, results)
+				tags = await self._post_tags_many(t, [post_id for post_id, privacies in applied.items() if Privacy.public in privacies])
+
+			await t.commit()
+
+		self._finish_privacy_batch(user, applied, tags)
+		await self._invalidate_posts(list(set(updated) | set(applied)))
+
+		return self._batch_response([item.post_id.int() for item in posts], results)
 
 
 	@HttpErrorHandler('setting user icon')
@@ -723,54 +1000,70 @@ class Uploader(SqlInterface, B2Interface) :
 		if coordinates.width != coordinates.height :
 			raise BadRequest(f'icons must be square. width({coordinates.width}) != height({coordinates.height})')
 
-		ipost: Task[InternalPost] = ensure_future(client.post(post_id))
 		iuser: Task[InternalUser] = ensure_future(client.user(user.user_id))
 		image = None
 
-		ipost: InternalPost = await ipost
+		media_path: str = await self._media_path(post_id)
 
 		try :
-			async with request(
-				'GET',
-				f'https://cdn.fuzz.ly/{post_id}/{quote(ipost.filename)}',
-				raise_for_status=True,
-			) as response :
-				image = Image(blob=await response.read())
+			with stage('download') :
+				async with request(
+					'GET',
+					f'https://cdn.fuzz.ly/{media_path}',
+					raise_for_status=True,
+				) as response :
+					data: bytes = await response.read()
+
+			count_in(len(data))
+
+			with stage('decode') :
+				image = Image(blob=data)
+
+			del data
 
 		except ClientResponseError as e :
 			raise BadGateway('unable to retrieve image from B2.', inner_exception=str(e))
 
 		# upload new icon
-		image.crop(**coordinates.dict())
-		self.convert_image(image, self.icon_size)
+		with stage('crop') :
+			self.crop_icon(image, coordinates)
 
 		iuser: InternalUser = await iuser
 		handle = iuser.handle.lower()
 
-		self.b2_upload(self.get_image_data(image), f'{post_id}/icons/{handle}.webp', self.mime_types['webp'])
+		with stage('encode.webp') :
+			data: bytes = self.get_image_data(image)
+
+		# the jpeg is encoded from the same crop, so the webp alone decides the version
+		version: Optional[str] = content_version(data) if self.versioned_media else None
+		legacy: str = f'{post_id}/icons/'
+		prefix: Optional[str] = f'{legacy}{version}/' if version else None
+		self._upload_media(data, f'{legacy}{handle}.webp', prefix and f'{prefix}{handle}.webp', self.mime_types['webp'], 'webp')
 
-		image.convert('jpeg')
-		self.b2_upload(self.get_image_data(image), f'{post_id}/icons/{handle}.jpg', self.mime_types['jpeg'])
+		with stage('encode.jpeg') :
+			image.convert('jpeg')
+			data: bytes = self.get_image_data(image)
+
+		self._upload_media(data, f'{legacy}{handle}.jpg', prefix and f'{prefix}{handle}.jpg', self.mime_types['jpeg'], 'jpeg')
 
 		image.close()
 
 		# update db to point to new icon
 		await self.query_async("""
 			UPDATE kheina.public.users
-				SET icon = %s
+				SET icon = %s,
+					icon_version = %s
 			WHERE users.user_id = %s;
 			""",
-			(post_id.int(), user.user_id),
+			(post_id.int(), version, user.user_id),
 			commit=True,
 		)
 
-		# cleanup old icons
-		if post_id != iuser.icon :
-			await self.b2_delete_file_async(f'{iuser.icon}/icons/{handle}.webp')
-			await self.b2_delete_file_async(f'{iuser.icon}/icons/{handle}.jpg')
+		# cleanup old icons, from the previous post and previous versions from this one
+		ensure_future(self.collect_user_media('icon', user.user_id, handle, { post_id, PostId(iuser.icon) } if iuser.icon else { post_id }))
 
-		iuser.icon = post_id
-		ensure_future(UserKVS.put_async(str(iuser.user_id), iuser))
+		# the cached user has nowhere to keep icon_version, so it's dropped and rebuilt on the next read
+		ensure_future(UserCache.remove(str(iuser.user_id)))
 
 
 	@HttpErrorHandler('setting user banner')
@@ -778,55 +1071,70 @@ class Uploader(SqlInterface, B2Interface) :
 		if round(coordinates.width / 3) != coordinates.height :
 			raise BadRequest(f'banners must be a 3x:1 rectangle. round(width / 3)({round(coordinates.width / 3)}) != height({coordinates.height})')
 
-		ipost: Task[InternalPost] = ensure_future(client.post(post_id))
 		iuser: Task[InternalUser] = ensure_future(client.user(user.user_id))
 		image = None
 
-		ipost: Post = await ipost
+		media_path: str = await self._media_path(post_id)
 
 		try :
-			async with request(
-				'GET',
-				f'https://cdn.fuzz.ly/{post_id}/{quote(ipost.filename)}',
-				raise_for_status=True,
-			) as response :
-				image = Image(blob=await response.read())
+			with stage('download') :
+				async with request(
+					'GET',
+					f'https://cdn.fuzz.ly/{media_path}',
+					raise_for_status=True,
+				) as response :
+					data: bytes = await response.read()
+
+			count_in(len(data))
+
+			with stage('decode') :
+				image = Image(blob=data)
+
+			del data
 
 		except ClientResponseError as e :
 			raise BadGateway('unable to retrieve image from B2.', inner_exception=str(e))
 
 		# upload new banner
-		image.crop(**coordinates.dict())
-		if image.size[0] > self.banner_size * 3 or image.size[1] > self.banner_size :
-			image.resize(width=self.banner_size * 3, height=self.banner_size, filter=self.filter_function)
+		with stage('crop') :
+			self.crop_banner(image, coordinates)
 
 		iuser: InternalUser = await iuser
 		handle = iuser.handle.lower()
 
-		self.b2_upload(self.get_image_data(image), f'{post_id}/banners/{handle}.webp', self.mime_types['webp'])
+		with stage('encode.webp') :
+			data: bytes = self.get_image_data(image)
+
+		# the jpeg is encoded from the same crop, so the webp alone decides the version
+		version: Optional[str] = content_version(data) if self.versioned_media else None
+		legacy: str = f'{post_id}/banners/'
+		prefix: Optional[str] = f'{legacy}{version}/' if version else None
+		self._upload_media(data, f'{legacy}{handle}.webp', prefix and f'{prefix}{handle}.webp', self.mime_types['webp'], 'webp')
+
+		with stage('encode.jpeg') :
+			image.convert('jpeg')
+			data: bytes = self.get_image_data(image)
 
-		image.convert('jpeg')
-		self.b2_upload(self.get_image_data(image), f'{post_id}/banners/{handle}.jpg', self.mime_types['jpeg'])
+		self._upload_media(data, f'{legacy}{handle}.jpg', prefix and f'{prefix}{handle}.jpg', self.mime_types['jpeg'], 'jpeg')
 
 		image.close()
 
 		# update db to point to new banner
 		await self.query_async("""
 			UPDATE kheina.public.users
-				SET banner = %s
+				SET banner = %s,
+					banner_version = %s
 			WHERE users.user_id = %s;
 			""",
-			(post_id.int(), user.user_id),
+			(post_id.int(), version, user.user_id),
 			commit=True,
 		)
 
-		# cleanup old banners
-		if post_id != iuser.banner :
-			await self.b2_delete_file_async(f'{iuser.banner}/banners/{handle}.webp')
-			await self.b2_delete_file_async(f'{iuser.banner}/banners/{handle}.jpg')
+		# cleanup old banners, from the previous post and previous versions from this one
+		ensure_future(self.collect_user_media('banner', user.user_id, handle, { post_id, PostId(iuser.banner) } if iuser.banner else { post_id }))
 
-		iuser.banner = post_id
-		ensure_future(UserKVS.put_async(str(iuser.user_id), iuser))
+		# the cached user has nowhere to keep banner_version, so it's dropped and rebuilt on the next read
+		ensure_future(UserCache.remove(str(iuser.user_id)))
 
 
 	@HttpErrorHandler('removing post')
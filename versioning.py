@@ -0,0 +1,218 @@
+from asyncio import gather, sleep
+from base64 import urlsafe_b64encode
+from hashlib import sha1 as hashlib_sha1
+from hashlib import sha256
+from mmap import mmap
+from os import environ
+from time import sleep as sleep_sync
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Union
+from urllib.parse import quote
+
+import ujson
+from imaging import thumbnail_names
+from kh_common.backblaze import B2UploadError
+from requests import post as requests_post
+
+from fuzzly.models.post import PostId
+
+
+# versioned keys never change content, so caches can keep them for as long as they like
+ImmutableCacheControl: str = 'public, max-age=31536000, immutable'
+# the services that read media still build unversioned urls, so versioned keys are only written alongside them once enabled
+VersionedLayout: bool = environ.get('UPLOADER_VERSIONED_MEDIA', '').lower() in { '1', 'true' }
+
+
+def content_version(*parts: Any) -> str :
+	"""
+	returns a short, url safe version for the given content. bytes-like parts are hashed as-is, anything else by its repr.
+	"""
+	digest = sha256()
+
+	for part in parts :
+		digest.update(part if isinstance(part, (bytes, bytearray, memoryview, mmap)) else repr(part).encode())
+		digest.update(b'\0')
+
+	# 48 bits encode to exactly 8 characters, without padding
+	return urlsafe_b64encode(digest.digest()[:6]).decode()
+
+
+def media_version(original: Union[bytes, memoryview, mmap], settings: Dict[str, Any], filename: str) -> str :
+	"""
+	the version of a post's media, from its stored original, the filename it's stored under and the derivative settings.
+	uploads and the backfill both version through here, so the backfill recognizes posts it has nothing to change for.
+	"""
+	return content_version(original, settings, filename)
+
+
+def settings_version(settings: Dict[str, Any]) -> str :
+	"""
+	the version of the derivative settings alone, recorded with every post's media whichever layout it's written in,
+	so the backfill can skip posts that were already rendered with the current settings without downloading them.
+	"""
+	return content_version(settings)
+
+
+def media_prefix(post_id: Union[PostId, int], version: Optional[str]) -> str :
+	# unversioned media, which every post has, lives directly under the post id
+	return f'{PostId(post_id)}/{version}/' if version else f'{PostId(post_id)}/'
+
+
+class VersionedMedia :
+	"""
+	post media is always written to its legacy keys, {post_id}/{filename} and {post_id}/thumbnails/, and
+	icons and banners to {post_id}/icons/{handle}.webp, which are overwritten in place. when the versioned
+	layout is enabled, it's also written under {post_id}/{media_version}/ and {post_id}/icons/{icon_version}/,
+	where each version is a hash of the content it holds, and the versions are recorded in the database.
+	a versioned key's content never changes, so those are uploaded with a far-future, immutable Cache-Control.
+	media that was replaced is garbage collected gc_delay seconds later, so clients still holding the old
+	urls have time to refresh. the current media is read from the database when the collection runs, so an
+	upload that landed in the meantime is never collected, and the current legacy keys are always kept.
+	relies on B2Interface's upload url and retry settings, AsyncSqlInterface and B2Cleanup.
+	"""
+
+	def __init__(self: 'VersionedMedia', gc_delay: Optional[float] = None, versioned: Optional[bool] = None) -> None :
+		self.media_gc_delay: float = float(environ.get('UPLOADER_MEDIA_GC_DELAY', 3600)) if gc_delay is None else gc_delay
+		self.versioned_media: bool = VersionedLayout if versioned is None else versioned
+
+
+	def b2_upload_immutable(self: 'VersionedMedia', file_data: bytes, filename: str, content_type: str) -> Dict[str, Any] :
+		"""
+		B2Interface.b2_upload, with a Cache-Control b2 serves the file with. b2_upload has no way to add file info headers.
+		"""
+		sha1: str = hashlib_sha1(file_data).hexdigest()
+		upload_url: Optional[Dict[str, Any]] = None
+		backoff: float = 1
+		content: Optional[bytes] = None
+		status: Optional[int] = None
+
+		for _ in range(self.b2_max_retries) :
+			if not upload_url :
+				upload_url = self._obtain_upload_url()
+
+			try :
+				response = requests_post(
+					upload_url['uploadUrl'],
+					headers={
+						'authorization': upload_url['authorizationToken'],
+						'X-Bz-File-Name': quote(filename),
+						'Content-Type': content_type,
+						'Content-Length': str(len(file_data)),
+						'X-Bz-Content-Sha1': sha1,
+						'X-Bz-Info-b2-cache-control': quote(ImmutableCacheControl, safe=''),
+					},
+					data=file_data,
+					timeout=self.b2_timeout,
+				)
+				status = response.status_code
+
+				if response.ok :
+					return ujson.loads(response.content)
+
+				content = response.content
+
+				if status in { 401, 503 } :
+					# the upload url expired or its pod is busy, b2 asks for a new one rather than a retry
+					upload_url = None
+
+			except Exception as e :
+				self.logger.error('error encountered during b2 upload.', exc_info=e)
+				upload_url = None
+
+			sleep_sync(backoff)
+			backoff = min(backoff * 2, self.b2_max_backoff)
+
+		raise B2UploadError(
+			f'Upload to b2 failed, max retries exceeded: {self.b2_max_retries}.',
+			response=ujson.loads(content) if content else None,
+			status=status,
+			filesize=len(file_data),
+		)
+
+
+	async def collect_post_media(self: 'VersionedMedia', post_id: PostId) -> None :
+		"""
+		deletes the post's replaced originals and every version of its media but the current one, after gc_delay.
+		the current original and thumbnails under the legacy keys are kept, and legacy thumbnails for sizes the
+		current image no longer has are deleted. icons and banners cropped from the post outlive its image, so
+		they are left to collect_user_media.
+		"""
+		await sleep(self.media_gc_delay)
+
+		try :
+			data: Optional[Tuple[Optional[str], Optional[str], Optional[List[int]]]] = await self.async_query("""
+				SELECT posts.filename, posts.media_version, posts.thumbnail_sizes
+				FROM kheina.public.posts
+				WHERE posts.post_id = %s;
+				""",
+				(post_id.int(),),
+				fetch_one=True,
+			)
+
+		except Exception as e :
+			self.logger.error(f'failed to read the media version of {post_id} for cleanup.', exc_info=e)
+			return
+
+		if not data or not data[0] :
+			# deleted since, so there's nothing to tell the current media apart by
+			return
+
+		legacy: str = media_prefix(post_id, None)
+		kept: Tuple[str, ...] = (f'{legacy}icons/', f'{legacy}banners/')
+		current: Set[str] = { legacy + data[0] }
+
+		if data[2] :
+			# the animated preview's presence isn't recorded, so it's only ever replaced
+			current.update(f'{legacy}thumbnails/{name}' for name in [*thumbnail_names(data[2]), 'animated.webp'])
+
+		else :
+			# uploaded before thumbnail sizes were recorded, so there's no telling which ones it has
+			kept += (f'{legacy}thumbnails/',)
+
+		if data[1] :
+			kept += (media_prefix(post_id, data[1]),)
+
+		def remove(file: Dict[str, str], superseded: bool) -> bool :
+			return superseded or not (file['fileName'] in current or file['fileName'].startswith(kept))
+
+		await self.cleanup_prefix(legacy, remove)
+
+
+	async def collect_user_media(self: 'VersionedMedia', column: str, user_id: int, handle: str, post_ids: Iterable[PostId]) -> None :
+		"""
+		deletes the user's icons or banners, by column, under each of post_ids except the current ones, after gc_delay.
+		the legacy keys under the current post are kept, along with the current version.
+		"""
+		await sleep(self.media_gc_delay)
+
+		try :
+			# column is only ever icon or banner, never user input
+			data: Optional[Tuple[Optional[int], Optional[str]]] = await self.async_query(f"""
+				SELECT users.{column}, users.{column}_version
+				FROM kheina.public.users
+				WHERE users.user_id = %s;
+				""",
+				(user_id,),
+				fetch_one=True,
+			)
+
+		except Exception as e :
+			self.logger.error(f'failed to read the {column} version of user {user_id} for cleanup.', exc_info=e)
+			return
+
+		if not data or data[0] is None :
+			return
+
+		legacy: str = f'{PostId(data[0])}/{column}s/'
+		current: Tuple[str, ...] = (f'{legacy}{handle}.',)
+
+		if data[1] :
+			current += (f'{legacy}{data[1]}/',)
+
+		def remove(file: Dict[str, str], superseded: bool) -> bool :
+			# other users may have cropped their own from the same post
+			if file['fileName'].rsplit('/', 1)[-1].rsplit('.', 1)[0] != handle :
+				return False
+
+			return superseded or not file['fileName'].startswith(current)
+
+		await gather(*(self.cleanup_prefix(f'{post_id}/{column}s/', remove) for post_id in set(post_ids)))